@@ -119,6 +119,84 @@ class Configuration:
         return self.data['mount']
 
 
+class TimeIndex:
+    """ Index of the rows of a table by time
+
+    The times are sorted once, so that the rows near a given time are found by binary search rather than by testing
+    every row. The rows found are exactly those of the same test applied to every row, in increasing order.
+    """
+    
+    def __init__(self, time: numpy.array, interval: numpy.array = None):
+        """ Create a time index
+
+        :param time: Time of each row
+        :param interval: Interval of validity of each row (optional, needed for rows_containing)
+        """
+        self.time = numpy.array(time, dtype='float')
+        self.interval = None if interval is None else numpy.array(interval, dtype='float')
+        self.order = numpy.argsort(self.time, kind='stable')
+        self.sorted_time = self.time[self.order]
+        self.monotonic = numpy.array_equal(self.order, numpy.arange(len(self.order)))
+        if self.interval is not None and len(self.interval) > 0:
+            self.max_halfwidth = numpy.max(self.interval) / 2.0
+        else:
+            self.max_halfwidth = 0.0
+    
+    @classmethod
+    def cached(cls, table, interval: bool = False):
+        """ The time index of a GainTable, Visibility or BlockVisibility, made once and kept with the table
+
+        The table drops its index whenever its data are replaced or its times or intervals are set through the
+        properties, and the index is then remade here. Changes made in place to data['time'] or data['interval']
+        are not seen, so times must be changed through the properties e.g. vis.time = vis.time + offset.
+
+        :param table: GainTable, Visibility or BlockVisibility
+        :param interval: Index the interval of validity of each row as well
+        :return: TimeIndex
+        """
+        index = getattr(table, '_time_index', None)
+        if index is None:
+            index = cls(table.time, table.interval if interval else None)
+            table._time_index = index
+        return index
+    
+    def candidates(self, start, end) -> numpy.ndarray:
+        """ Rows with times from start to end, allowing for rounding at the ends
+
+        :param start: Start time
+        :param end: End time
+        :return: Array of row indices, sorted by time
+        """
+        margin = 1e-12 * (abs(start) + abs(end))
+        first = numpy.searchsorted(self.sorted_time, start - margin, side='left')
+        last = numpy.searchsorted(self.sorted_time, end + margin, side='right')
+        return self.order[first:last]
+    
+    def rows_near(self, time, halfwidth, inclusive=False) -> numpy.ndarray:
+        """ Rows with abs(row time - time) < halfwidth, or <= halfwidth if inclusive
+
+        :param time: Time
+        :param halfwidth: Half width of the time interval
+        :param inclusive: Include rows at exactly halfwidth
+        :return: Array of row indices
+        """
+        within = numpy.less_equal if inclusive else numpy.less
+        rows = self.candidates(time - halfwidth, time + halfwidth)
+        rows = rows[within(numpy.abs(self.time[rows] - time), halfwidth)]
+        return rows if self.monotonic else numpy.sort(rows)
+    
+    def rows_containing(self, time) -> numpy.ndarray:
+        """ Rows whose interval of validity contains the time i.e. abs(row time - time) < row interval / 2
+
+        :param time: Time
+        :return: Array of row indices
+        """
+        assert self.interval is not None, "Intervals of validity are needed"
+        rows = self.candidates(time - self.max_halfwidth, time + self.max_halfwidth)
+        rows = rows[numpy.abs(self.time[rows] - time) < self.interval[rows] / 2.0]
+        return rows if self.monotonic else numpy.sort(rows)
+
+
 class GainTable:
     """ Gain table with data_models: time, antenna, gain[:, chan, rec, rec], weight columns
 
@@ -174,14 +252,39 @@ class GainTable:
         size += self.data.size * sys.getsizeof(self.data)
         return size / 1024.0 / 1024.0 / 1024.0
     
+    @property
+    def data(self):
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._time_index = None
+    
     @property
     def time(self):
         return self.data['time']
     
+    @time.setter
+    def time(self, time):
+        self.data['time'] = time
+        self._time_index = None
+    
     @property
     def interval(self):
         return self.data['interval']
     
+    @interval.setter
+    def interval(self, interval):
+        self.data['interval'] = interval
+        self._time_index = None
+    
+    @property
+    def time_index(self):
+        """ Index of the rows by time and interval (see TimeIndex.cached)
+        """
+        return TimeIndex.cached(self, interval=True)
+    
     @property
     def gain(self):
         return self.data['gain']
@@ -444,7 +547,7 @@ class Visibility:
                  time=None, antenna1=None, antenna2=None, vis=None,
                  weight=None, imaging_weight=None, integration_time=None,
                  polarisation_frame=PolarisationFrame('stokesI'), cindex=None,
-                 blockvis=None):
+                 blockvis=None, precision='double'):
         """Visibility
 
         :param data:
@@ -463,6 +566,7 @@ class Visibility:
         :param polarisation_frame:
         :param cindex:
         :param blockvis:
+        :param precision: Precision of the vis, weight and imaging_weight columns 'double' | 'single'
         """
         if data is None and vis is not None:
             if imaging_weight is None:
@@ -475,6 +579,8 @@ class Visibility:
             assert len(antenna2) == nvis
             
             npol = polarisation_frame.npol
+            assert precision in ['double', 'single'], "Unknown precision %s" % precision
+            ctype, ftype = ('>c8', '>f4') if precision == 'single' else ('>c16', '>f8')
             desc = [('index', '>i8'),
                     ('uvw', '>f8', (3,)),
                     ('time', '>f8'),
@@ -483,9 +589,9 @@ class Visibility:
                     ('integration_time', '>f8'),
                     ('antenna1', '>i8'),
                     ('antenna2', '>i8'),
-                    ('vis', '>c16', (npol,)),
-                    ('weight', '>f8', (npol,)),
-                    ('imaging_weight', '>f8', (npol,))]
+                    ('vis', ctype, (npol,)),
+                    ('weight', ftype, (npol,)),
+                    ('imaging_weight', ftype, (npol,))]
             data = numpy.zeros(shape=[nvis], dtype=desc)
             data['index'] = list(range(nvis))
             data['uvw'] = uvw
@@ -557,13 +663,33 @@ class Visibility:
     def w(self):
         return self.data['uvw'][:, 2]
     
+    @property
+    def data(self):
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._time_index = None
+    
     @property
     def time(self):
         return self.data['time']
     
+    @time.setter
+    def time(self, time):
+        self.data['time'] = time
+        self._time_index = None
+    
     @property
     def integration_time(self):
         return self.data['integration_time']
+
+    @property
+    def time_index(self):
+        """ Index of the rows by time (see TimeIndex.cached)
+        """
+        return TimeIndex.cached(self)
     
     @property
     def frequency(self):
@@ -655,6 +781,7 @@ class BlockVisibility:
         self.phasecentre = phasecentre  # Phase centre of observation
         self.configuration = configuration  # Antenna/station configuration
         self.polarisation_frame = polarisation_frame
+        self.coalescence_plans = dict()  # Coalescence plans keyed by coalescence parameters
     
     def __str__(self):
         """Default printer for Skycomponent
@@ -716,13 +843,33 @@ class BlockVisibility:
     def weight(self):
         return self.data['weight']
     
+    @property
+    def data(self):
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._time_index = None
+    
     @property
     def time(self):
         return self.data['time']
     
+    @time.setter
+    def time(self, time):
+        self.data['time'] = time
+        self._time_index = None
+    
     @property
     def integration_time(self):
         return self.data['integration_time']
+
+    @property
+    def time_index(self):
+        """ Index of the rows by time (see TimeIndex.cached)
+        """
+        return TimeIndex.cached(self)
     
     @property
     def nvis(self):
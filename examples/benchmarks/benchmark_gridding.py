@@ -0,0 +1,71 @@
+""" Benchmark of the convolutional gridding engines.
+
+The throughput of convolutional_grid is measured in kernel samples per second for the loop, numpy and numba
+engines, and for numba with several threads. The sampling is that of a snapshot of SKA1-LOW: 512 stations (130816
+baselines) and 4 channels. Two kernels are used:
+
+ - the 8 by 8 anti-aliasing kernel oversampled by 8, with the uv coordinates sorted as for time ordered data
+ - a w projection kernel list of 16 kernels of width 16 oversampled by 8, with random uv coordinates
+
+The loop engine is timed on the first few thousand visibilities only.
+
+Usage::
+
+    python benchmark_gridding.py [nvis]
+
+"""
+import sys
+import time
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid
+
+
+def make_kernels(nkernels=16, width=16, oversampling=8):
+    """ Random oversampled kernels of the shape made by w_kernel_list
+    """
+    rs = numpy.random.RandomState(1)
+    shape = [oversampling, oversampling, width, width]
+    return [rs.normal(size=shape) + 1j * rs.normal(size=shape) for i in range(nkernels)]
+
+
+def time_engine(nvis, engine, nthreads=1, nkernels=16, width=16, sort=False, npixel=1024, nchan=4, npol=1):
+    """ Grid nvis random visibilities, returning the time taken and the number of kernel samples gridded
+    """
+    rs = numpy.random.RandomState(2)
+    kernels = make_kernels(nkernels, width)
+    kernel_indices = rs.randint(0, len(kernels), nvis)
+    uvcoords = rs.uniform(-0.2, 0.2, [nvis, 2])
+    if sort:
+        uvcoords = uvcoords[numpy.lexsort((uvcoords[:, 0], uvcoords[:, 1]))]
+    vis = rs.normal(size=[nvis, npol]) + 1j * rs.normal(size=[nvis, npol])
+    visweights = numpy.ones([nvis, npol])
+    frequencymap = rs.randint(0, nchan, nvis)
+    uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+    start = time.time()
+    convolutional_grid((kernel_indices, kernels), uvgrid, vis, visweights, uvcoords, frequencymap, engine=engine,
+                       nthreads=nthreads)
+    elapsed = time.time() - start
+    return elapsed, nvis * npol * width * width
+
+
+if __name__ == '__main__':
+    nvis = int(sys.argv[1]) if len(sys.argv) > 1 else 130816 * 4
+
+    # Compile numba before timing
+    time_engine(1000, 'numba')
+
+    kernel_cases = [('8x8 anti-aliasing kernel', {'nkernels': 1, 'width': 8, 'sort': True}),
+                    ('16x16 w projection kernels', {'nkernels': 16, 'width': 16, 'sort': False})]
+    engine_cases = [('numpy', 1), ('numba', 1), ('numba', 4), ('numba', 16)]
+    for name, kernel_kwargs in kernel_cases:
+        print(name)
+        elapsed, nsamples = time_engine(min(nvis, 5000), 'loop', **kernel_kwargs)
+        loop_rate = nsamples / elapsed
+        print("    loop: %.3g samples/s" % loop_rate)
+        for engine, nthreads in engine_cases:
+            elapsed, nsamples = time_engine(nvis, engine, nthreads=nthreads, **kernel_kwargs)
+            rate = nsamples / elapsed
+            print("    %s, %d threads: %d visibilities in %.2f s, %.3g samples/s, %.1f times loop" %
+                  (engine, nthreads, nvis, elapsed, rate, rate / loop_rate))
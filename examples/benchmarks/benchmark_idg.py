@@ -0,0 +1,87 @@
+""" Benchmark of image domain gridding against w projection and w stacking.
+
+For random arrays of increasing maximum baseline, and so increasing maximum w, a point source is imaged with
+invert_idg, invert_2d with w projection and invert_wstack_native. The time taken and the error relative to a
+direct Fourier transform are printed for each, together with the fastest method at that wmax.
+
+Usage::
+
+    python benchmark_idg.py [npixel]
+
+"""
+import sys
+import time
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord, EarthLocation
+
+from data_models.memory_data_models import Configuration
+from data_models.polarisation import PolarisationFrame
+from libs.util.coordinate_support import xyz_at_latitude
+from processing_components.imaging.base import predict_skycomponent_visibility, invert_2d
+from processing_components.imaging.idg import invert_idg
+from processing_components.imaging.wstack_native import invert_wstack_native
+from processing_components.simulation.testing_support import ingest_unittest_visibility, create_unittest_model, \
+    create_unittest_components
+
+
+def make_vis(rmax, nants=20, npixel=128):
+    """ Visibility of a point source observed by a random array, as in test_imaging_idg
+    """
+    rs = numpy.random.RandomState(1)
+    r = rmax * numpy.sqrt(rs.uniform(0.0, 1.0, nants))
+    theta = rs.uniform(0.0, 2.0 * numpy.pi, nants)
+    xyz = numpy.array([r * numpy.cos(theta), r * numpy.sin(theta), rs.uniform(-5.0, 5.0, nants)]).T
+    location = EarthLocation(lon="116.4999", lat="-26.7000", height=300.0)
+    xyz = xyz_at_latitude(xyz, location.geodetic[1].to(u.rad).value)
+    config = Configuration(location=location, names='S_%d', mount='xy', xyz=xyz, frame='local',
+                           diameter=35.0, name='IDGBENCH')
+    times = numpy.linspace(-3.0, +3.0, 5) * numpy.pi / 12.0
+    phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+    vis = ingest_unittest_visibility(config, numpy.array([1e8]), numpy.array([1e6]), times,
+                                     PolarisationFrame('stokesI'), phasecentre, block=False)
+    model = create_unittest_model(vis, PolarisationFrame('stokesI'), npixel=npixel)
+    components = create_unittest_components(model, numpy.array([[100.0]]))
+    return predict_skycomponent_visibility(vis, components), model
+
+
+def dft_image(vis, model):
+    """ Dirty image by direct Fourier transform, including the w term
+    """
+    npixel = model.shape[3]
+    cdelt = model.wcs.wcs.cdelt * numpy.pi / 180.0
+    l = cdelt[0] * (numpy.arange(npixel) - npixel // 2)
+    m = cdelt[1] * (numpy.arange(npixel) - npixel // 2)
+    l, m = numpy.meshgrid(l, m)
+    n = numpy.sqrt(1.0 - l ** 2 - m ** 2) - 1.0
+    uvw = vis.uvw
+    wt = vis.imaging_weight[:, 0]
+    phasor = numpy.exp(2j * numpy.pi * (uvw[:, 0, None, None] * l + uvw[:, 1, None, None] * m +
+                                        uvw[:, 2, None, None] * n))
+    return numpy.real(numpy.einsum('k,kyx->yx', wt * vis.vis[:, 0], phasor)) / numpy.sum(wt)
+
+
+if __name__ == '__main__':
+    npixel = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+
+    contexts = [('idg', invert_idg, {}),
+                ('wprojection', invert_2d, {'wstep': 10.0, 'oversampling': 4}),
+                ('wstack_native', invert_wstack_native, {'vis_slices': 11})]
+    for rmax in [250.0, 500.0, 1000.0, 2000.0, 4000.0]:
+        vis, model = make_vis(rmax, npixel=npixel)
+        wmax = numpy.max(numpy.abs(vis.w))
+        expected = dft_image(vis, model)
+        times = dict()
+        for name, invert, kwargs in contexts:
+            start = time.time()
+            try:
+                dirty, sumwt = invert(vis, model, **kwargs)
+            except AssertionError as err:
+                print("    %s failed: %s" % (name, err))
+                continue
+            times[name] = time.time() - start
+            error = numpy.max(numpy.abs(dirty.data[0, 0] - expected)) / numpy.max(expected)
+            print("rmax %.0f m, wmax %.1f wavelengths: %s took %.3f s, relative error %.3g" %
+                  (rmax, wmax, name, times[name], error))
+        print("rmax %.0f m, wmax %.1f wavelengths: fastest is %s" % (rmax, wmax, min(times, key=times.get)))
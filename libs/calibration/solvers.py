@@ -21,41 +21,97 @@ from data_models.memory_data_models import GainTable
 log = logging.getLogger(__name__)
 
 
-def solve_from_X(gt: GainTable, x: numpy.ndarray, xwt: numpy.ndarray, chunk, crosspol, niter, phase_only, tol, npol) \
-        -> GainTable:
+def solve_from_X(gt: GainTable, x: numpy.ndarray, xwt: numpy.ndarray, chunk, crosspol, niter, phase_only, tol, npol,
+                 solver='itsubs') -> GainTable:
     """ Solve for gains from the point source equivalents
 
+    Several chunks of the gaintable can be solved at once, in which case x and xwt have a leading axis with one
+    entry for each chunk.
+
     :param gt:
-    :param x: point source visibility
+    :param x: point source visibility [nants, nants, nchan, npol] or [nchunks, nants, nants, nchan, npol]
     :param xwt: point source weight
-    :param chunk: which chunk of the gaintable?
+    :param chunk: which chunk of the gaintable? An integer or an array of chunks
     :param crosspol:
     :param niter:
     :param phase_only:
     :param tol:
     :param npol:
+    :param solver: 'itsubs' (iterative substitution) or 'stefcal' (StefCal, scalar and vector gains only)
     :return:
     """
-    if npol > 1:
-        if crosspol:
-            gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...], gt.data['residual'][chunk, ...] = \
-                solve_antenna_gains_itsubs_matrix(gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...],
-                                                  x, xwt, phase_only=phase_only, niter=niter,
-                                                  tol=tol)
+    if numpy.ndim(chunk) == 0:
+        x = x[numpy.newaxis, ...]
+        xwt = xwt[numpy.newaxis, ...]
+    chunks = numpy.atleast_1d(chunk)
+    
+    if solver == 'stefcal':
+        if npol > 1 and crosspol:
+            raise ValueError("solve_from_X: StefCal cannot solve for cross polarisation gains")
+        solver = solve_antenna_gains_stefcal
+    elif solver == 'itsubs':
+        if npol > 1:
+            if crosspol:
+                solver = solve_antenna_gains_itsubs_matrix
+            else:
+                solver = solve_antenna_gains_itsubs_vector
         else:
-            gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...], gt.data['residual'][chunk, ...] = \
-                solve_antenna_gains_itsubs_vector(gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...],
-                                                  x, xwt, phase_only=phase_only, niter=niter,
-                                                  tol=tol)
-    
+            solver = solve_antenna_gains_itsubs_scalar
     else:
-        gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...], gt.data['residual'][chunk, ...] = \
-            solve_antenna_gains_itsubs_scalar(gt.data['gain'][chunk, ...], gt.data['weight'][chunk, ...],
-                                              x, xwt, phase_only=phase_only, niter=niter,
-                                              tol=tol)
+        raise ValueError("solve_from_X: unknown solver %s" % solver)
+    
+    gt.data['gain'][chunks, ...], gt.data['weight'][chunks, ...], gt.data['residual'][chunks, ...] = \
+        solver(gt.data['gain'][chunks, ...], gt.data['weight'][chunks, ...], x, xwt, phase_only=phase_only,
+               niter=niter, tol=tol)
     return gt
 
 
+def symmetrise_point_source(x, xwt):
+    """ Fill in the point source equivalents for antenna1 < antenna2, and zero the autocorrelations (in place)
+
+    :param x: Equivalent point source visibility [nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
+    """
+    nants = x.shape[1]
+    ant1, ant2 = numpy.triu_indices(nants, 1)
+    x[:, ant1, ant2, ...] = numpy.conjugate(x[:, ant2, ant1, ...])
+    xwt[:, ant1, ant2, ...] = xwt[:, ant2, ant1, ...]
+    ant = numpy.arange(nants)
+    x[:, ant, ant, ...] = 0.0
+    xwt[:, ant, ant, ...] = 0.0
+
+
+def iterate_substitution(update, gain, gwt, x, xwt, niter, tol):
+    """ Iterate the solutions of a batch of solution intervals, each until its own change is below tol
+
+    Once a solution has converged it is left unchanged, and the iterations continue only for the rest.
+
+    :param update: Function of (gain, x, xwt) for part of the batch, returning new gain, gain weight, and change
+    :param gain: gains [nbatch, nants, ...]
+    :param gwt: gain weight [nbatch, nants, ...]
+    :param x: Equivalent point source visibility [nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
+    :param niter: Number of iterations
+    :param tol: tolerance on solution change
+    :return: gain, weight
+    """
+    gain = numpy.array(gain, dtype='complex')
+    gwt = numpy.array(gwt, dtype='float')
+    active = numpy.arange(gain.shape[0])
+    xactive, xwtactive = x, xwt
+    for iter in range(niter):
+        if len(active) == 0:
+            break
+        newgain, newgwt, change = update(gain[active], xactive, xwtactive)
+        gain[active] = newgain
+        gwt[active] = newgwt
+        converged = numpy.max(numpy.abs(change).reshape(len(active), -1), axis=1) < tol
+        if numpy.any(converged):
+            active = active[~converged]
+            xactive, xwtactive = x[active], xwt[active]
+    return gain, gwt
+
+
 def solve_antenna_gains_itsubs_scalar(gain, gwt, x, xwt, niter=30, tol=1e-8, phase_only=True, refant=0):
     """Solve for the antenna gains
 
@@ -64,62 +120,56 @@ def solve_antenna_gains_itsubs_scalar(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     This uses an iterative substitution algorithm due to Larry
     D'Addario c 1980'ish (see ThompsonDaddario1982 Appendix 1). Used
     in the original VLA Dec-10 Antsol.
+    
+    A batch of solution intervals is solved at once, each converging separately.
 
-    :param gain: gains
-    :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param gain: gains [nbatch, nants, ...]
+    :param gwt: gain weight [nbatch, nants, ...]
+    :param x: Equivalent point source visibility[nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
     :param refant: Reference antenna for phase (default=0.0)
-    :return: gain [nants, ...], weight [nants, ...]
+    :return: gain [nbatch, nants, ...], weight [nbatch, nants, ...], residual [nbatch, ...]
 
     """
     
-    nants = x.shape[0]
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    symmetrise_point_source(x, xwt)
     
-    for iter in range(niter):
+    def update(gain, x, xwt):
         gainLast = gain
         gain, gwt = gain_substitution_scalar(gain, x, xwt)
         mask = numpy.abs(gain) > 0.0
         if phase_only:
             gain[mask] = gain[mask] / numpy.abs(gain[mask])
         angles = numpy.angle(gain)
-        gain *= numpy.exp(-1j * angles)[refant, ...]
+        gain *= numpy.exp(-1j * angles)[:, refant, numpy.newaxis, ...]
         gain = 0.5 * (gain + gainLast)
-        change = numpy.max(numpy.abs(gain - gainLast))
-        if change < tol:
-            return gain, gwt, solution_residual_scalar(gain, x, xwt)
+        return gain, gwt, gain - gainLast
     
+    gain, gwt = iterate_substitution(update, gain, gwt, x, xwt, niter, tol)
     return gain, gwt, solution_residual_scalar(gain, x, xwt)
 
 
 def gain_substitution_scalar(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    nbatch, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
     gwt = numpy.zeros_like(gain, dtype='float')
     
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    
-    for ant1 in range(nants):
-        top = numpy.sum(x[:, ant1, :, 0, 0] * gain[:, :, 0, 0] * xwt[:, ant1, :, 0, 0], axis=0)
-        bot = numpy.sum((gain[:, :, 0, 0] * numpy.conjugate(gain[:, :, 0, 0]) *
-                         xwt[:, ant1, :, 0, 0]).real, axis=0)
-        
-        if bot.all() > 0.0:
-            newgain[ant1, :, 0, 0] = top / bot
-            gwt[ant1, :, 0, 0] = bot
-        else:
-            newgain[ant1, :, 0, 0] = 0.0
-            gwt[ant1, :, 0, 0] = 0.0
+    x = x.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., 0, 0]
+    xwt = xwt.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., 0, 0]
+    
+    # Sum over antenna2 for all antenna1 at once
+    g2 = gain[:, :, numpy.newaxis, :, 0, 0]
+    top = numpy.sum(x * g2 * xwt, axis=1)
+    bot = numpy.sum((g2 * numpy.conjugate(g2) * xwt).real, axis=1)
+    
+    # An antenna is only solved if it has weight in all channels
+    solved = numpy.all(bot != 0.0, axis=-1)
+    newgain[..., 0, 0][solved] = top[solved] / bot[solved]
+    newgain[..., 0, 0][~solved] = 0.0
+    gwt[..., 0, 0][solved] = bot[solved]
     return newgain, gwt
 
 
@@ -133,52 +183,51 @@ def solve_antenna_gains_itsubs_vector(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     J. P. Hamaker, “Understanding radio polarimetry - IV. The full-coherency analogue of
     scalar self-calibration: Self-alignment, dynamic range and polarimetric fidelity,” Astronomy
     and Astrophysics Supplement Series, vol. 143, no. 3, pp. 515–534, May 2000.
+    
+    A batch of solution intervals is solved at once, each converging separately.
 
-    :param gain: gains
-    :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param gain: gains [nbatch, nants, ...]
+    :param gwt: gain weight [nbatch, nants, ...]
+    :param x: Equivalent point source visibility[nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
     :param refant: Reference antenna for phase (default=0.0)
-    :return: gain [nants, ...], weight [nants, ...]
+    :return: gain [nbatch, nants, ...], weight [nbatch, nants, ...], residual [nbatch, ...]
     """
     
-    nants, _, nchan, npol = x.shape
+    nbatch, nants, _, nchan, npol = x.shape
     assert npol == 4
-    newshape = (nants, nants, nchan, 2, 2)
+    newshape = (nbatch, nants, nants, nchan, 2, 2)
     x = x.reshape(newshape)
     xwt = xwt.reshape(newshape)
     
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    symmetrise_point_source(x, xwt)
     
+    gain = numpy.array(gain)
     gain[..., 0, 1] = 0.0
     gain[..., 1, 0] = 0.0
     
-    for iter in range(niter):
+    def update(gain, x, xwt):
         gainLast = gain
         gain, gwt = gain_substitution_vector(gain, x, xwt)
         for rec in [0, 1]:
             gain[..., rec, 1 - rec] = 0.0
             if phase_only:
                 gain[..., rec, rec] = gain[..., rec, rec] / numpy.abs(gain[..., rec, rec])
-            gain[..., rec, rec] *= numpy.conjugate(gain[refant, ..., rec, rec]) / numpy.abs(gain[refant, ..., rec, rec])
-        change = numpy.max(numpy.abs(gain - gainLast))
+            refgain = gain[:, refant, numpy.newaxis, ..., rec, rec]
+            gain[..., rec, rec] *= numpy.conjugate(refgain) / numpy.abs(refgain)
+        change = gain - gainLast
         gain = 0.5 * (gain + gainLast)
-        if change < tol:
-            return gain, gwt, solution_residual_vector(gain, x, xwt)
+        return gain, gwt, change
     
+    gain, gwt = iterate_substitution(update, gain, gwt, x, xwt, niter, tol)
     return gain, gwt, solution_residual_vector(gain, x, xwt)
 
 
 def gain_substitution_vector(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    nbatch, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
     if nrec > 0:
         newgain[..., 0, 1] = 0.0
@@ -187,29 +236,21 @@ def gain_substitution_vector(gain, x, xwt):
     gwt = numpy.zeros_like(gain, dtype='float')
     
     # We are going to work with Jones 2x2 matrix formalism so everything has to be
-    # converted to that format
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    
-    if nrec > 0:
-        gain[..., 0, 1] = 0.0
-        gain[..., 1, 0] = 0.0
-    
-    for ant1 in range(nants):
-        for chan in range(nchan):
-            # Loop over e.g. 'RR', 'LL, or 'xx', 'YY' ignoring cross terms
-            for rec in range(nrec):
-                top = numpy.sum(x[:, ant1, chan, rec, rec] *
-                                gain[:, chan, rec, rec] * xwt[:, ant1, chan, rec, rec], axis=0)
-                bot = numpy.sum((gain[:, chan, rec, rec] * numpy.conjugate(gain[:, chan, rec, rec]) *
-                                 xwt[:, ant1, chan, rec, rec]).real, axis=0)
-                
-                if bot > 0.0:
-                    newgain[ant1, chan, rec, rec] = top / bot
-                    gwt[ant1, chan, rec, rec] = bot
-                else:
-                    newgain[ant1, chan, rec, rec] = 0.0
-                    gwt[ant1, chan, rec, rec] = 0.0
+    # converted to that format. Only the diagonal terms e.g. 'RR', 'LL, or 'xx', 'YY' are used.
+    rec = numpy.arange(nrec)
+    x = x.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., rec, rec]
+    xwt = xwt.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., rec, rec]
+    
+    # Sum over antenna2 for all antenna1, channels and receptors at once
+    g2 = gain[:, :, numpy.newaxis, :, rec, rec]
+    top = numpy.sum(x * g2 * xwt, axis=1)
+    bot = numpy.sum((g2 * numpy.conjugate(g2) * xwt).real, axis=1)
+    
+    solved = bot > 0.0
+    diagonal = numpy.zeros_like(top)
+    diagonal[solved] = top[solved] / bot[solved]
+    newgain[..., rec, rec] = diagonal
+    gwt[..., rec, rec] = numpy.where(solved, bot, 0.0)
     
     return newgain, gwt
 
@@ -224,106 +265,95 @@ def solve_antenna_gains_itsubs_matrix(gain, gwt, x, xwt, niter=30, tol=1e-8, pha
     J. P. Hamaker, “Understanding radio polarimetry - IV. The full-coherency analogue of
     scalar self-calibration: Self-alignment, dynamic range and polarimetric fidelity,” Astronomy
     and Astrophysics Supplement Series, vol. 143, no. 3, pp. 515–534, May 2000.
+    
+    A batch of solution intervals is solved at once, each converging separately.
 
-    :param gain: gains
-    :param gwt: gain weight
-    :param x: Equivalent point source visibility[nants, nants, ...]
-    :param xwt: Equivalent point source weight [nants, nants, ...]
+    :param gain: gains [nbatch, nants, ...]
+    :param gwt: gain weight [nbatch, nants, ...]
+    :param x: Equivalent point source visibility[nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
     :param niter: Number of iterations
     :param tol: tolerance on solution change
     :param phase_only: Do solution for only the phase? (default True)
     :param refant: Reference antenna for phase (default=0.0)
-    :return: gain [nants, ...], weight [nants, ...]
+    :return: gain [nbatch, nants, ...], weight [nbatch, nants, ...], residual [nbatch, ...]
     """
     
-    nants, _, nchan, npol = x.shape
+    nbatch, nants, _, nchan, npol = x.shape
     assert npol == 4
-    newshape = (nants, nants, nchan, 2, 2)
+    newshape = (nbatch, nants, nants, nchan, 2, 2)
     x = x.reshape(newshape)
     xwt = xwt.reshape(newshape)
     
-    for ant1 in range(nants):
-        x[ant1, ant1, ...] = 0.0
-        xwt[ant1, ant1, ...] = 0.0
-        for ant2 in range(ant1 + 1, nants):
-            x[ant1, ant2, ...] = numpy.conjugate(x[ant2, ant1, ...])
-            xwt[ant1, ant2, ...] = xwt[ant2, ant1, ...]
+    symmetrise_point_source(x, xwt)
     
+    gain = numpy.array(gain)
     gain[..., 0, 1] = 0.0
     gain[..., 1, 0] = 0.0
     
-    for iter in range(niter):
+    def update(gain, x, xwt):
         gainLast = gain
         gain, gwt = gain_substitution_matrix(gain, x, xwt)
         if phase_only:
             gain = gain / numpy.abs(gain)
-        change = numpy.max(numpy.abs(gain - gainLast))
+        change = gain - gainLast
         gain = 0.5 * (gain + gainLast)
-        if change < tol:
-            return gain, gwt, solution_residual_matrix(gain, x, xwt)
+        return gain, gwt, change
     
+    gain, gwt = iterate_substitution(update, gain, gwt, x, xwt, niter, tol)
     return gain, gwt, solution_residual_matrix(gain, x, xwt)
 
 
 def gain_substitution_matrix(gain, x, xwt):
-    nants, nchan, nrec, _ = gain.shape
+    nbatch, nants, nchan, nrec, _ = gain.shape
     newgain = numpy.ones_like(gain, dtype='complex')
-    gwt = numpy.zeros_like(gain, dtype='float')
     
     # We are going to work with Jones 2x2 matrix formalism so everything has to be
     # converted to that format
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
+    x = x.reshape(nbatch, nants, nants, nchan, nrec, nrec)
+    xwt = xwt.reshape(nbatch, nants, nants, nchan, nrec, nrec)
     
-    # Write these loops out explicitly. Derivation of these vector equations is tedious but they are
-    # structurally identical to the scalar case with the following changes
+    # The derivation of these vector equations is tedious but they are structurally identical to the scalar
+    # case with the following changes
     # Vis -> 2x2 coherency vector, g-> 2x2 Jones matrix, *-> matmul, conjugate->Hermitean transpose (.H)
-    for ant1 in range(nants):
-        for chan in range(nchan):
-            top = 0.0
-            bot = 0.0
-            for ant2 in range(nants):
-                if ant1 != ant2:
-                    xmat = x[ant2, ant1, chan]
-                    xwtmat = xwt[ant2, ant1, chan]
-                    g2 = gain[ant2, chan]
-                    top += xmat * xwtmat * g2
-                    bot += numpy.conjugate(g2) * xwtmat * g2
-            newgain[ant1, chan][bot > 0.0] = top[bot > 0.0] / bot[bot > 0.0]
-            newgain[ant1, chan][bot <= 0.0] = 0.0
-            gwt[ant1, chan] = bot.real
+    # The sums over antenna2 leave out antenna2 == antenna1.
+    g2 = gain[:, :, numpy.newaxis, ...]
+    ant = numpy.arange(nants)
+    top = x * xwt * g2
+    top[:, ant, ant, ...] = 0.0
+    top = numpy.sum(top, axis=1)
+    bot = numpy.conjugate(g2) * xwt * g2
+    bot[:, ant, ant, ...] = 0.0
+    bot = numpy.sum(bot, axis=1)
+    
+    newgain[bot > 0.0] = top[bot > 0.0] / bot[bot > 0.0]
+    newgain[bot <= 0.0] = 0.0
+    gwt = bot.real
     return newgain, gwt
 
 
 def solution_residual_scalar(gain, x, xwt):
     """Calculate residual across all baselines of gain for point source equivalent visibilities
     
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [nbatch, nant, ...]
+    :param x: Point source equivalent visibility [nbatch, nant, ...]
+    :param xwt: Point source equivalent weight [nbatch, nant, ...]
+    :return: residual[nbatch, ...]
     """
     
-    nants, nchan, nrec, _ = gain.shape
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
+    nbatch, nants, nchan, nrec, _ = gain.shape
+    x = x.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., 0, 0]
+    xwt = xwt.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., 0, 0]
     
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
-    
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                error = x[ant2, ant1, chan, 0, 0] - \
-                    gain[ant1, chan, 0, 0] * numpy.conjugate(gain[ant2, chan, 0, 0])
-                residual += (error * xwt[ant2, ant1, chan, 0, 0] * numpy.conjugate(error)).real
-                sumwt += xwt[ant2, ant1, chan, 0, 0]
+    # x[antenna2, antenna1] - gain[antenna1] conj(gain[antenna2]), summed over all baselines and channels
+    error = x - gain[:, numpy.newaxis, :, :, 0, 0] * numpy.conjugate(gain[:, :, numpy.newaxis, :, 0, 0])
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2, 3))
+    sumwt = numpy.sum(xwt, axis=(1, 2, 3))
     
     residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
     residual[sumwt <= 0.0] = 0.0
     
-    return residual
+    return numpy.tile(residual[:, numpy.newaxis, numpy.newaxis, numpy.newaxis], [1, nchan, nrec, nrec])
 
 
 def solution_residual_vector(gain, x, xwt):
@@ -331,66 +361,124 @@ def solution_residual_vector(gain, x, xwt):
     
     Vector case i.e. off-diagonals of gains are zero
 
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [nbatch, nant, ...]
+    :param x: Point source equivalent visibility [nbatch, nant, ...]
+    :param xwt: Point source equivalent weight [nbatch, nant, ...]
+    :return: residual[nbatch, ...]
     """
     
-    nants, nchan, nrec, _ = gain.shape
-    x = x.reshape(nants, nants, nchan, nrec, nrec)
-    x[..., 1, 0] = 0.0
-    x[..., 0, 1] = 0.0
-    
-    xwt = xwt.reshape(nants, nants, nchan, nrec, nrec)
-    xwt[..., 1, 0] = 0.0
-    xwt[..., 0, 1] = 0.0
+    nbatch, nants, nchan, nrec, _ = gain.shape
+    rec = numpy.arange(nrec)
+    x = x.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., rec, rec]
+    xwt = xwt.reshape(nbatch, nants, nants, nchan, nrec, nrec)[..., rec, rec]
     
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
-    
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                for rec in range(nrec):
-                    error = x[ant2, ant1, chan, rec, rec] - \
-                        gain[ant1, chan, rec, rec] * numpy.conjugate(gain[ant2, chan, rec, rec])
-                    residual += (error * xwt[ant2, ant1, chan, rec, rec] * numpy.conjugate(error)).real
-                    sumwt += xwt[ant2, ant1, chan, rec, rec]
+    # Summed over all baselines, channels and receptors
+    error = x - gain[:, numpy.newaxis, :, :, rec, rec] * numpy.conjugate(gain[:, :, numpy.newaxis, :, rec, rec])
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2, 3, 4))
+    sumwt = numpy.sum(xwt, axis=(1, 2, 3, 4))
     
     residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
     residual[sumwt <= 0.0] = 0.0
     
-    return residual
+    return numpy.tile(residual[:, numpy.newaxis, numpy.newaxis, numpy.newaxis], [1, nchan, nrec, nrec])
 
 
 def solution_residual_matrix(gain, x, xwt):
     """Calculate residual across all baselines of gain for point source equivalent visibilities
 
-    :param gain: gain [nant, ...]
-    :param x: Point source equivalent visibility [nant, ...]
-    :param xwt: Point source equivalent weight [nant, ...]
-    :return: residual[...]
+    :param gain: gain [nbatch, nant, ...]
+    :param x: Point source equivalent visibility [nbatch, nant, ...]
+    :param xwt: Point source equivalent weight [nbatch, nant, ...]
+    :return: residual[nbatch, ...]
     """
     
-    nants, _, nchan, nrec, _ = x.shape
-    
-    residual = numpy.zeros([nchan, nrec, nrec])
-    sumwt = numpy.zeros([nchan, nrec, nrec])
+    nbatch, nants, _, nchan, nrec, _ = x.shape
     
-    # This is written out in long winded form but should be optimised for
-    # production code!
-    for ant1 in range(nants):
-        for ant2 in range(nants):
-            for chan in range(nchan):
-                for rec1 in range(nrec):
-                    for rec2 in range(nrec):
-                        error = x[ant2, ant1, chan, rec2, rec1] - \
-                            gain[ant1, chan, rec2, rec1] * numpy.conjugate(gain[ant2, chan, rec2, rec1])
-                        residual[chan, rec2, rec1] += (error * xwt[ant2, ant1, chan, rec2, rec1] * numpy.conjugate(
-                            error)).real
-                        sumwt[chan, rec2, rec1] += xwt[ant2, ant1, chan, rec2, rec1]
+    # Summed over all baselines, separately for each channel and receptor pair
+    error = x - gain[:, numpy.newaxis, ...] * numpy.conjugate(gain[:, :, numpy.newaxis, ...])
+    residual = numpy.sum((error * xwt * numpy.conjugate(error)).real, axis=(1, 2))
+    sumwt = numpy.sum(xwt, axis=(1, 2))
     
     residual[sumwt > 0.0] = numpy.sqrt(residual[sumwt > 0.0] / sumwt[sumwt > 0.0])
     residual[sumwt <= 0.0] = 0.0
     return residual
+
+
+def solve_antenna_gains_stefcal(gain, gwt, x, xwt, niter=30, tol=1e-8, phase_only=True, refant=0):
+    """Solve for the antenna gains using StefCal
+
+    x(antenna2, antenna1) = gain(antenna1) conj(gain(antenna2))
+
+    StefCal solves for the gain of each antenna by linear least squares, given the current gains of all the other
+    antennas, and every second update is averaged with the previous one to accelerate convergence. See:
+
+    S. Salvini and S. J. Wijnholds, “Fast gain calibration in radio astronomy using alternating direction
+    implicit methods: Analysis and applications,” Astronomy and Astrophysics, vol. 571, A97, 2014.
+
+    Only the diagonal (scalar or vector) gains are solved for. Each receptor and channel of each solution interval
+    is solved separately, and stops when the relative change of its gains is below tol.
+
+    :param gain: gains [nbatch, nants, ...]
+    :param gwt: gain weight [nbatch, nants, ...]
+    :param x: Equivalent point source visibility[nbatch, nants, nants, ...]
+    :param xwt: Equivalent point source weight [nbatch, nants, nants, ...]
+    :param niter: Number of iterations
+    :param tol: tolerance on the relative change of the gains
+    :param phase_only: Do solution for only the phase? (default True)
+    :param refant: Reference antenna for phase (default=0.0)
+    :return: gain [nbatch, nants, ...], weight [nbatch, nants, ...], residual [nbatch, ...]
+    """
+    
+    nbatch, nants, nchan, nrec, _ = gain.shape
+    newshape = (nbatch, nants, nants, nchan, nrec, nrec)
+    x = x.reshape(newshape)
+    xwt = xwt.reshape(newshape)
+    
+    symmetrise_point_source(x, xwt)
+    
+    # One problem for each solution interval, channel and receptor, with the antennas on the last axes:
+    # xw[problem, antenna1, antenna2] and g[problem, antenna]
+    rec = numpy.arange(nrec)
+    axes = (0, 3, 4, 2, 1)
+    xw = numpy.transpose(x[..., rec, rec] * xwt[..., rec, rec], axes).reshape(-1, nants, nants)
+    w = numpy.transpose(xwt[..., rec, rec], axes).reshape(-1, nants, nants)
+    g = numpy.transpose(gain[..., rec, rec], (0, 2, 3, 1)).reshape(-1, nants).astype('complex')
+    gw = numpy.zeros(g.shape)
+    
+    active = numpy.arange(g.shape[0])
+    xwactive, wactive = xw, w
+    for iter in range(niter):
+        if len(active) == 0:
+            break
+        gainLast = g[active]
+        top = numpy.matmul(xwactive, gainLast[..., numpy.newaxis])[..., 0]
+        bot = numpy.matmul(wactive, numpy.abs(gainLast[..., numpy.newaxis]) ** 2)[..., 0]
+        solved = bot > 0.0
+        newgain = numpy.zeros_like(top)
+        newgain[solved] = top[solved] / bot[solved]
+        if iter % 2 == 1:
+            newgain = 0.5 * (newgain + gainLast)
+        if phase_only:
+            mask = numpy.abs(newgain) > 0.0
+            newgain[mask] = newgain[mask] / numpy.abs(newgain[mask])
+        g[active] = newgain
+        gw[active] = numpy.where(solved, bot, 0.0)
+        converged = numpy.linalg.norm(newgain - gainLast, axis=1) <= tol * numpy.linalg.norm(newgain, axis=1)
+        if numpy.any(converged):
+            active = active[~converged]
+            xwactive, wactive = xw[active], w[active]
+    
+    # The solution is only determined up to a phase, so make the phase of the reference antenna zero
+    refgain = g[:, refant]
+    mask = numpy.abs(refgain) > 0.0
+    g[mask] *= (numpy.conjugate(refgain[mask]) / numpy.abs(refgain[mask]))[:, numpy.newaxis]
+    
+    newgain = numpy.zeros_like(gain, dtype='complex')
+    newgain[..., rec, rec] = numpy.transpose(g.reshape(nbatch, nchan, nrec, nants), (0, 3, 1, 2))
+    newgwt = numpy.zeros_like(gain, dtype='float')
+    newgwt[..., rec, rec] = numpy.transpose(gw.reshape(nbatch, nchan, nrec, nants), (0, 3, 1, 2))
+    
+    if nrec > 1:
+        return newgain, newgwt, solution_residual_vector(newgain, x, xwt)
+    else:
+        return newgain, newgwt, solution_residual_scalar(newgain, x, xwt)
@@ -9,9 +9,15 @@ This module contains functions for performing the gridding process and the inver
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 log = logging.getLogger(__name__)
 
 
@@ -203,26 +209,23 @@ def frac_coord(npixel, kernel_oversampling, p):
     return flx.astype(int), fracx.astype(int)
 
 
-def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
-    """Convolutional degridding with frequency and polarisation independent
+def grid_coordinates(kernel_list, ny, nx, vuvwmap, vfrequencymap):
+    """ Calculate the grid coordinates of the visibilities as needed by convolutional_grid and convolutional_degrid
 
-    Takes into account fractional `uv` coordinate values where the GCF
-    is oversampled
+    These depend only on the uvw, frequencies, grid geometry and kernels and so may be calculated once and reused
+    (see libs.imaging.gridding_plan).
 
-    :param kernel_list: list of oversampled convolution kernel
-    :param vshape: Shape of visibility
-    :param uvgrid:   The uv plane to de-grid from
-    :param vuvwmap: function to map uvw to grid fractions
-    :param vfrequencymap: function to map frequency to image channels
-    :return: Array of visibilities.
+    :param kernel_list: List of oversampled convolution kernels
+    :param ny: Number of pixels in the v axis of the grid
+    :param nx: Number of pixels in the u axis of the grid
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: chan, kernel_indices, x, y, xf, yf (integer arrays, one value per visibility)
     """
     kernel_indices, kernels = kernel_list
     kernel_oversampling, _, gh, gw = kernels[0].shape
     assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
     assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
-    inchan, inpol, ny, nx = uvgrid.shape
-    vnpol = vshape[1]
-    vis = numpy.zeros(vshape, dtype='complex')
     
     # uvw -> fraction of grid mapping
     y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
@@ -230,123 +233,493 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
     x -= gw // 2
     
+    nvis = len(x)
+    chan = numpy.array(vfrequencymap, dtype='int')
     if len(kernels) > 1:
-        coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
-        ckernels = numpy.conjugate(kernels)
+        kernel_indices = numpy.array(kernel_indices, dtype='int')
+    else:
+        kernel_indices = numpy.zeros([nvis], dtype='int')
+    return chan, kernel_indices, x, y, xf, yf
+
+
+def gridding_engine(engine='auto'):
+    """ Resolve the name of the engine used for convolutional gridding and degridding
+
+    The loop and numpy engines give identical results. The compiled numba engine may round complex products and
+    sums differently, and so agrees with them only to rounding error. It is therefore used only if asked for:
+
+        - 'loop': The reference implementation, looping over visibilities in Python
+        - 'numpy': Blocks of visibilities are processed using array operations
+        - 'numba': The gridding loops are compiled using numba (if installed)
+        - 'auto': numpy, which gives the same results as loop
+
+    :param engine: 'auto' | 'loop' | 'numpy' | 'numba'
+    :return: name of engine to be used
+    """
+    if engine == 'auto':
+        return 'numpy'
+    elif engine == 'numba' and numba is None:
+        log.warning("gridding_engine: numba is not installed, using numpy engine instead")
+        return 'numpy'
+    assert engine in ['loop', 'numpy', 'numba'], "Unknown gridding engine %s" % engine
+    return engine
+
+
+def jit(func):
+    """ Compile a function with numba, releasing the GIL, or return None if numba is not installed
+    
+    :param func: Function to compile
+    :return: compiled function or None
+    """
+    if numba is None:
+        return None
+    return numba.njit(nogil=True, cache=True)(func)
+
+
+def degrid_loop(uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf):
+    """ Reference degridding loop, one visibility at a time
+
+    :param uvgrid: Grid to degrid from [nchan, npol, ny, nx]
+    :param vis: Visibility values to be filled in [nvis, npol]
+    :param ckernels: Conjugated kernels [nkernels, oversampling, oversampling, gh, gw]
+    :param kernel_indices: Kernel used for each visibility [nvis]
+    :param chan: Image channel of each visibility [nvis]
+    :param x: Integer x coordinate of bottom left of kernel on grid [nvis]
+    :param y: Integer y coordinate of bottom left of kernel on grid [nvis]
+    :param xf: Fractional x coordinate (index into oversampled kernel) [nvis]
+    :param yf: Fractional y coordinate (index into oversampled kernel) [nvis]
+    """
+    _, _, _, gh, gw = ckernels.shape
+    vnpol = vis.shape[-1]
+    if len(ckernels) > 1:
+        coords = kernel_indices, chan, x, y, xf, yf
         for pol in range(vnpol):
             vis[..., pol] = [
-                numpy.sum(uvgrid[chan, pol, yy: yy + gh, xx:xx + gw] * ckernels[kind][yyf, xxf, :, :])
-                for kind, chan, xx, yy, xxf, yyf in zip(*coords)
+                numpy.sum(uvgrid[ch, pol, yy: yy + gh, xx:xx + gw] * ckernels[kind, yyf, xxf, :, :])
+                for kind, ch, xx, yy, xxf, yyf in zip(*coords)
             ]
     else:
         # This is the usual case. We trim a bit of time by avoiding the kernel lookup
-        coords = list(vfrequencymap), x, y, xf, yf
-        ckernel0 = numpy.conjugate(kernels[0])
+        coords = chan, x, y, xf, yf
+        ckernel0 = ckernels[0]
         for pol in range(vnpol):
             vis[..., pol] = [
-                numpy.sum(uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] * ckernel0[yyf, xxf, :, :])
-                for chan, xx, yy, xxf, yyf in zip(*coords)
+                numpy.sum(uvgrid[ch, pol, yy: yy + gh, xx: xx + gw] * ckernel0[yyf, xxf, :, :])
+                for ch, xx, yy, xxf, yyf in zip(*coords)
             ]
-            
-    return numpy.array(vis)
 
 
-def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
+def degrid_numpy(uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf, chunksize=2 ** 22):
+    """ Degridding of blocks of visibilities using array operations
+
+    For a block of visibilities, the kernel-sized subgrids for all polarisations are gathered from the grid and
+    contracted against the kernels in one operation.
+
+    :param chunksize: Maximum number of grid samples gathered in one block
+    See degrid_loop for the other parameters
+    """
+    _, _, _, gh, gw = ckernels.shape
+    nvis, vnpol = vis.shape
+    pols = numpy.arange(vnpol)[numpy.newaxis, :, numpy.newaxis, numpy.newaxis]
+    dy = numpy.arange(gh)[numpy.newaxis, numpy.newaxis, :, numpy.newaxis]
+    dx = numpy.arange(gw)[numpy.newaxis, numpy.newaxis, numpy.newaxis, :]
+    step = max(1, chunksize // (vnpol * gh * gw))
+    for start in range(0, nvis, step):
+        rows = slice(start, start + step)
+        nrows = len(x[rows])
+        subgrids = uvgrid[chan[rows, numpy.newaxis, numpy.newaxis, numpy.newaxis], pols,
+                          y[rows, numpy.newaxis, numpy.newaxis, numpy.newaxis] + dy,
+                          x[rows, numpy.newaxis, numpy.newaxis, numpy.newaxis] + dx]
+        ckernel = ckernels[kernel_indices[rows], yf[rows], xf[rows]][:, numpy.newaxis, ...]
+        vis[rows] = numpy.sum((subgrids * ckernel).reshape([nrows, vnpol, gh * gw]), axis=-1)
+
+
+def degrid_numba(uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf):
+    """ Degridding loop suitable for compilation by numba. See degrid_loop for parameters
+    """
+    nvis, vnpol = vis.shape
+    gh = ckernels.shape[3]
+    gw = ckernels.shape[4]
+    for i in range(nvis):
+        ckernel = ckernels[kernel_indices[i], yf[i], xf[i]]
+        for pol in range(vnpol):
+            total = 0.0j
+            for dy in range(gh):
+                for dx in range(gw):
+                    total += uvgrid[chan[i], pol, y[i] + dy, x[i] + dx] * ckernel[dy, dx]
+            vis[i, pol] = total
+
+
+degrid_numba_compiled = jit(degrid_numba)
+
+
+def degrid_threads(degrid_function, uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf, nthreads=1):
+    """ Degrid in parallel, each thread filling in a contiguous block of visibilities
+
+    The grid is only read so the threads never interfere, and each visibility is computed exactly as in the serial
+    case. Only the numba engine releases the GIL, so the threads run concurrently only with that engine. With the
+    loop and numpy engines they take turns and the degridding is little faster than with one thread.
+
+    :param degrid_function: Degridding engine function e.g. degrid_numba_compiled
+    :param nthreads: Number of threads
+    See degrid_loop for the other parameters
+    """
+    edges = numpy.linspace(0, len(x), nthreads + 1).astype('int')
+    
+    def degrid_block(start, end):
+        rows = slice(start, end)
+        degrid_function(uvgrid, vis[rows], ckernels, kernel_indices[rows], chan[rows], x[rows], y[rows], xf[rows],
+                        yf[rows])
+    
+    with ThreadPoolExecutor(nthreads) as pool:
+        list(pool.map(degrid_block, edges[:-1], edges[1:]))
+
+
+def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap, engine='auto', nthreads=1,
+                         grid_coords=None):
+    """Convolutional degridding with frequency and polarisation independent
+
+    Takes into account fractional `uv` coordinate values where the GCF
+    is oversampled
+
+    The degridding engine is selected by name (see gridding_engine). The loop and numpy engines give identical
+    results, the numba engine sums in a different order and so agrees to rounding error. The results do not depend
+    on the number of threads. The calculation is done in the precision of uvgrid (complex128 or complex64).
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param engine: Degridding engine 'auto' | 'loop' | 'numpy' | 'numba'
+    :param nthreads: Number of threads used for degridding (only faster with the numba engine)
+    :param grid_coords: Precalculated output of grid_coordinates (optional)
+    :return: Array of visibilities.
+    """
+    _, kernels = kernel_list
+    inchan, inpol, ny, nx = uvgrid.shape
+    # The precision of the calculation is set by the grid (complex128 or complex64)
+    vis = numpy.zeros(vshape, dtype=uvgrid.dtype)
+    
+    if grid_coords is None:
+        grid_coords = grid_coordinates(kernel_list, ny, nx, vuvwmap, vfrequencymap)
+    chan, kernel_indices, x, y, xf, yf = grid_coords
+    nvis = len(x)
+    ckernels = numpy.conjugate(kernels).astype(uvgrid.dtype, copy=False)
+    
+    engine = gridding_engine(engine)
+    degrid_function = {'numba': degrid_numba_compiled, 'numpy': degrid_numpy, 'loop': degrid_loop}[engine]
+    if engine != 'loop':
+        vis = vis.reshape([nvis, -1])
+    if nthreads > 1:
+        degrid_threads(degrid_function, uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf, nthreads=nthreads)
+    else:
+        degrid_function(uvgrid, vis, ckernels, kernel_indices, chan, x, y, xf, yf)
+    vis = vis.reshape(vshape)
+    
+    return vis
+
+
+def accumulate_in_order(grid, index, values):
+    """ Add values into a flat grid, in the order given, so that the result is identical to summing sequentially
+
+    numpy.bincount adds its weights one by one in the order given. Seeding the sum with the current values of the
+    grid therefore reproduces exactly the result of adding the values one at a time into the grid.
+
+    :param grid: One dimensional (float or complex) array to be added to in place
+    :param index: Indices into grid
+    :param values: Values to be added
+    """
+    lo = numpy.min(index)
+    hi = numpy.max(index) + 1
+    if hi - lo > 16 * len(index):
+        # Sparse update: compress the indices so that the work scales with the number of values not the grid size
+        cells, cindex = numpy.unique(index, return_inverse=True)
+        seed = grid[cells]
+    else:
+        cells = slice(lo, hi)
+        cindex = index - lo
+        seed = grid[lo:hi]
+    ncells = len(seed)
+    allindex = numpy.concatenate([numpy.arange(ncells), cindex])
+    if numpy.iscomplexobj(grid):
+        grid[cells] = numpy.bincount(allindex, numpy.concatenate([seed.real, values.real]), ncells) + \
+                      1j * numpy.bincount(allindex, numpy.concatenate([seed.imag, values.imag]), ncells)
+    else:
+        grid[cells] = numpy.bincount(allindex, numpy.concatenate([seed, values]), ncells)
+
+
+def grid_loop(uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf):
+    """ Reference gridding loop, one visibility at a time
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param sumwt: Sum of weights to add to [nchan, npol]
+    :param viswt: Weighted visibility values [nvis, npol]
+    :param wts: Visibility weights [nvis, npol]
+    :param kernels: Kernels [nkernels, oversampling, oversampling, gh, gw]
+    :param kernel_indices: Kernel used for each visibility [nvis]
+    :param chan: Image channel of each visibility [nvis]
+    :param x: Integer x coordinate of bottom left of kernel on grid [nvis]
+    :param y: Integer y coordinate of bottom left of kernel on grid [nvis]
+    :param xf: Fractional x coordinate (index into oversampled kernel) [nvis]
+    :param yf: Fractional y coordinate (index into oversampled kernel) [nvis]
+    """
+    _, _, _, gh, gw = kernels.shape
+    npol = viswt.shape[-1]
+    if len(kernels) > 1:
+        coords = kernel_indices, chan, x, y, xf, yf
+        for pol in range(npol):
+            for v, vwt, kind, ch, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
+                uvgrid[ch, pol, yy: yy + gh, xx: xx + gw] += kernels[kind, yyf, xxf, :, :] * v
+                sumwt[ch, pol] += vwt
+    else:
+        kernel0 = kernels[0]
+        coords = chan, x, y, xf, yf
+        for pol in range(npol):
+            for v, vwt, ch, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
+                uvgrid[ch, pol, yy: yy + gh, xx: xx + gw] += kernel0[yyf, xxf, :, :] * v
+                sumwt[ch, pol] += vwt
+
+
+def grid_numpy(uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf, chunksize=2 ** 22):
+    """ Gridding of blocks of visibilities using array operations
+
+    The kernel values for a block of visibilities are gathered and multiplied by the visibilities in one
+    operation, and then accumulated onto the grid using numpy.bincount. The sums are formed in the same order
+    as in grid_loop so the results are identical.
+
+    :param chunksize: Maximum number of kernel samples processed in one block
+    See grid_loop for the other parameters
+    """
+    _, _, _, gh, gw = kernels.shape
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis, npol = viswt.shape
+    flatgrid = uvgrid.reshape([-1])
+    assert numpy.shares_memory(flatgrid, uvgrid), "Grid must be contiguous"
+    koffset = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).reshape([-1])
+    step = max(1, chunksize // (gh * gw))
+    for start in range(0, nvis, step):
+        rows = slice(start, start + step)
+        ckernels = kernels[kernel_indices[rows], yf[rows], xf[rows]].reshape([-1, gh * gw])
+        for pol in range(npol):
+            corner = ((chan[rows] * inpol + pol) * ny + y[rows]) * nx + x[rows]
+            index = (corner[:, numpy.newaxis] + koffset[numpy.newaxis, :]).reshape([-1])
+            accumulate_in_order(flatgrid, index, (ckernels * viswt[rows, pol, numpy.newaxis]).reshape([-1]))
+            accumulate_in_order(sumwt[:, pol], chan[rows], wts[rows, pol])
+
+
+def grid_numba(uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf):
+    """ Gridding loop suitable for compilation by numba. See grid_loop for parameters
+
+    The compiled complex products may be rounded differently (e.g. by fused multiply-add) so the grid agrees with
+    grid_loop to rounding error rather than exactly.
+    """
+    nvis, npol = viswt.shape
+    gh = kernels.shape[3]
+    gw = kernels.shape[4]
+    for pol in range(npol):
+        for i in range(nvis):
+            v = viswt[i, pol]
+            kernel = kernels[kernel_indices[i], yf[i], xf[i]]
+            plane = uvgrid[chan[i], pol]
+            # Taking views of the rows outside the inner loop avoids indexing the 4D grid for every sample
+            for dy in range(gh):
+                row = plane[y[i] + dy, x[i]:x[i] + gw]
+                krow = kernel[dy]
+                for dx in range(gw):
+                    row[dx] += krow[dx] * v
+            sumwt[chan[i], pol] += wts[i, pol]
+
+
+grid_numba_compiled = jit(grid_numba)
+
+
+def grid_tiles(grid_function, uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf, nthreads=1):
+    """ Grid in parallel, using threads that each own a strip of rows of the grid
+
+    The grid is divided into strips holding roughly equal numbers of visibilities. Each strip is gridded by one
+    thread into a private subgrid that is seeded with the current values of the strip and has a margin of one
+    kernel width on either side. All visibilities whose kernels touch the strip are gridded, in their original
+    order, and then the strip (but not the margins) is copied back. Every grid cell therefore receives exactly the
+    same sequence of additions as in serial gridding so the result does not depend on the number of threads.
+
+    Only the numba engine releases the GIL, so the threads run concurrently only with that engine. With the loop
+    and numpy engines they take turns, and the extra work for the margins can make gridding slower than with one
+    thread.
+
+    :param grid_function: Gridding engine function e.g. grid_numba_compiled
+    :param nthreads: Number of threads
+    See grid_loop for the other parameters
+    """
+    _, _, _, gh, _ = kernels.shape
+    inchan, inpol, ny, nx = uvgrid.shape
+    
+    # Use a few strips per thread to balance the load
+    nstrips = 4 * nthreads
+    edges = numpy.quantile(y + gh // 2, numpy.linspace(0.0, 1.0, nstrips + 1)).astype('int')
+    edges[0] = 0
+    edges[-1] = ny
+    edges = numpy.unique(edges)
+    
+    def grid_strip(y0, y1):
+        rows = numpy.nonzero((y < y1) & (y + gh > y0))[0]
+        if len(rows) == 0:
+            return
+        subgrid = numpy.zeros([inchan, inpol, y1 - y0 + 2 * gh, nx], dtype=uvgrid.dtype)
+        subgrid[:, :, gh:gh + y1 - y0] = uvgrid[:, :, y0:y1]
+        grid_function(subgrid, numpy.zeros_like(sumwt), viswt[rows], wts[rows], kernels, kernel_indices[rows],
+                      chan[rows], x[rows], y[rows] - y0 + gh, xf[rows], yf[rows])
+        uvgrid[:, :, y0:y1] = subgrid[:, :, gh:gh + y1 - y0]
+    
+    with ThreadPoolExecutor(nthreads) as pool:
+        list(pool.map(grid_strip, edges[:-1], edges[1:]))
+    
+    for pol in range(viswt.shape[-1]):
+        accumulate_in_order(sumwt[:, pol], chan, wts[:, pol])
+
+
+def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, engine='auto', nthreads=1,
+                       grid_coords=None):
     """Grid after convolving with frequency and polarisation independent gcf
 
     Takes into account fractional `uv` coordinate values where the GCF is oversampled
 
+    The gridding engine is selected by name (see gridding_engine). The loop and numpy engines give identical grids
+    and sums of weights, the numba engine agrees to rounding error. If more than one thread is used, the grid is
+    divided into strips owned by separate threads (see grid_tiles). For a given engine the result does not depend
+    on the number of threads. The calculation is done in the precision of uvgrid (complex128 or complex64).
+
     :param kernel_list: List of oversampled convolution kernels
     :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
     :param vis: Visibility values
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
+    :param engine: Gridding engine 'auto' | 'loop' | 'numpy' | 'numba'
+    :param nthreads: Number of threads used for gridding (only faster with the numba engine)
+    :param grid_coords: Precalculated output of grid_coordinates (optional)
     :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
     """
     
-    kernel_indices, kernels = kernel_list
-    kernel_oversampling, _, gh, gw = kernels[0].shape
-    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
-    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    _, kernels = kernel_list
     inchan, inpol, ny, nx = uvgrid.shape
     
     # Construct output grids (in uv space)
     sumwt = numpy.zeros([inchan, inpol])
     
-    # uvw -> fraction of grid mapping
-    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
-    y -= gh // 2
-    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
-    x -= gw // 2
-    
-    # About 228k samples per second for standard kernel so about 10 million CMACs per second
+    if grid_coords is None:
+        grid_coords = grid_coordinates(kernel_list, ny, nx, vuvwmap, vfrequencymap)
+    chan, kernel_indices, x, y, xf, yf = grid_coords
     
-    # Now we can loop over all rows
-    wts = visweights[...]
-    viswt = vis[...] * visweights[...]
+    # For the 8 by 8 anti-aliasing kernel, the loop engine manages about 2 million kernel samples (CMACs) per
+    # second, the numpy engine about three times that, and the numba engine about 50 times that on one thread.
+    # For wider w projection kernels the loop engine does better and the gains are smaller (see
+    # examples/benchmarks/benchmark_gridding.py).
+    nvis = len(x)
     npol = vis.shape[-1]
-
-    if len(kernels) > 1:
-        coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
-        for pol in range(npol):
-            for v, vwt, kind, chan, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
-                uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] += kernels[kind][yyf, xxf, :, :] * v
-                sumwt[chan, pol] += vwt
+    # The Visibility columns are big-endian so we convert to native byte order as needed by numba
+    wts = visweights[...].reshape([nvis, npol]).astype(visweights.dtype.newbyteorder('='))
+    # The precision of the calculation is set by the grid (complex128 or complex64)
+    viswt = (vis[...] * visweights[...]).reshape([nvis, npol]).astype(uvgrid.dtype, copy=False)
+    kernels = numpy.array(kernels, dtype=uvgrid.dtype)
+    
+    engine = gridding_engine(engine)
+    grid_function = {'numba': grid_numba_compiled, 'numpy': grid_numpy, 'loop': grid_loop}[engine]
+    if nthreads > 1:
+        grid_tiles(grid_function, uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf,
+                   nthreads=nthreads)
     else:
-        kernel0 = kernels[0]
-        coords = list(vfrequencymap), x, y, xf, yf
-        for pol in range(npol):
-            for v, vwt, chan, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
-                uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] += kernel0[yyf, xxf, :, :] * v
-                sumwt[chan, pol] += vwt
+        grid_function(uvgrid, sumwt, viswt, wts, kernels, kernel_indices, chan, x, y, xf, yf)
 
     return uvgrid, sumwt
 
 
-def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform'):
+def box_sum(grid, box=3):
+    """ Sum over a square box centred on each pixel of the last two axes of a grid (zero outside the grid)
+
+    :param grid: Grid [..., ny, nx]
+    :param box: Full width of box in pixels (odd)
+    :return: Grid of box sums
+    """
+    assert box % 2 == 1, "Box width must be odd"
+    half = box // 2
+    pad = [(0, 0)] * (grid.ndim - 2) + [(half + 1, half), (half + 1, half)]
+    csum = numpy.pad(grid, pad).cumsum(axis=-2).cumsum(axis=-1)
+    return csum[..., box:, box:] - csum[..., :-box, box:] - csum[..., box:, :-box] + csum[..., :-box, :-box]
+
+
+def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform',
+                    robustness=0.0, superuniform_box=3):
     """Reweight data using one of a number of algorithms
 
-    :param shape:
+    The weights are accumulated onto a density grid (including the Hermitian conjugate points) using
+    numpy.bincount, so the cost is dominated by a few passes over the visibilities.
+
+        - natural: The visibility weights are unchanged
+        - uniform: Each weight is divided by the sum of weights in its grid cell
+        - super-uniform: As uniform, but the sum of weights is over a box of superuniform_box cells
+        - briggs: Briggs robust weighting between uniform (robustness -2) and natural (robustness 2)
+        - super-briggs: As briggs, but the sum of weights is over a box of superuniform_box cells
+
+    :param shape: Shape of image [nchan, npol, ny, nx]
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
     :param vpolarisationmap: map polarisation to image polarisation
-    :param weighting: '' | 'uniform'
+    :param weighting: 'natural' | 'uniform' | 'super-uniform' | 'briggs' | 'super-briggs'
+    :param robustness: Briggs robustness parameter
+    :param superuniform_box: Full width of box (in cells) for super-uniform and super-briggs weighting
     :return: visweights, density, densitygrid
     """
+    if weighting not in ['uniform', 'super-uniform', 'briggs', 'super-briggs']:
+        return visweights, None, None
+
+    log.info("weight_gridding: Performing %s weighting" % weighting)
+    inchan, inpol, ny, nx = shape
+    
+    wts = visweights[...]
+    chan = numpy.array(vfrequencymap, dtype='int')
+    # uvw -> grid cell mapping, for the sample and its Hermitian conjugate
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    yconj, _ = frac_coord(ny, 1.0, -vuvwmap[:, 1])
+    xconj, _ = frac_coord(nx, 1.0, -vuvwmap[:, 0])
+    
     densitygrid = numpy.zeros(shape, dtype='float')
-    if weighting == 'uniform':
-        log.info("weight_gridding: Performing uniform weighting")
-        inchan, inpol, ny, nx = shape
-
-        wts = visweights[...]
-        # uvw -> fraction of grid mapping
-        for flip in [-1.0, 1.0]:
-            y, yf = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
-            x, xf = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
-            coords = list(vfrequencymap), x, y
-            for pol in range(inpol):
-                for vwt, chan, x, y in zip(wts, *coords):
-                    densitygrid[chan, pol, y, x] += vwt[..., pol]
-                    
-        # Find the total weight per sample counting redundancies with other samples
-        newvisweights = numpy.zeros_like(visweights)
-        density = numpy.zeros_like(visweights)
-        y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
-        x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
-        coords = list(vfrequencymap), x, y
-        for pol in range(inpol):
-            density[..., pol] += [densitygrid[chan, pol, y, x] for chan, x, y in zip(*coords)]
-
-        # Normalise each visibility weight to sum to one in a grid cell
-        if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
-            log.warning("weight_gridding: Losing samples in weighting")
-            
+    flatgrid = densitygrid.reshape([-1])
+    cells = list()
+    for pol in range(inpol):
+        corner = (chan * inpol + pol) * ny
+        cells.append((corner + y) * nx + x)
+        # The conjugate samples are added first, as in the original loop over flips
+        accumulate_in_order(flatgrid, numpy.concatenate([(corner + yconj) * nx + xconj, cells[pol]]),
+                            numpy.concatenate([wts[:, pol], wts[:, pol]]))
+    
+    if weighting in ['super-uniform', 'super-briggs']:
+        densitygrid = box_sum(densitygrid, superuniform_box)
+        flatgrid = densitygrid.reshape([-1])
+    
+    # Find the total weight per sample counting redundancies with other samples
+    density = numpy.zeros_like(visweights)
+    for pol in range(inpol):
+        density[:, pol] = flatgrid[cells[pol]]
+    
+    # Normalise each visibility weight to sum to one in a grid cell
+    if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
+        log.warning("weight_gridding: Losing samples in weighting")
+    
+    newvisweights = numpy.zeros_like(visweights)
+    if weighting in ['uniform', 'super-uniform']:
         newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
-        return newvisweights, density, densitygrid
     else:
-        return visweights, None, None
+        # See Briggs' thesis, section 3.2: f^2 = (5 10^-R)^2 / (sum of squared cell weights / sum of weights)
+        sumdensity = numpy.sum(densitygrid, axis=(2, 3))
+        sumdensity2 = numpy.sum(densitygrid ** 2, axis=(2, 3))
+        f2 = numpy.zeros_like(sumdensity)
+        f2[sumdensity2 > 0.0] = (5.0 * numpy.power(10.0, -robustness)) ** 2 / \
+                                (sumdensity2[sumdensity2 > 0.0] / sumdensity[sumdensity2 > 0.0])
+        newvisweights[...] = visweights / (1.0 + density * f2[chan, :])
+    return newvisweights, density, densitygrid
 
 
 def visibility_recentre(uvw, dl, dm):
@@ -0,0 +1,78 @@
+""" Direct Fourier transform of point sources to visibilities.
+
+For a list of point sources with direction cosines :math:`(l_c, m_c)` and fluxes :math:`F_c` the visibilities are
+
+.. math::
+
+    V(u,v,w) = \\sum_c F_c e^{-2 \\pi j (u l_c + v m_c + w(\\sqrt{1-l_c^2-m_c^2}-1))}
+
+with the same phase convention as libs.util.coordinate_support.simulate_point. For many sources this is evaluated in
+chunks of visibilities and sources: the phases of a chunk are the matrix product of the uvw with the directions,
+and the sum over sources is the matrix product of the phasors with the fluxes. The size of each chunk of phasors is
+limited, and the chunks of visibilities can be processed by several threads.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def dft_directions(l, m):
+    """ Direction vectors (l, m, n - 1) of sources, as used in the phase of simulate_point
+
+    :param l: Direction cosines l of the sources [ncomp]
+    :param m: Direction cosines m of the sources [ncomp]
+    :return: Array [ncomp, 3]
+    """
+    l = numpy.asarray(l, dtype='float')
+    m = numpy.asarray(m, dtype='float')
+    return numpy.stack([l, m, numpy.sqrt(1 - l ** 2 - m ** 2) - 1.0], axis=-1)
+
+
+def dft_predict(vis, uvw, directions, flux, nthreads=1, max_chunk_bytes=16 * 1024 ** 2):
+    """ Add the visibilities of point sources to vis, by direct Fourier transform
+
+    :param vis: Visibilities to be added to [nvis, npol] (changed in place)
+    :param uvw: uvw in wavelengths [nvis, 3]
+    :param directions: Direction vectors from dft_directions [ncomp, 3]
+    :param flux: Flux of each source for each polarisation [ncomp, npol]
+    :param nthreads: Number of threads, each adding a contiguous block of visibilities
+    :param max_chunk_bytes: Maximum size of the phases and phasors for a chunk of visibilities and sources in one
+        thread
+    :return: vis
+    """
+    nvis = uvw.shape[0]
+    ncomp = directions.shape[0]
+    if nvis == 0 or ncomp == 0:
+        return vis
+    assert vis.shape[0] == nvis, "vis and uvw have different numbers of visibilities"
+    assert flux.shape[0] == ncomp, "directions and flux have different numbers of sources"
+
+    # Each chunk has phases (real) and phasors (complex) of shape [nvis_chunk, ncomp_chunk]
+    ncomp_chunk = min(ncomp, 1024)
+    nvis_chunk = max(1, max_chunk_bytes // (24 * ncomp_chunk))
+    flux = numpy.asarray(flux)
+
+    def predict_block(start, end):
+        for vstart in range(start, end, nvis_chunk):
+            rows = slice(vstart, min(vstart + nvis_chunk, end))
+            for cstart in range(0, ncomp, ncomp_chunk):
+                comps = slice(cstart, cstart + ncomp_chunk)
+                phase = numpy.dot(uvw[rows], directions[comps].T)
+                phase *= -2.0 * numpy.pi
+                # Evaluating the cosine and sine separately is much faster than the complex exponential
+                phasor = numpy.empty(phase.shape, dtype='complex')
+                numpy.cos(phase, out=phasor.real)
+                numpy.sin(phase, out=phasor.imag)
+                vis[rows] += numpy.dot(phasor, flux[comps])
+
+    if nthreads > 1 and nvis > nthreads:
+        edges = numpy.linspace(0, nvis, nthreads + 1).astype('int')
+        with ThreadPoolExecutor(nthreads) as pool:
+            list(pool.map(predict_block, edges[:-1], edges[1:]))
+    else:
+        predict_block(0, nvis)
+    return vis
@@ -1,40 +1,270 @@
 """ FFT support functions
 
+The FFTs are done by a backend chosen by set_fft_backend. This is a global setting, used by fft, ifft, ifft_real,
+fft2 and ifft2 and so by invert_2d, predict_2d, fft_image and the cleaners:
+
+    - 'numpy': numpy.fft, single threaded. This is the default and the reference implementation. numpy.fft cannot
+      transform in place, so temporary arrays are transformed one axis at a time in blocks, each written back into
+      the array. The results are identical to numpy.fft.fft2 and ifft2.
+    - 'scipy': scipy.fft with a number of worker threads. Plans are cached by scipy.fft and reused. The real part
+      of the inverse transform is calculated with a complex-to-real transform, and temporary arrays are
+      transformed in place.
+    - 'pyfftw': As scipy, but using FFTW via pyfftw (if installed), with the pyfftw cache of FFTW plans enabled.
+
+Single precision (float32, complex64) arrays are always transformed in single precision, using scipy.fft if the
+backend is numpy.
 """
 
+import logging
+
 import numpy
+import scipy.fft
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+from ..util.workspace import workspace
+
+log = logging.getLogger(__name__)
+
+# The current FFT backend, see set_fft_backend
+fft_backend = {'name': 'numpy', 'workers': 1}
+
+
+def set_fft_backend(name='numpy', workers=1):
+    """ Set the backend used for all FFTs
+
+    :param name: 'numpy' | 'scipy' | 'pyfftw'
+    :param workers: Number of threads used by the scipy and pyfftw backends (-1 for all cpus)
+    """
+    assert name in ['numpy', 'scipy', 'pyfftw'], "Unknown FFT backend %s" % name
+    if name == 'pyfftw' and pyfftw is None:
+        log.warning("set_fft_backend: pyfftw is not installed, using scipy backend instead")
+        name = 'scipy'
+    if name == 'pyfftw':
+        pyfftw.interfaces.cache.enable()
+    fft_backend['name'] = name
+    fft_backend['workers'] = workers
+
+
+def get_fft_backend():
+    """ Get the backend used for all FFTs
+
+    :return: name, workers
+    """
+    return fft_backend['name'], fft_backend['workers']
+
+
+def complex_type(precision='double'):
+    """ Complex numpy dtype for a given precision
+
+    :param precision: 'double' | 'single'
+    :return: numpy.complex128 or numpy.complex64
+    """
+    assert precision in ['double', 'single'], "Unknown precision %s" % precision
+    return numpy.complex64 if precision == 'single' else numpy.complex128
+
 
+def real_type(precision='double'):
+    """ Real numpy dtype for a given precision
 
-def fft(a):
+    :param precision: 'double' | 'single'
+    :return: numpy.float64 or numpy.float32
+    """
+    assert precision in ['double', 'single'], "Unknown precision %s" % precision
+    return numpy.float32 if precision == 'single' else numpy.float64
+
+
+def is_single_precision(a):
+    """ Is this array single precision (float32 or complex64)?
+
+    :param a: numpy array
+    :return: True or False
+    """
+    return a.dtype in [numpy.float32, numpy.complex64]
+
+
+def use_numpy_fft(a):
+    """ Should this array be transformed by numpy.fft?
+
+    :param a: numpy array
+    :return: True or False
+    """
+    return fft_backend['name'] == 'numpy' and not is_single_precision(a)
+
+
+def numpy_transform_in_place(transform, a, block_bytes=4 * 1024 ** 2):
+    """ Two dimensional transform of the two innermost axes with numpy.fft, overwriting the array
+
+    numpy.fft.fft2 and ifft2 transform the last axis and then the second last, returning a new array each time. Here
+    the same one dimensional transforms are done on blocks of rows and then blocks of columns, and written back into
+    a, so that the only temporary arrays are the size of a block. The result is identical to numpy.fft.fft2 or ifft2.
+
+    :param transform: 'fft2' or 'ifft2'
+    :param a: complex array to transform
+    :param block_bytes: Approximate size of the blocks transformed at a time
+    :return: a, transformed
+    """
+    transform1d = {'fft2': numpy.fft.fft, 'ifft2': numpy.fft.ifft}[transform]
+    ny, nx = a.shape[-2:]
+    column_bytes = a.nbytes // (ny * nx)
+    step = max(1, block_bytes // (column_bytes * nx))
+    for y0 in range(0, ny, step):
+        a[..., y0:y0 + step, :] = transform1d(a[..., y0:y0 + step, :], axis=-1)
+    step = max(1, block_bytes // (column_bytes * ny))
+    for x0 in range(0, nx, step):
+        a[..., x0:x0 + step] = transform1d(a[..., x0:x0 + step], axis=-2)
+    return a
+
+
+def backend_transform(transform, a, overwrite_x=False, **kwargs):
+    """ Call a scipy.fft style transform from the current backend
+
+    :param transform: Name of transform e.g. 'fft2', 'ifft2', 'irfft2'
+    :param a: array to transform
+    :param overwrite_x: Can the input array be overwritten?
+    :param kwargs: Other arguments for the transform e.g. axes
+    :return: transformed array
+    """
+    if use_numpy_fft(a):
+        in_place = overwrite_x and transform in ['fft2', 'ifft2'] and numpy.iscomplexobj(a) and a.flags.writeable
+        if in_place and tuple(kwargs.get('axes', (-2, -1))) == (-2, -1):
+            return numpy_transform_in_place(transform, a)
+        return getattr(numpy.fft, transform)(a, **kwargs)
+    elif fft_backend['name'] == 'pyfftw':
+        module = pyfftw.interfaces.scipy_fft
+    else:
+        module = scipy.fft
+    return getattr(module, transform)(a, overwrite_x=overwrite_x, workers=fft_backend['workers'], **kwargs)
+
+
+def fft2(a, axes=(-2, -1), overwrite_x=False):
+    """ Two dimensional FFT (without shifts) using the current backend
+
+    :param a: array to transform
+    :param axes: axes to transform
+    :param overwrite_x: Can a be overwritten?
+    :return: transformed array
+    """
+    return backend_transform('fft2', a, overwrite_x=overwrite_x, axes=axes)
+
+
+def ifft2(a, axes=(-2, -1), overwrite_x=False):
+    """ Two dimensional inverse FFT (without shifts) using the current backend
+
+    :param a: array to transform
+    :param axes: axes to transform
+    :param overwrite_x: Can a be overwritten?
+    :return: transformed array
+    """
+    return backend_transform('ifft2', a, overwrite_x=overwrite_x, axes=axes)
+
+
+def shift_into(a, out, inverse=False):
+    """ Copy a into out with the zero frequency shifted to the centre (as numpy.fft.fftshift) or back again
+
+    .. note::
+
+        Only the two innermost axes are shifted
+
+    :param a: array to shift
+    :param out: array to hold the result, same shape as a, not overlapping a
+    :param inverse: Shift as numpy.fft.ifftshift
+    :return: out
+    """
+    ny, nx = a.shape[-2:]
+    sy, sx = (-(ny // 2), -(nx // 2)) if inverse else (ny // 2, nx // 2)
+    sy %= ny
+    sx %= nx
+    for src_y, dst_y in [(slice(0, ny - sy), slice(sy, ny)), (slice(ny - sy, ny), slice(0, sy))]:
+        for src_x, dst_x in [(slice(0, nx - sx), slice(sx, nx)), (slice(nx - sx, nx), slice(0, sx))]:
+            out[..., dst_y, dst_x] = a[..., src_y, src_x]
+    return out
+
+
+def shifted_transform(transform, a, out=None):
+    """ Apply an unshifted transform to an array with the zero frequency in the centre
+
+    The shifted copy of a is held in an array borrowed from the workspace pool and transformed in place (by blocks
+    with the numpy backend, see numpy_transform_in_place), so that the only array allocated is out, if not given.
+
+    :param transform: fft2 or ifft2
+    :param a: array to transform
+    :param out: array to hold the result (may be a)
+    :return: transformed array
+    """
+    shifted = workspace.borrow(a.shape, a.dtype)
+    try:
+        transformed = transform(shift_into(a, shifted, inverse=True), overwrite_x=True)
+        if out is None:
+            out = numpy.empty_like(transformed)
+        return shift_into(transformed, out)
+    finally:
+        workspace.release(shifted)
+
+
+def fft(a, out=None):
     """ Fourier transformation from image to grid space
     
     .. note::
     
         If there are four axes then the last outer axes are not transformed
 
+    The transform of a complex array is done in place for all backends (see shifted_transform).
+
     :param a: image in `lm` coordinate space
+    :param out: complex array to hold the `uv` grid, e.g. a for an in place transform (optional)
     :return: `uv` grid
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+    return shifted_transform(fft2, a, out)
 
 
-def ifft(a):
+def ifft(a, out=None):
     """ Fourier transformation from grid to image space
 
     .. note::
     
         If there are four axes then the last outer axes are not transformed
 
+    The transform of a complex array is done in place for all backends (see shifted_transform).
+
     :param a: `uv` grid to transform
+    :param out: complex array to hold the image, e.g. a for an in place transform (optional)
     :return: an image in `lm` coordinate space
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+    return shifted_transform(ifft2, a, out)
+
+
+def ifft_real(a, overwrite_a=False):
+    """ Real part of the Fourier transformation from grid to image space i.e. numpy.real(ifft(a))
+
+    Except for the numpy backend, this uses a complex-to-real transform of the Hermitian part of the grid, which
+    needs about half of the work and memory of the full complex transform.
+
+    .. note::
+
+        Only the two innermost axes are transformed
+
+    :param a: `uv` grid to transform
+    :param overwrite_a: Can a be overwritten?
+    :return: a real image in `lm` coordinate space
+    """
+    if use_numpy_fft(a):
+        return numpy.real(ifft(a, out=a if overwrite_a else None))
+    
+    ny, nx = a.shape[-2:]
+    # The Hermitian part of the unshifted grid, on the half plane used by irfft2. The shift of the grid is
+    # folded into the indices so that the full grid is not copied.
+    ky = numpy.arange(ny)
+    kx = numpy.arange(nx // 2 + 1)
+    hermitian = a.take((ky + ny // 2) % ny, axis=-2).take((kx + nx // 2) % nx, axis=-1)
+    hermitian += numpy.conjugate(a.take((ny // 2 - ky) % ny, axis=-2).take((nx // 2 - kx) % nx, axis=-1))
+    hermitian *= 0.5
+    image = backend_transform('irfft2', hermitian, overwrite_x=True, s=(ny, nx), axes=(-2, -1))
+    return numpy.fft.fftshift(image, axes=(-2, -1))
 
 
 def pad_mid(ff, npixel):
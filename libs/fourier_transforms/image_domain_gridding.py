@@ -0,0 +1,246 @@
+""" Image domain gridding (IDG)
+
+Instead of convolving each visibility with a precalculated (and, for w projection, possibly very large) kernel,
+image domain gridding works with small subgrids. The visibilities are divided into groups, each from one baseline
+and channel, lying within one tile of the uv grid. For each group the subgrid is first calculated in the image
+domain, at the low resolution corresponding to its size, by direct summation of the visibilities including their
+w term, and multiplied by a taper. The subgrid is then Fourier transformed and added into the uv grid. Degridding
+is the adjoint operation. The image made from the grid is corrected for the taper (see idg_correction).
+
+The w term is handled exactly for each visibility, so no w kernels need be calculated or stored. The subgrids must
+be big enough to hold the taper (about 6 pixels wide in uv) and the w term of the group, see idg_subgrid_size.
+
+See van der Tol, Veenboer and Offringa, A&A 616, A27 (2018)
+"""
+
+import logging
+
+import numpy
+
+from .convolutional_gridding import coordinates, grdsf
+from .fft_support import fft, ifft
+
+log = logging.getLogger(__name__)
+
+# Half width in pixels of the uv footprint of the taper, plus a pixel for the offset of the visibility
+idg_taper_support = 4
+
+
+def idg_taper(npixel):
+    """ Image domain taper: the prolate spheroidal function across the field, sampled at npixel points
+
+    :param npixel: Number of pixels
+    :return: 1D taper
+    """
+    return grdsf(numpy.abs(2.0 * coordinates(npixel)))[0]
+
+
+def idg_correction(shape, subgrid_size):
+    """ Correction for the IDG taper, to be applied to the image made from the (padded) grid
+
+    :param shape: Shape of the padded grid (ny, nx)
+    :param subgrid_size: Size of subgrids
+    :return: 2D correction function
+    """
+    taper = numpy.outer(idg_taper(shape[0]), idg_taper(shape[1])) * subgrid_size ** 2
+    correction = numpy.zeros_like(taper)
+    correction[taper > 0.0] = 1.0 / taper[taper > 0.0]
+    return correction
+
+
+def idg_w_support(wmaxabs, field_of_view):
+    """ Half width in pixels of the uv footprint of the w term
+
+    :param wmaxabs: Maximum absolute w (wavelengths)
+    :param field_of_view: Field of view of the padded grid (radians)
+    :return: half width in pixels
+    """
+    lmax = min(0.5 * field_of_view, 0.99)
+    return int(numpy.ceil(wmaxabs * lmax / numpy.sqrt(1.0 - lmax ** 2) * field_of_view))
+
+
+def idg_subgrid_size(wmaxabs, field_of_view, subgrid_size=32):
+    """ Size of subgrid needed for the taper and the w term, at least subgrid_size
+
+    :param wmaxabs: Maximum absolute w (wavelengths)
+    :param field_of_view: Field of view of the padded grid (radians)
+    :param subgrid_size: Requested size of subgrid
+    :return: size of subgrid (even), half width of margin for taper and w term
+    """
+    margin = idg_taper_support + idg_w_support(wmaxabs, field_of_view)
+    # Leave space for a tile of at least 8 pixels
+    size = max(subgrid_size, 2 * margin + 8)
+    size += size % 2
+    if size > subgrid_size:
+        log.debug("idg_subgrid_size: Increasing subgrid size from %d to %d to hold w term" % (subgrid_size, size))
+    return size, margin
+
+
+def idg_subgrids(vuvwmap, vfrequencymap, baselines, ny, nx, subgrid_size, margin):
+    """ Divide the visibilities into groups sharing a subgrid
+
+    Each group holds visibilities from a single baseline and channel lying in one tile of the uv grid. The tiles
+    are subgrid_size - 2 * margin pixels wide so that the taper and w term of all visibilities in a group fall
+    within the subgrid centred on the tile.
+
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param baselines: baseline index for each visibility
+    :param ny: Number of pixels in the v axis of the grid
+    :param nx: Number of pixels in the u axis of the grid
+    :param subgrid_size: Size of subgrids
+    :param margin: Half width of taper and w term
+    :return: order (visibility indices sorted by group), start (index in order of the first visibility of each
+        group), chan, y0, x0 (channel and grid corner of each group), dy, dx (offset in pixels of each visibility
+        from the centre of its subgrid, in order)
+    """
+    tile = subgrid_size - 2 * margin
+    assert tile > 0, "Subgrid is too small for the taper and w term"
+    y = ny // 2 + vuvwmap[:, 1] * ny
+    x = nx // 2 + vuvwmap[:, 0] * nx
+    ty = numpy.floor(y / tile).astype('int')
+    tx = numpy.floor(x / tile).astype('int')
+    chan = numpy.array(vfrequencymap, dtype='int')
+
+    key = numpy.stack([numpy.array(baselines, dtype='int'), chan, ty, tx])
+    order = numpy.lexsort(key[::-1])
+    key = key[:, order]
+    newgroup = numpy.ones(len(order), dtype='bool')
+    newgroup[1:] = numpy.any(key[:, 1:] != key[:, :-1], axis=0)
+    start = numpy.nonzero(newgroup)[0]
+
+    # The subgrid is centred on the centre of the tile
+    yc = ty[order][start] * tile + tile // 2
+    xc = tx[order][start] * tile + tile // 2
+    y0 = yc - subgrid_size // 2
+    x0 = xc - subgrid_size // 2
+    assert numpy.min(y0) >= 0 and numpy.max(y0) + subgrid_size <= ny, "Cellsize is too large: uv overflows grid"
+    assert numpy.min(x0) >= 0 and numpy.max(x0) + subgrid_size <= nx, "Cellsize is too large: uv overflows grid"
+
+    group = numpy.cumsum(newgroup) - 1
+    dy = y[order] - yc[group]
+    dx = x[order] - xc[group]
+    return order, start, chan[order][start], y0, x0, dy, dx
+
+
+def idg_phasor(dy, dx, w, subgrid_size, field_of_view, sign=1.0):
+    """ Phasors of visibilities on their subgrids in the image domain
+
+    :param dy: offset of visibility from subgrid centre in v (pixels)
+    :param dx: offset of visibility from subgrid centre in u (pixels)
+    :param w: w of visibility (wavelengths)
+    :param subgrid_size: Size of subgrids
+    :param field_of_view: Field of view of the padded grid (radians)
+    :param sign: +1 for gridding, -1 for degridding
+    :return: phasors [nvis, subgrid_size, subgrid_size]
+    """
+    j = numpy.arange(subgrid_size) - subgrid_size // 2
+    l = j * field_of_view / subgrid_size
+    r2 = l[:, numpy.newaxis] ** 2 + l[numpy.newaxis, :] ** 2
+    nterm = numpy.zeros_like(r2)
+    nterm[r2 < 1.0] = numpy.sqrt(1.0 - r2[r2 < 1.0]) - 1.0
+    py = numpy.exp(sign * 2j * numpy.pi * numpy.outer(dy, j) / subgrid_size)
+    px = numpy.exp(sign * 2j * numpy.pi * numpy.outer(dx, j) / subgrid_size)
+    pw = numpy.exp(sign * 2j * numpy.pi * w[:, numpy.newaxis, numpy.newaxis] * nterm[numpy.newaxis, ...])
+    return py[:, :, numpy.newaxis] * px[:, numpy.newaxis, :] * pw
+
+
+def idg_batches(start, nvis, batch=2048):
+    """ Divide groups into batches of about batch visibilities
+
+    :param start: index of the first visibility of each group
+    :param nvis: Total number of visibilities
+    :param batch: Target number of visibilities in a batch
+    :return: list of (first group, last group + 1)
+    """
+    ngroups = len(start)
+    end = numpy.append(start[1:], nvis)
+    batches = list()
+    g0 = 0
+    while g0 < ngroups:
+        g1 = max(g0 + 1, numpy.searchsorted(end, start[g0] + batch, side='right'))
+        batches.append((g0, g1))
+        g0 = g1
+    return batches
+
+
+def idg_grid(uvgrid, vis, visweights, vuvwmap, vfrequencymap, w, baselines, field_of_view, subgrid_size=32,
+             batch=2048):
+    """ Grid visibilities using image domain gridding
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param vis: Visibility values [nvis, npol]
+    :param visweights: Visibility weights [nvis, npol]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param w: w of visibilities (wavelengths)
+    :param baselines: baseline index for each visibility
+    :param field_of_view: Field of view of the padded grid (radians)
+    :param subgrid_size: Minimum size of subgrids (see idg_subgrid_size)
+    :param batch: Number of visibilities processed at once
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol], subgrid size used
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis = len(w)
+    subgrid_size, margin = idg_subgrid_size(numpy.max(numpy.abs(w)), field_of_view, subgrid_size)
+    order, start, chan, y0, x0, dy, dx = idg_subgrids(vuvwmap, vfrequencymap, baselines, ny, nx, subgrid_size,
+                                                      margin)
+    log.debug("idg_grid: %d visibilities in %d subgrids of size %d" % (nvis, len(start), subgrid_size))
+
+    viswt = (vis * visweights).reshape([nvis, -1])[order].astype(uvgrid.dtype)
+    wt = visweights.reshape([nvis, -1])[order]
+    ws = w[order]
+    sumwt = numpy.zeros([inchan, inpol])
+    numpy.add.at(sumwt, numpy.array(vfrequencymap, dtype='int')[order], wt)
+
+    taper = numpy.outer(idg_taper(subgrid_size), idg_taper(subgrid_size))
+    for g0, g1 in idg_batches(start, nvis, batch):
+        r0 = start[g0]
+        r1 = start[g1] if g1 < len(start) else nvis
+        phasor = idg_phasor(dy[r0:r1], dx[r0:r1], ws[r0:r1], subgrid_size, field_of_view, +1.0)
+        # Sum the phasors weighted by the visibilities over each group
+        terms = viswt[r0:r1, :, numpy.newaxis, numpy.newaxis] * phasor[:, numpy.newaxis, ...]
+        subgrids = numpy.add.reduceat(terms, start[g0:g1] - r0, axis=0) * taper
+        subgrids = fft(subgrids, out=subgrids)
+        for i, g in enumerate(range(g0, g1)):
+            uvgrid[chan[g], :, y0[g]:y0[g] + subgrid_size, x0[g]:x0[g] + subgrid_size] += subgrids[i]
+    return uvgrid, sumwt, subgrid_size
+
+
+def idg_degrid(uvgrid, vshape, vuvwmap, vfrequencymap, w, baselines, field_of_view, subgrid_size=32, batch=2048):
+    """ Degrid visibilities using image domain gridding
+
+    :param uvgrid: Grid to degrid from [nchan, npol, ny, nx]
+    :param vshape: Shape of visibility
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param w: w of visibilities (wavelengths)
+    :param baselines: baseline index for each visibility
+    :param field_of_view: Field of view of the padded grid (radians)
+    :param subgrid_size: Minimum size of subgrids (see idg_subgrid_size)
+    :param batch: Number of visibilities processed at once
+    :return: visibilities, subgrid size used
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis = len(w)
+    subgrid_size, margin = idg_subgrid_size(numpy.max(numpy.abs(w)), field_of_view, subgrid_size)
+    order, start, chan, y0, x0, dy, dx = idg_subgrids(vuvwmap, vfrequencymap, baselines, ny, nx, subgrid_size,
+                                                      margin)
+    log.debug("idg_degrid: %d visibilities in %d subgrids of size %d" % (nvis, len(start), subgrid_size))
+
+    ws = w[order]
+    vis = numpy.zeros([nvis, inpol], dtype=uvgrid.dtype)
+    # The inverse FFT includes a factor 1 / subgrid_size ** 2 that is not wanted here
+    taper = numpy.outer(idg_taper(subgrid_size), idg_taper(subgrid_size)) * subgrid_size ** 2
+    for g0, g1 in idg_batches(start, nvis, batch):
+        r0 = start[g0]
+        r1 = start[g1] if g1 < len(start) else nvis
+        subgrids = numpy.zeros([g1 - g0, inpol, subgrid_size, subgrid_size], dtype=uvgrid.dtype)
+        for i, g in enumerate(range(g0, g1)):
+            subgrids[i] = uvgrid[chan[g], :, y0[g]:y0[g] + subgrid_size, x0[g]:x0[g] + subgrid_size]
+        subgrids = ifft(subgrids, out=subgrids) * taper
+        phasor = idg_phasor(dy[r0:r1], dx[r0:r1], ws[r0:r1], subgrid_size, field_of_view, -1.0)
+        # Each visibility is the sum over its subgrid weighted by its phasor
+        group = numpy.repeat(numpy.arange(g1 - g0), numpy.diff(numpy.append(start[g0:g1], r1)))
+        vis[order[r0:r1]] = numpy.einsum('kpyx,kyx->kp', subgrids[group], phasor)
+    return vis.reshape(vshape), subgrid_size
@@ -284,7 +284,8 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = 'VV'
         ft_wcs.wcs.cdelt[0] = 1.0 / (ft_shape[3] * d2r * im.wcs.wcs.cdelt[0])
         ft_wcs.wcs.cdelt[1] = 1.0 / (ft_shape[2] * d2r * im.wcs.wcs.cdelt[1])
-        ft_data = ifft(im.data.astype('complex'))
+        ft_data = im.data.astype('complex')
+        ft_data = ifft(ft_data, out=ft_data)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     elif im.wcs.wcs.ctype[0] == 'UU' and im.wcs.wcs.ctype[1] == 'VV':
         ft_wcs.wcs.crval[0] = template_image.wcs.wcs.crval[0]
@@ -295,7 +296,8 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = template_image.wcs.wcs.ctype[1]
         ft_wcs.wcs.cdelt[0] = template_image.wcs.wcs.cdelt[0]
         ft_wcs.wcs.cdelt[1] = template_image.wcs.wcs.cdelt[1]
-        ft_data = fft(im.data.astype('complex'))
+        ft_data = im.data.astype('complex')
+        ft_data = fft(ft_data, out=ft_data)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     else:
         raise NotImplementedError("Cannot FFT specified axes")
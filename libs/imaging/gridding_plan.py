@@ -0,0 +1,247 @@
+"""
+Gridding plans: the mapping of a Visibility onto the grid of an image, calculated once and reused.
+
+The uvw, frequencies and image geometry do not change between major cycles, so neither do the grid coordinates,
+channel map and kernels used in gridding and degridding. A GriddingPlan holds all of these. Plans are kept in an
+in-process least recently used cache keyed by a fingerprint of the uvw and frequencies, the image geometry and the
+kernel parameters. Repeated calls to invert_2d, predict_2d and weight_visibility for the same data (e.g. in every
+major cycle of a workflow) therefore find the plan already calculated.
+
+The cache is private to each process. In a distributed workflow a plan is reused only if the task for the same
+visibility runs in the same worker process as in the previous cycle. Otherwise the plan is calculated again in the
+new worker, and each worker holds its own copy, up to gridding_plan_cache_max_bytes. Plans larger than that limit
+are never cached.
+
+A BlockVisibility can be gridded without converting it to a Visibility: BlockVisibilityRows presents the
+cross-correlations of the block as rows, with the uvw in wavelengths calculated for each channel, and plans can be
+made for it in the same way as for a Visibility.
+"""
+
+import collections
+import hashlib
+import logging
+import threading
+
+import numpy
+from astropy import constants
+
+from data_models.memory_data_models import Visibility, BlockVisibility, Image
+from data_models.parameters import get_parameter
+
+from ..fourier_transforms.convolutional_gridding import grid_coordinates
+from .imaging_params import get_frequency_map, get_uvw_map, get_kernel_list
+from .kernel_cache import image_geometry_key, phasecentre_key
+
+log = logging.getLogger(__name__)
+
+
+class GriddingPlan:
+    """ Precomputed mapping of the visibilities onto the (padded) uv grid of an image
+    """
+
+    def __init__(self, shape, padding, spectral_mode, vfrequencymap, vuvwmap, kernel_name, gcf, kernel_list,
+                 grid_coords):
+        """ Create a gridding plan
+
+        :param shape: Shape of the padded grid [nchan, npol, ny, nx]
+        :param padding: Padding factor
+        :param spectral_mode: Spectral mode from get_frequency_map
+        :param vfrequencymap: Map from visibility row to image channel
+        :param vuvwmap: uvw mapped to fractions of the grid
+        :param kernel_name: Name of kernel e.g. '2d' or 'wprojection'
+        :param gcf: Gridding correction function
+        :param kernel_list: (kernel indices, kernels) from get_kernel_list
+        :param grid_coords: chan, kernel_indices, x, y, xf, yf from grid_coordinates
+        """
+        self.shape = shape
+        self.padding = padding
+        self.spectral_mode = spectral_mode
+        self.vfrequencymap = vfrequencymap
+        self.vuvwmap = vuvwmap
+        self.kernel_name = kernel_name
+        self.gcf = gcf
+        self.kernel_list = kernel_list
+        self.grid_coords = grid_coords
+
+    @property
+    def nvis(self):
+        return len(self.vuvwmap)
+
+    @property
+    def nbytes(self):
+        """ Size of the per-visibility arrays (the kernels and gcf are shared with other plans)
+        """
+        return self.vuvwmap.nbytes + sum(a.nbytes for a in self.grid_coords)
+
+    def __str__(self):
+        s = "GriddingPlan:\n"
+        s += "\tKernel: %s\n" % self.kernel_name
+        s += "\tGrid shape: %s\n" % str(self.shape)
+        s += "\tPadding: %s\n" % str(self.padding)
+        s += "\tNumber of visibilities: %d\n" % self.nvis
+        s += "\tSize: %.3f (MB)\n" % (self.nbytes / 1024.0 / 1024.0)
+        return s
+
+
+class BlockVisibilityRows:
+    """ The cross-correlations of a BlockVisibility seen as the rows of a Visibility, without conversion
+
+    The rows are in the same order as made by convert_blocks: time, then baseline (antenna1 < antenna2, with
+    antenna1 varying slowest), then channel. Visibility data are moved between the block layout
+    [time, ant2, ant1, chan, pol] and the rows by gather and scatter.
+    """
+
+    def __init__(self, vis: BlockVisibility):
+        """ Create the rows for a BlockVisibility
+
+        :param vis: BlockVisibility
+        """
+        assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
+        ntimes, nants, _, nchan, npol = vis.vis.shape
+        self.blockvis = vis
+        self.antenna1, self.antenna2 = numpy.triu_indices(nants, 1)
+        self.shape = (ntimes, len(self.antenna1), nchan)
+        self.npol = npol
+        self.phasecentre = vis.phasecentre
+        self.channel = numpy.tile(numpy.arange(nchan), ntimes * len(self.antenna1))
+        self.frequency = vis.frequency[self.channel]
+        # Scale the uvw in metres to wavelengths for each channel
+        uvw = vis.uvw[:, self.antenna2, self.antenna1, numpy.newaxis, :]
+        self.uvw = (uvw * vis.frequency[:, numpy.newaxis] / constants.c.value).reshape([self.nvis, 3])
+
+    @property
+    def nvis(self):
+        return int(numpy.prod(self.shape))
+
+    @property
+    def w(self):
+        return self.uvw[:, 2]
+
+    def gather(self, blockdata):
+        """ Extract the rows from a block array e.g. vis.data['vis']
+
+        :param blockdata: Array [ntimes, nants, nants, nchan, npol]
+        :return: Array [nvis, npol]
+        """
+        return blockdata[:, self.antenna2, self.antenna1, ...].reshape([self.nvis, self.npol])
+
+    def scatter(self, rowdata, blockdata):
+        """ Write rows back into a block array in place
+
+        The baselines with antenna2 > antenna1 are set from the rows and the transposed baselines from their
+        conjugates. The autocorrelations are set to zero.
+
+        :param rowdata: Array [nvis, npol]
+        :param blockdata: Array [ntimes, nants, nants, nchan, npol] to be filled
+        :return: blockdata
+        """
+        rowdata = rowdata.reshape(self.shape + (self.npol,))
+        diagonal = numpy.arange(blockdata.shape[1])
+        blockdata[:, diagonal, diagonal, ...] = 0.0
+        blockdata[:, self.antenna2, self.antenna1, ...] = rowdata
+        blockdata[:, self.antenna1, self.antenna2, ...] = numpy.conjugate(rowdata)
+        return blockdata
+
+
+def gridding_plan_key(vis: Visibility, im: Image, **kwargs):
+    """ Fingerprint of everything that a gridding plan depends on
+
+    :param vis: Visibility
+    :param im: Image
+    :return: tuple
+    """
+    digest = hashlib.sha1(type(vis).__name__.encode())
+    digest.update(numpy.ascontiguousarray(vis.uvw).tobytes())
+    digest.update(numpy.ascontiguousarray(vis.frequency).tobytes())
+    kernel_parameters = tuple(get_parameter(kwargs, name) for name in ['padding', 'oversampling', 'wstep',
+                                                                       'kernelwidth', 'remove_shift', 'precision'])
+    return (vis.nvis, digest.hexdigest(), image_geometry_key(im), phasecentre_key(vis.phasecentre),
+            kernel_parameters)
+
+
+def create_gridding_plan(vis: Visibility, im: Image, **kwargs) -> GriddingPlan:
+    """ Calculate the gridding plan for a visibility and image
+
+    :param vis: Visibility or BlockVisibilityRows
+    :param im: Image defining the grid
+    :param kwargs: Parameters for get_uvw_map and get_kernel_list e.g. padding, oversampling, wstep, kernelwidth
+    :return: GriddingPlan
+    """
+    assert isinstance(vis, (Visibility, BlockVisibilityRows)), "vis is not a Visibility: %r" % vis
+    nchan, npol, ny, nx = im.data.shape
+
+    padding = {}
+    if get_parameter(kwargs, "padding", False):
+        padding = {'padding': get_parameter(kwargs, "padding", False)}
+    if isinstance(vis, BlockVisibilityRows):
+        # Map the channels of the block and then look up the channel of each row
+        spectral_mode, channelmap = get_frequency_map(vis.blockvis, im)
+        vfrequencymap = numpy.array(channelmap, dtype='int')[vis.channel]
+    else:
+        spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im, **padding)
+    kernel_name, gcf, kernel_list = get_kernel_list(vis, im, **kwargs)
+
+    shape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    grid_coords = grid_coordinates(kernel_list, shape[2], shape[3], vuvwmap, vfrequencymap)
+    vfrequencymap = grid_coords[0]
+    # Plans are shared so make the arrays read-only
+    for a in grid_coords + (vuvwmap,):
+        a.setflags(write=False)
+    return GriddingPlan(shape, padding, spectral_mode, vfrequencymap, vuvwmap, kernel_name, gcf, kernel_list,
+                        grid_coords)
+
+
+# Least recently used cache of gridding plans, limited in total size
+gridding_plan_cache = collections.OrderedDict()
+gridding_plan_cache_lock = threading.Lock()
+gridding_plan_cache_max_bytes = 1024 ** 3
+
+
+def get_gridding_plan(vis: Visibility, im: Image, **kwargs) -> GriddingPlan:
+    """ Get the gridding plan for a visibility and image
+
+    If a plan is given by the keyword gridding_plan, it is used. Otherwise the plan is found in the cache of
+    plans, or calculated and added to the cache. The least recently used plans are evicted to keep the cache within
+    gridding_plan_cache_max_bytes, and a plan larger than that is not cached at all. The cache can be bypassed with
+    gridding_plan_cache=False.
+
+    :param vis: Visibility or BlockVisibilityRows
+    :param im: Image defining the grid
+    :param gridding_plan: Precalculated plan (optional)
+    :param gridding_plan_cache: Use the cache of gridding plans (True)
+    :return: GriddingPlan
+    """
+    plan = get_parameter(kwargs, "gridding_plan", None)
+    if plan is not None:
+        assert plan.nvis == vis.nvis, "Gridding plan is for %d visibilities, not %d" % (plan.nvis, vis.nvis)
+        assert tuple(plan.shape[:2]) == tuple(im.shape[:2]), "Gridding plan does not match image"
+        return plan
+
+    if not get_parameter(kwargs, "gridding_plan_cache", True):
+        return create_gridding_plan(vis, im, **kwargs)
+
+    key = gridding_plan_key(vis, im, **kwargs)
+    with gridding_plan_cache_lock:
+        if key in gridding_plan_cache:
+            gridding_plan_cache.move_to_end(key)
+            return gridding_plan_cache[key]
+
+    plan = create_gridding_plan(vis, im, **kwargs)
+    if plan.nbytes > gridding_plan_cache_max_bytes:
+        log.debug("get_gridding_plan: plan of %.1f MB is too large to cache" % (plan.nbytes / 1024.0 / 1024.0))
+        return plan
+    with gridding_plan_cache_lock:
+        gridding_plan_cache[key] = plan
+        total = sum(p.nbytes for p in gridding_plan_cache.values())
+        while total > gridding_plan_cache_max_bytes:
+            _, evicted = gridding_plan_cache.popitem(last=False)
+            total -= evicted.nbytes
+    return plan
+
+
+def clear_gridding_plan_cache():
+    """ Remove all plans from the cache of gridding plans
+    """
+    with gridding_plan_cache_lock:
+        gridding_plan_cache.clear()
@@ -13,9 +13,10 @@ from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 from data_models.polarisation import PolarisationFrame
 
-from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate
 from ..image.operations import convert_image_to_kernel
+from ..fourier_transforms.fft_support import complex_type
 from ..image.operations import copy_image, fft_image, pad_image, create_w_term_like
+from .kernel_cache import w_kernel_cache, image_geometry_key, phasecentre_key, cached_anti_aliasing_calculate
 
 log = logging.getLogger(__name__)
 
@@ -116,20 +117,25 @@ def get_uvw_map(vis: Visibility, im: Image, padding=2):
     return uvw_mode, shape, padding, vuvwmap
 
 
-def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
+def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3, precision='double'):
     """Return a generator to calculate the standard visibility kernel
 
+    The kernel is shared between calls (see cached_anti_aliasing_calculate) and is read-only.
+
     :param vis: visibility
     :param shape: tuple with 2D shape of grid
     :param oversampling: Oversampling factor
     :param support: Support of kernel
+    :param precision: 'double' | 'single'
     :return: Function to look up gridding kernel
     """
-    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate(shape, oversampling, support)[1]]
+    return numpy.zeros_like(vis.w, dtype='int'), [cached_anti_aliasing_calculate(shape, oversampling, support,
+                                                                                 precision)[1]]
 
 
 # noinspection PyTypeChecker
-def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, **kwargs):
+def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, precision='double',
+                  **kwargs):
     """ Calculate w convolution kernels
     
     Uses create_w_term_like to calculate the w screen. This is exactly as wstacking does.
@@ -140,16 +146,21 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     convolution function for all channels and polarisations. Changing that behaviour would
     require modest changes here and to the gridding/degridding routines.
 
+    The kernels are held in w_kernel_cache, keyed by the image geometry, phasecentre, range of w, wstep,
+    oversampling, kernelwidth and the other keyword arguments (e.g. remove_shift), so that they are
+    calculated only once. The cached kernels are read-only.
+
     :param im:
     :param kernelwidth:
     :param vis: visibility
     :param oversampling: Oversampling factor
     :param wstep: Step in w between cached functions
+    :param precision: Precision of the kernels 'double' | 'single'. The kernels are always calculated in double
+        precision.
     :return: (indices to the w kernel for each row, kernels)
     """
 
     nchan, npol, ny, nx = im.shape
-    gcf, _ = anti_aliasing_calculate((ny, nx))
 
     assert oversampling % 2 == 0 or oversampling == 1, "oversampling must be unity or even"
     assert kernelwidth % 2 == 0, "kernelwidth must be even"
@@ -160,32 +171,41 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     def digitise(w, wstep):
         return numpy.ceil((w + wmaxabs) / wstep).astype('int')
     
-    # Find all the unique indices for which we need a kernel
-    nwsteps = digitise(wmaxabs, wstep) + 1
-    w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
+    def calculate_kernels():
+        gcf, _ = cached_anti_aliasing_calculate((ny, nx))
+        
+        # Find all the unique indices for which we need a kernel
+        nwsteps = digitise(wmaxabs, wstep) + 1
+        w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
+        
+        wtemplate = copy_image(im)
+        
+        wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
+        
+        padded_shape = list(wtemplate.shape)
+        padded_shape[3] *= oversampling
+        padded_shape[2] *= oversampling
     
-    wtemplate = copy_image(im)
+        # For all the unique indices, calculate the corresponding w kernel
+        kernels = list()
+        for w in w_list:
+            # Make a w screen
+            wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
+            wscreen.data /= gcf
+            assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
+            wscreen_padded = pad_image(wscreen, padded_shape)
     
-    wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
+            wconv = fft_image(wscreen_padded)
+            wconv.data *= float(oversampling)**2
+            # For the moment, ignore the polarisation and channel axes
+            kernels.append(convert_image_to_kernel(wconv, oversampling,
+                                                   kernelwidth).data[0, 0, ...].astype(complex_type(precision)))
+        return kernels
     
-    padded_shape = list(wtemplate.shape)
-    padded_shape[3] *= oversampling
-    padded_shape[2] *= oversampling
-
-    # For all the unique indices, calculate the corresponding w kernel
-    kernels = list()
-    for w in w_list:
-        # Make a w screen
-        wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
-        wscreen.data /= gcf
-        assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
-        wscreen_padded = pad_image(wscreen, padded_shape)
-
-        wconv = fft_image(wscreen_padded)
-        wconv.data *= float(oversampling)**2
-        # For the moment, ignore the polarisation and channel axes
-        kernels.append(convert_image_to_kernel(wconv, oversampling,
-                                               kernelwidth).data[0, 0, ...])
+    key = ('w_kernel_list', image_geometry_key(im), phasecentre_key(vis.phasecentre), float(wmaxabs), float(wstep),
+           oversampling, kernelwidth, precision, tuple(sorted(kwargs.items())))
+    kernels = w_kernel_cache.get(key, calculate_kernels)
+    log.debug("w_kernel_list: %s" % str(w_kernel_cache))
     
     # Now make a lookup table from row number of vis to the kernel
     kernel_indices = digitise(vis.w, wstep)
@@ -206,8 +226,9 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     wstep = get_parameter(kwargs, "wstep", 0.0)
     oversampling = get_parameter(kwargs, "oversampling", 8)
     padding = get_parameter(kwargs, "padding", 2)
+    precision = get_parameter(kwargs, "precision", 'double')
     
-    gcf, _ = anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling)
+    gcf, _ = cached_anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling, precision=precision)
     
     wabsmax = numpy.max(numpy.abs(vis.w))
     if wstep > 0.0 and wabsmax > 0.0:
@@ -232,10 +253,10 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
         remove_shift = get_parameter(kwargs, "remove_shift", True)
         padded_image = pad_image(im, padded_shape)
         kernel_list = w_kernel_list(vis, padded_image, oversampling=oversampling, wstep=wstep,
-                                    kernelwidth=kernelwidth, remove_shift=remove_shift)
+                                    kernelwidth=kernelwidth, remove_shift=remove_shift, precision=precision)
     else:
         kernelname = '2d'
         kernel_list = standard_kernel_list(vis, (padding * npixel, padding * npixel),
-                                           oversampling=oversampling)
+                                           oversampling=oversampling, precision=precision)
     
     return kernelname, gcf, kernel_list
@@ -0,0 +1,223 @@
+"""
+Caches for convolution kernels and other arrays that are expensive to calculate but depend only on a few parameters
+such as the image geometry.
+
+The cached arrays are made read-only so that they can be shared safely between calls and between threads.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+import numpy
+
+from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from ..fourier_transforms.fft_support import complex_type, real_type
+
+log = logging.getLogger(__name__)
+
+
+class KernelCache:
+    """ Least recently used cache of lists of arrays, bounded in memory, optionally backed by files on disk
+
+    Entries are identified by a key, a tuple of hashable values describing everything the arrays depend on. When
+    the total size of the cached arrays exceeds max_bytes, the least recently used entries are evicted. If a
+    directory is given, new entries are also saved there (one .npz file per entry) and entries not in memory are
+    looked for there before being calculated.
+    """
+
+    def __init__(self, name, max_bytes=512 * 1024 ** 2, directory=None):
+        """ Create a cache
+
+        :param name: Name of cache, used in logging and in the names of files on disk
+        :param max_bytes: Maximum total size of the arrays held in memory (0 to disable caching in memory)
+        :param directory: Directory for the disk cache (None for no disk cache)
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "KernelCache %s: %s" % (self.name, str(self.statistics()))
+
+    def configure(self, max_bytes=None, directory=None):
+        """ Change the memory limit and/or the disk cache directory
+
+        :param max_bytes: Maximum total size of the arrays held in memory
+        :param directory: Directory for the disk cache ('' to stop using the disk cache)
+        """
+        with self.lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+                self.evict()
+            if directory is not None:
+                self.directory = directory if directory != '' else None
+
+    def get(self, key, calculate):
+        """ Get the arrays for a key, calculating them if necessary
+
+        :param key: Tuple describing all the parameters that the arrays depend on
+        :param calculate: Function with no arguments that calculates the list of arrays
+        :return: list of read-only arrays
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(self.entries[key])
+
+        arrays = self.load(key)
+        if arrays is not None:
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            arrays = [numpy.array(a) for a in calculate()]
+            with self.lock:
+                self.misses += 1
+            self.save(key, arrays)
+
+        for a in arrays:
+            a.setflags(write=False)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = arrays
+                self.nbytes += sum(a.nbytes for a in arrays)
+                self.evict()
+        return list(arrays)
+
+    def evict(self):
+        """ Evict least recently used entries until the cache fits in memory. The lock must be held.
+        """
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, arrays = self.entries.popitem(last=False)
+            self.nbytes -= sum(a.nbytes for a in arrays)
+            self.evictions += 1
+
+    def filename(self, key):
+        """ Name of the disk cache file for a key
+
+        :param key: Tuple describing the entry
+        :return: file name
+        """
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "%s_%s.npz" % (self.name, digest))
+
+    def load(self, key):
+        """ Load the arrays for a key from disk
+
+        :param key: Tuple describing the entry
+        :return: list of arrays or None if not found
+        """
+        if self.directory is None:
+            return None
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with numpy.load(filename) as data:
+                if data['key'] != repr(key):
+                    return None
+                return [data['arr_%d' % i] for i in range(len(data.files) - 1)]
+        except (OSError, ValueError, KeyError) as err:
+            log.warning("KernelCache %s: cannot read %s: %s" % (self.name, filename, str(err)))
+            return None
+
+    def save(self, key, arrays):
+        """ Save the arrays for a key to disk, if a disk cache is being used
+
+        :param key: Tuple describing the entry
+        :param arrays: list of arrays
+        """
+        if self.directory is None:
+            return
+        filename = self.filename(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file and rename so that other processes never see a partial file
+            tmpname = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+            with open(tmpname, 'wb') as f:
+                numpy.savez(f, *arrays, key=repr(key))
+            os.replace(tmpname, filename)
+        except OSError as err:
+            log.warning("KernelCache %s: cannot write %s: %s" % (self.name, filename, str(err)))
+
+    def clear(self):
+        """ Remove all entries from memory and reset the statistics. The disk cache is not changed.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def statistics(self):
+        """ Statistics of cache use
+
+        :return: dict with hits, disk_hits, misses, evictions, entries, nbytes
+        """
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self.entries), 'nbytes': self.nbytes}
+
+
+def image_geometry_key(im):
+    """ Tuple describing the geometry of an image, suitable for use as part of a cache key
+
+    :param im: Image
+    :return: tuple
+    """
+    return (tuple(im.shape), str(im.data.dtype), tuple(im.wcs.wcs.ctype), tuple(im.wcs.wcs.crpix),
+            tuple(im.wcs.wcs.cdelt), tuple(im.wcs.wcs.crval))
+
+
+def phasecentre_key(phasecentre):
+    """ Tuple describing a phasecentre, suitable for use as part of a cache key
+
+    :param phasecentre: SkyCoord or None
+    :return: tuple
+    """
+    if phasecentre is None:
+        return None
+    return phasecentre.ra.deg, phasecentre.dec.deg, phasecentre.frame.name
+
+
+# Cache for the w projection kernels calculated by w_kernel_list
+w_kernel_cache = KernelCache('w_kernel')
+
+# Cache for the gridding correction functions and anti-aliasing kernels
+anti_aliasing_cache = KernelCache('anti_aliasing', max_bytes=128 * 1024 ** 2)
+
+
+def cached_anti_aliasing_calculate(shape, oversampling=1, support=3, precision='double'):
+    """ Memoized version of anti_aliasing_calculate
+
+    The gridding correction function and the oversampled kernel are calculated once for each shape, oversampling,
+    support and precision and then shared. The returned arrays are read-only: copy them before changing them.
+
+    :param shape: (height, width) pair
+    :param oversampling: Number of sub-samples per grid pixel
+    :param support: Support of kernel (in pixels) width is 2*support+2
+    :param precision: 'double' | 'single'
+    :return: gcf, kernel (both read-only)
+    """
+    shape = tuple(int(n) for n in shape)
+    key = ('anti_aliasing_calculate', shape, int(oversampling), int(support), precision)
+    
+    def calculate():
+        gcf, kernel = anti_aliasing_calculate(shape, oversampling, support)
+        return gcf.astype(real_type(precision)), kernel.astype(complex_type(precision))
+    
+    gcf, kernel = anti_aliasing_cache.get(key, calculate)
+    return gcf, kernel
@@ -108,6 +108,44 @@ def average_chunks2(arr, wts, chunksize):
     return chunks, weights
 
 
+def average_chunks_axis(arr, wts, chunksize, axis=-1):
+    """ Average the array arr with weights by chunks along one axis
+
+    This gives the same result as average_chunks applied to every one dimensional slice along the axis.
+
+    :param arr: Array of values
+    :param wts: Array of weights, broadcastable to the shape of arr
+    :param chunksize: averaging size
+    :param axis: Axis to be averaged
+    :return: Array of averaged data, array of weights
+    """
+    wts = numpy.broadcast_to(wts, arr.shape)
+    if chunksize <= 1:
+        return arr, wts
+    
+    places = numpy.arange(0, arr.shape[axis], chunksize)
+    chunks = numpy.add.reduceat(wts * arr, places, axis=axis)
+    weights = numpy.add.reduceat(wts, places, axis=axis)
+    
+    chunks[weights > 0.0] = chunks[weights > 0.0] / weights[weights > 0.0]
+    
+    return chunks, weights
+
+
+def average_chunks2_axes(arr, wts, chunksize):
+    """ Average the last two axes of arr with weights by chunks
+
+    This gives the same result as average_chunks2 applied to every two dimensional slice over the last two axes.
+
+    :param arr: Array of values [..., n0, n1]
+    :param wts: Array of weights, broadcastable to the shape of arr
+    :param chunksize: 2-tuple of averaging region e.g. (2,3)
+    :return: Array of averaged data [..., l0, l1], array of weights
+    """
+    tempchunks, tempwt = average_chunks_axis(arr, wts, chunksize[1], axis=-1)
+    return average_chunks_axis(tempchunks, tempwt, chunksize[0], axis=-2)
+
+
 def tukey_filter(x, r):
     """ Calculate the Tukey (tapered cosine) filter
     
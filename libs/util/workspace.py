@@ -0,0 +1,126 @@
+""" Pool of reusable work arrays
+
+Imaging allocates large temporary arrays (padded grids, padded images, FFT outputs) in every call. With many
+facets, w slices and channels processed by each worker this churn fragments memory. Instead, such arrays can be
+borrowed from a pool and returned when finished with, so that later calls reuse them:
+
+    grid = workspace.borrow(shape, 'complex', zero=True)
+    try:
+        ...
+    finally:
+        workspace.release(grid)
+
+A borrowed array belongs to the borrower until it is released, so the pool can be shared by threads. An array
+must not be used (or referenced by a returned result) after it has been released.
+
+By default the pool holds up to 256 MB of free arrays, e.g. one double precision grid of 4096 by 4096. For larger
+images the limit can be raised:
+
+    workspace.configure(max_bytes=4 * 1024 ** 3)
+"""
+
+import collections
+import logging
+import threading
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+class BufferPool:
+    """ Pool of reusable numpy arrays, keyed by shape and dtype
+
+    Released arrays are kept for reuse up to a total of max_bytes, beyond which they are dropped and left to the
+    garbage collector.
+    """
+
+    def __init__(self, name, max_bytes=256 * 1024 ** 2):
+        """ Create a pool
+
+        :param name: Name of pool, used in logging
+        :param max_bytes: Maximum total size of the free arrays held for reuse
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.free = collections.defaultdict(list)
+        self.nbytes = 0
+        self.allocations = 0
+        self.reuses = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "BufferPool %s: %s" % (self.name, str(self.statistics()))
+
+    @staticmethod
+    def key(shape, dtype):
+        return tuple(int(n) for n in shape), numpy.dtype(dtype).str
+
+    def configure(self, max_bytes=None):
+        """ Change the limit on the total size of the free arrays, dropping free arrays to meet a lower limit
+
+        :param max_bytes: Maximum total size of the free arrays held for reuse
+        """
+        with self.lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+                for arrays in self.free.values():
+                    while len(arrays) > 0 and self.nbytes > self.max_bytes:
+                        self.nbytes -= arrays.pop().nbytes
+
+    def borrow(self, shape, dtype='complex', zero=False):
+        """ Borrow an array from the pool, allocating a new one if none is free
+
+        :param shape: Shape of array
+        :param dtype: dtype of array
+        :param zero: Set the array to zero (otherwise the contents are undefined)
+        :return: C contiguous array
+        """
+        key = self.key(shape, dtype)
+        a = None
+        with self.lock:
+            if len(self.free[key]) > 0:
+                a = self.free[key].pop()
+                self.nbytes -= a.nbytes
+                self.reuses += 1
+            else:
+                self.allocations += 1
+        if a is None:
+            return numpy.zeros(key[0], dtype=key[1]) if zero else numpy.empty(key[0], dtype=key[1])
+        if zero:
+            a.fill(0)
+        return a
+
+    def release(self, a):
+        """ Return a borrowed array to the pool
+
+        :param a: Array from borrow
+        """
+        assert a.flags.c_contiguous and a.flags.owndata, "Only arrays from borrow can be released"
+        key = self.key(a.shape, a.dtype)
+        with self.lock:
+            if self.nbytes + a.nbytes <= self.max_bytes:
+                self.free[key].append(a)
+                self.nbytes += a.nbytes
+
+    def clear(self):
+        """ Drop all free arrays and reset the statistics
+        """
+        with self.lock:
+            self.free.clear()
+            self.nbytes = 0
+            self.allocations = 0
+            self.reuses = 0
+
+    def statistics(self):
+        """ Statistics of pool use
+
+        :return: dict with allocations, reuses, free (number of free arrays), nbytes (size of free arrays)
+        """
+        with self.lock:
+            return {'allocations': self.allocations, 'reuses': self.reuses,
+                    'free': sum(len(arrays) for arrays in self.free.values()), 'nbytes': self.nbytes}
+
+
+# Pool used by the FFT and imaging functions
+workspace = BufferPool('workspace')
@@ -21,7 +21,6 @@ from data_models.memory_data_models import BlockVisibility, GainTable, assert_vi
 
 from libs.calibration.solvers import solve_from_X
 
-from ..visibility.base import create_visibility_from_rows
 from ..calibration.operations import apply_gaintable, create_gaintable_from_blockvisibility
 from ..visibility.coalesce import convert_blockvisibility_to_visibility, decoalesce_visibility
 from ..visibility.base import copy_visibility
@@ -31,7 +30,7 @@ from ..visibility.operations import divide_visibility
 log = logging.getLogger(__name__)
 
 def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=None, phase_only=True, niter=30,
-                    tol=1e-8, crosspol=False, normalise_gains=True, **kwargs) -> GainTable:
+                    tol=1e-8, crosspol=False, normalise_gains=True, solver='itsubs', **kwargs) -> GainTable:
     """Solve a gain table by fitting an observed visibility to a model visibility
     
     If modelvis is None, a point source model is assumed.
@@ -43,6 +42,7 @@ def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=N
     :param niter: Number of iterations (default 30)
     :param tol: Iteration stops when the fractional change in the gain solution is below this tolerance
     :param crosspol: Do solutions including cross polarisations i.e. XY, YX or RL, LR
+    :param solver: Gain solver 'itsubs' (iterative substitution) or 'stefcal' (StefCal, not for crosspol)
     :return: GainTable containing solution
 
     """
@@ -61,30 +61,36 @@ def solve_gaintable(vis: BlockVisibility, modelvis: BlockVisibility = None, gt=N
     else:
         log.debug("solve_gaintable: starting from existing gaintable")
 
-    for row in range(gt.ntimes):
-        vis_rows = numpy.abs(vis.time - gt.time[row]) < gt.interval[row] / 2.0
-        if numpy.sum(vis_rows) > 0:
-            subvis = create_visibility_from_rows(vis, vis_rows)
-            if modelvis is not None:
-                model_subvis = create_visibility_from_rows(modelvis, vis_rows)
-                pointvis = divide_visibility(subvis, model_subvis)
-                x = numpy.sum(pointvis.vis * pointvis.weight, axis=0)
-                xwt = numpy.sum(pointvis.weight, axis=0)
-            else:
-                x = numpy.sum(subvis.vis * subvis.weight, axis=0)
-                xwt = numpy.sum(subvis.weight, axis=0)
-            
-            mask = numpy.abs(xwt) > 0.0
-            x_shape = x.shape
-            x[mask] = x[mask] / xwt[mask]
-            x[~mask] = 0.0
-            x = x.reshape(x_shape)
-            
-            gt = solve_from_X(gt, x, xwt, row, crosspol, niter, phase_only,
-                              tol, npol=vis.polarisation_frame.npol)
-            if normalise_gains and not phase_only:
-                gabs = numpy.average(numpy.abs(gt.data['gain'][row]))
-                gt.data['gain'][row] /= gabs
+    # Find the rows of vis for each solution interval using the time index, and then form the point source
+    # equivalents for all intervals in one grouped sum over the rows
+    vis_index = vis.time_index
+    interval_rows = [vis_index.rows_near(gt.time[row], gt.interval[row] / 2.0) for row in range(gt.ntimes)]
+    nrows = numpy.array([len(rows) for rows in interval_rows])
+    chunks = numpy.nonzero(nrows)[0]
+    if len(chunks) > 0:
+        if modelvis is not None:
+            pointvis = divide_visibility(vis, modelvis)
+        else:
+            pointvis = vis
+        vis_rows = numpy.concatenate([interval_rows[chunk] for chunk in chunks])
+        starts = numpy.cumsum(nrows[chunks]) - nrows[chunks]
+        if numpy.array_equal(vis_rows, numpy.arange(pointvis.vis.shape[0])):
+            x = numpy.add.reduceat(pointvis.vis * pointvis.weight, starts, axis=0)
+            xwt = numpy.add.reduceat(pointvis.weight, starts, axis=0)
+        else:
+            x = numpy.add.reduceat(pointvis.vis[vis_rows] * pointvis.weight[vis_rows], starts, axis=0)
+            xwt = numpy.add.reduceat(pointvis.weight[vis_rows], starts, axis=0)
+        
+        mask = numpy.abs(xwt) > 0.0
+        x[mask] = x[mask] / xwt[mask]
+        x[~mask] = 0.0
+        
+        # All intervals are solved together
+        gt = solve_from_X(gt, x, xwt, chunks, crosspol, niter, phase_only,
+                          tol, npol=vis.polarisation_frame.npol, solver=solver)
+        if normalise_gains and not phase_only:
+            gabs = numpy.average(numpy.abs(gt.data['gain'][chunks]).reshape(len(chunks), -1), axis=1)
+            gt.data['gain'][chunks] /= gabs[:, numpy.newaxis, numpy.newaxis, numpy.newaxis, numpy.newaxis]
     
     assert isinstance(gt, GainTable), "gt is not a GainTable: %r" % gt
     
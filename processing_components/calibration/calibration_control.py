@@ -30,16 +30,23 @@ def create_calibration_controls(**kwargs):
     Get this dictionary and then adjust parameters as desired
     
     The calibrate function takes a context string e.g. TGB. It then calibrates each of these Jones matrices in turn.
+    
+    The solver for each can be 'itsubs' (iterative substitution) or, for the scalar and vector shapes, 'stefcal'.
 
     :param kwargs:
     :return:
     """
 
-    controls = {'T': {'shape': 'scalar', 'timeslice': 'auto', 'phase_only': True, 'first_selfcal': 0},
-                'G': {'shape': 'vector', 'timeslice': 60.0, 'phase_only': False, 'first_selfcal': 0},
-                'P': {'shape': 'matrix', 'timeslice': 1e4, 'phase_only': False, 'first_selfcal': 0},
-                'B': {'shape': 'vector', 'timeslice': 1e5, 'phase_only': False, 'first_selfcal': 0},
-                'I': {'shape': 'vector', 'timeslice': 1.0, 'phase_only': True, 'first_selfcal': 0}}
+    controls = {'T': {'shape': 'scalar', 'timeslice': 'auto', 'phase_only': True, 'first_selfcal': 0,
+                      'solver': 'itsubs'},
+                'G': {'shape': 'vector', 'timeslice': 60.0, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': 'itsubs'},
+                'P': {'shape': 'matrix', 'timeslice': 1e4, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': 'itsubs'},
+                'B': {'shape': 'vector', 'timeslice': 1e5, 'phase_only': False, 'first_selfcal': 0,
+                      'solver': 'itsubs'},
+                'I': {'shape': 'vector', 'timeslice': 1.0, 'phase_only': True, 'first_selfcal': 0,
+                      'solver': 'itsubs'}}
 
     return controls
 
@@ -82,7 +89,8 @@ def calibrate_function(vis, model_vis, calibration_context='T', controls=None, i
             gaintables[c] = solve_gaintable(avis, amvis,
                                             timeslice=controls[c]['timeslice'],
                                             phase_only=controls[c]['phase_only'],
-                                            crosspol=controls[c]['shape'] == 'matrix')
+                                            crosspol=controls[c]['shape'] == 'matrix',
+                                            solver=controls[c].get('solver', 'itsubs'))
             log.debug('calibrate_function: Jones matrix %s, iteration %d' % (c, iteration))
             log.debug(qa_gaintable(gaintables[c], context='Jones matrix %s, iteration %d' % (c, iteration)))
             avis = apply_gaintable(avis, gaintables[c], inverse=True, timeslice=controls[c]['timeslice'])
@@ -30,12 +30,28 @@ def gaintable_null_iter(gt: GainTable, **kwargs) -> numpy.ndarray:
 
 
 def gaintable_timeslice_iter(gt: GainTable, **kwargs) -> numpy.ndarray:
-    """ W slice iterator
+    """ Time slice iterator
 
-    :param wstack: wstack (wavelengths)
-    :param gt_slices: Number of slices (second in precedence to wstack)
+    :param timeslice: 'auto' (one slice per time), None (one slice), or width of slice (seconds)
+    :param gaintable_slices: Number of slices (if timeslice is not one of the above)
     :return: Boolean array with selected rows=True
     """
+    for rows in gaintable_timeslice_index_iter(gt, **kwargs):
+        selected = numpy.zeros(gt.ntimes, dtype='bool')
+        selected[rows] = True
+        yield selected
+
+
+def gaintable_timeslice_index_iter(gt: GainTable, **kwargs) -> numpy.ndarray:
+    """ Time slice iterator yielding row indices
+
+    The rows are the same as for gaintable_timeslice_iter. They are found by binary search in the time index
+    rather than by testing every row.
+
+    :param timeslice: 'auto' (one slice per time), None (one slice), or width of slice (seconds)
+    :param gaintable_slices: Number of slices (if timeslice is not one of the above)
+    :return: Array of the indices of the selected rows
+    """
     assert isinstance(gt, GainTable)
     timemin = numpy.min(gt.time)
     timemax = numpy.max(gt.time)
@@ -58,6 +74,6 @@ def gaintable_timeslice_iter(gt: GainTable, **kwargs) -> numpy.ndarray:
         else:
             timeslice = timemax - timemin
 
+    index = gt.time_index
     for box in boxes:
-        rows = numpy.abs(gt.time - box) <= 0.5 * timeslice
-        yield rows
\ No newline at end of file
+        yield index.rows_near(box, 0.5 * timeslice, inclusive=True)
@@ -10,7 +10,7 @@ import numpy.linalg
 from data_models.memory_data_models import GainTable, BlockVisibility, QA, assert_vis_gt_compatible
 from data_models.memory_data_models import ReceptorFrame
 
-from ..visibility.iterators import vis_timeslice_iter
+from ..visibility.iterators import vis_timeslice_index_iter
 
 import logging
 
@@ -94,7 +94,9 @@ def apply_gaintable(vis: BlockVisibility, gt: GainTable, inverse=False, vis_slic
         V_corrected = {g_i * g_j^*}^-1 V_obs
         
     If the visibility data are polarised e.g. polarisation_frame("linear") then the inverse operator
-    represents an actual inverse of the gains.
+    represents an actual inverse of the gains. The 2x2 Jones matrices are applied on both sides, g_i V g_j^H, which
+    is the Mueller matrix kron(g_i, g_j^*) applied to the visibility, and agrees with it to rounding error.
+    Baselines with a singular gain are left unchanged by the inverse.
     
     :param vis: Visibility to have gains applied
     :param gt: Gaintable to be applied
@@ -116,10 +118,13 @@ def apply_gaintable(vis: BlockVisibility, gt: GainTable, inverse=False, vis_slic
     if is_scalar:
         log.debug('apply_gaintable: scalar gains')
 
-    for chunk, rows in enumerate(vis_timeslice_iter(vis, vis_slices=vis_slices)):
-        if numpy.sum(rows) > 0:
+    # The rows of each time slice are iterated as arrays of indices so that each slice costs time proportional to its
+    # own number of rows
+    gt_index = gt.time_index
+    for chunk, rows in enumerate(vis_timeslice_index_iter(vis, vis_slices=vis_slices)):
+        if len(rows) > 0:
             vistime = numpy.average(vis.time[rows])
-            gaintable_rows = abs(gt.time - vistime) < gt.interval / 2.0
+            gaintable_rows = gt_index.rows_containing(vistime)
             
             # Lookup the gain for this set of visibilities
             gain = gt.data['gain'][gaintable_rows]
@@ -129,39 +134,64 @@ def apply_gaintable(vis: BlockVisibility, gt: GainTable, inverse=False, vis_slic
             
             original = vis.vis[rows]
             applied = copy.deepcopy(original)
-            for time in range(ntimes):
-                for a1 in range(vis.nants - 1):
-                    for a2 in range(a1 + 1, vis.nants):
-                        if is_scalar:
-                            smueller = gain[time, a1, :, 0] * numpy.conjugate(gain[time, a2, :, 0])
-                            if inverse:
-                                if numpy.abs(smueller).all() > 0.0:
-                                    applied[time, a2, a1, :, 0][..., numpy.newaxis] = \
-                                        original[time, a2, a1, :, 0][..., numpy.newaxis] / smueller
-                            else:
-                                applied[time, a2, a1, :, 0][..., numpy.newaxis] = \
-                                    original[time, a2, a1, :, 0][..., numpy.newaxis] * smueller
-                        else:
-                            for chan in range(nchan):
-                                mueller = numpy.kron(gain[time, a1, chan, :, :],
-                                                     numpy.conjugate(gain[time, a2, chan, :, :]))
-                                if inverse:
-                                    # If the Mueller is singular, ignore it
-                                    try:
-                                        mueller = numpy.linalg.inv(mueller)
-                                        applied[time, a2, a1, chan, :] = \
-                                            numpy.matmul(mueller, original[time, a2, a1, chan, :])
-                                    except numpy.linalg.linalg.LinAlgError:
-                                        applied[time, a2, a1, chan, :] = \
-                                            original[time, a2, a1, chan, :]
-                                else:
-                                    applied[time, a2, a1, chan, :] = \
-                                        numpy.matmul(mueller, original[time, a2, a1, chan, :])
+            
+            # The gains are applied to all baselines a1 < a2 at once, for the times of the gaintable rows
+            a1, a2 = numpy.triu_indices(vis.nants, 1)
+            if is_scalar:
+                sgain = gain[..., 0, 0]
+                smueller = sgain[:, a1, :] * numpy.conjugate(sgain[:, a2, :])
+                # Only the first polarisation is changed
+                original_pol, applied_pol = original[..., 0], applied[..., 0]
+                if inverse:
+                    # Baselines with a zero gain in any channel are left unchanged
+                    itime, ibaseline = numpy.nonzero(numpy.all(smueller != 0.0, axis=2))
+                    ba1, ba2 = a1[ibaseline], a2[ibaseline]
+                    applied_pol[itime, ba2, ba1] = original_pol[itime, ba2, ba1] / smueller[itime, ibaseline]
+                else:
+                    applied_pol[:ntimes, a2, a1] = original_pol[:ntimes, a2, a1] * smueller
+            else:
+                # The Mueller matrix kron(g1, conjugate(g2)) applied to the visibility is the same as the Jones
+                # matrices applied on both sides, g1 V g2^H, for all times, baselines and channels. For the inverse,
+                # the Jones matrices are inverted once per antenna rather than once per baseline.
+                if inverse:
+                    # If either Jones matrix of a baseline is singular, the visibility is left unchanged
+                    gain, singular = invert_matrices(gain)
+                    singular = singular[:, a1] | singular[:, a2]
+                g1 = gain[:, a1]
+                g2h = numpy.conjugate(numpy.swapaxes(gain[:, a2], -1, -2))
+                jones_vis = original[:ntimes, a2, a1].reshape([ntimes, len(a1), nchan, nrec, nrec])
+                corrected = numpy.matmul(numpy.matmul(g1, jones_vis), g2h).reshape([ntimes, len(a1), nchan,
+                                                                                     nrec * nrec])
+                if inverse:
+                    corrected[singular] = original[:ntimes, a2, a1][singular]
+                applied[:ntimes, a2, a1] = corrected
             
             vis.data['vis'][rows] = applied
     return vis
 
 
+def invert_matrices(matrices):
+    """ Invert a stack of matrices e.g. Jones matrices, finding the singular matrices
+
+    :param matrices: Array [..., n, n]
+    :return: inverses (zero for singular matrices), boolean array [...] True for singular matrices
+    """
+    try:
+        return numpy.linalg.inv(matrices), numpy.zeros(matrices.shape[:-2], dtype='bool')
+    except numpy.linalg.LinAlgError:
+        # At least one matrix is singular so invert them one at a time
+        shape = matrices.shape
+        matrices = matrices.reshape((-1,) + shape[-2:])
+        inverse = numpy.zeros_like(matrices)
+        singular = numpy.zeros(matrices.shape[0], dtype='bool')
+        for i in range(matrices.shape[0]):
+            try:
+                inverse[i] = numpy.linalg.inv(matrices[i])
+            except numpy.linalg.LinAlgError:
+                singular[i] = True
+        return inverse.reshape(shape), singular.reshape(shape[:-2])
+
+
 def append_gaintable(gt: GainTable, othergt: GainTable) -> GainTable:
     """Append othergt to gt
 
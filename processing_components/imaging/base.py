@@ -27,6 +27,7 @@ import numpy
 from astropy import constants as constants
 from astropy import units as units
 from astropy import wcs
+from astropy.coordinates import SkyCoord
 from astropy.wcs.utils import pixel_to_skycoord
 
 from data_models.memory_data_models import Visibility, BlockVisibility, Image, Skycomponent, assert_same_chan_pol
@@ -34,10 +35,13 @@ from data_models.parameters import get_parameter
 from data_models.polarisation import convert_pol_frame, PolarisationFrame
 
 from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
-from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.direct_fourier_transform import dft_predict, dft_directions
+from libs.fourier_transforms.fft_support import fft, ifft, ifft_real, extract_mid, complex_type, real_type
 from libs.image.operations import create_image_from_array
-from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list
+from libs.imaging.gridding_plan import get_gridding_plan, BlockVisibilityRows
+from libs.imaging.imaging_params import get_frequency_map
 from libs.util.coordinate_support import simulate_point, skycoord_to_lmn
+from libs.util.workspace import workspace
 
 from ..visibility.base import copy_visibility, phaserotate_visibility
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility, convert_blockvisibility_to_visibility
@@ -80,6 +84,48 @@ def shift_vis_to_image(vis: Visibility, im: Image, tangent: bool = True, inverse
     return vis
 
 
+def shift_rows_to_image(rows: BlockVisibilityRows, visdata: numpy.ndarray, im: Image, inverse: bool = False) \
+        -> numpy.ndarray:
+    """Shift the rows of a BlockVisibility to the FFT phase centre of the image in place
+
+    This is the equivalent of shift_vis_to_image (with tangent=True) for visibility data taken from a
+    BlockVisibility by BlockVisibilityRows.gather.
+
+    :param rows: BlockVisibilityRows
+    :param visdata: Visibility data for the rows [nvis, npol]
+    :param im: Image model used to determine phase centre
+    :param inverse: Do the inverse operation True|False
+    :return: visdata with phase shift applied
+    """
+    nchan, npol, ny, nx = im.data.shape
+    image_phasecentre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
+    if rows.phasecentre.separation(image_phasecentre).rad > 1e-15:
+        l, m, n = skycoord_to_lmn(image_phasecentre, rows.phasecentre)
+        if numpy.abs(n) > 1e-15:
+            phasor = simulate_point(rows.uvw, l, m)[:, numpy.newaxis]
+            if inverse:
+                visdata *= phasor
+            else:
+                visdata *= numpy.conj(phasor)
+    return visdata
+
+
+def grid_blocks_directly(vis, **kwargs) -> bool:
+    """ Is vis a BlockVisibility to be gridded directly, rather than coalesced to a Visibility?
+
+    This is opt-in, by block_gridding=True, and only if no coalescence is asked for (by time_coal or
+    frequency_coal, see coalesce_visibility). Predictions written directly into the block differ from those of
+    decoalesce_visibility outside the cross-correlations: the autocorrelations are set to zero and the transposed
+    baselines to the conjugates (see BlockVisibilityRows.scatter).
+
+    :param vis: Visibility or BlockVisibility
+    :param block_gridding: Grid a BlockVisibility directly (False)
+    :return: True|False
+    """
+    return isinstance(vis, BlockVisibility) and get_parameter(kwargs, 'block_gridding', False) and \
+        get_parameter(kwargs, 'time_coal', 0.0) == 0.0 and get_parameter(kwargs, 'frequency_coal', 0.0) == 0.0
+
+
 def normalize_sumwt(im: Image, sumwt) -> Image:
     """Normalize out the sum of weights
 
@@ -107,31 +153,55 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms of
     this function. Any shifting needed is performed here.
 
-    :param vis: Visibility to be predicted
+    A BlockVisibility is degridded directly if block_gridding is True (see grid_blocks_directly). The
+    predictions for the cross-correlations are then written into the block (see BlockVisibilityRows.scatter).
+
+    :param vis: Visibility or BlockVisibility to be predicted
     :param model: model image
+    :param gridding_engine: Engine used for degridding 'auto' | 'loop' | 'numpy' | 'numba' (see gridding_engine)
+    :param nthreads: Number of threads used for degridding (1). Only faster with the numba engine, which releases
+        the GIL.
+    :param gridding_plan: Precalculated GriddingPlan (optional, see get_gridding_plan)
+    :param precision: Precision of kernels, grid and FFT 'double' | 'single' ('double')
+    :param block_gridding: Degrid a BlockVisibility directly, without coalescence (False)
     :return: resulting visibility (in place works)
     """
-    if isinstance(vis, BlockVisibility):
+    if grid_blocks_directly(vis, **kwargs):
+        # Degrid the cross-correlations of the BlockVisibility directly, without coalescence
+        avis = BlockVisibilityRows(vis)
+    elif isinstance(vis, BlockVisibility):
         log.debug("imaging.predict: coalescing prior to prediction")
         avis = coalesce_visibility(vis, **kwargs)
     else:
         avis = vis
     
-    assert isinstance(avis, Visibility), avis
+    assert isinstance(avis, (Visibility, BlockVisibilityRows)), avis
     
     _, _, ny, nx = model.data.shape
     
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(avis, model)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(avis, model, **kwargs)
-    
-    uvgrid = fft((pad_mid(model.data, int(round(padding * nx))) * gcf).astype(dtype=complex))
-    
-    avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
+    plan = get_gridding_plan(avis, model, **kwargs)
+    vshape = [avis.nvis, avis.npol] if isinstance(avis, BlockVisibilityRows) else avis.data['vis'].shape
+    
+    # The padded grid is borrowed from the workspace pool: pad, apply the gridding correction and FFT in place
+    precision = get_parameter(kwargs, "precision", 'double')
+    uvgrid = workspace.borrow(plan.shape, complex_type(precision), zero=True)
+    try:
+        extract_mid(uvgrid, npixel=nx)[...] = model.data * extract_mid(plan.gcf, npixel=nx)
+        uvgrid = fft(uvgrid, out=uvgrid)
+        visdata = convolutional_degrid(plan.kernel_list, vshape, uvgrid, plan.vuvwmap, plan.vfrequencymap,
+                                       engine=get_parameter(kwargs, "gridding_engine", 'auto'),
+                                       nthreads=get_parameter(kwargs, "nthreads", 1),
+                                       grid_coords=plan.grid_coords)
+    finally:
+        workspace.release(uvgrid)
+    
+    if isinstance(avis, BlockVisibilityRows):
+        # Shift from the image frame to the original visibility frame and write straight into the block
+        visdata = shift_rows_to_image(avis, visdata, model, inverse=True)
+        avis.scatter(visdata, vis.data['vis'])
+        return vis
+    
+    avis.data['vis'] = visdata
     
     # Now we can shift the visibility from the image frame to the original visibility frame
     svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
@@ -152,48 +222,75 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
     of this function. . Any shifting needed is performed here.
 
-    :param vis: Visibility to be inverted
+    A BlockVisibility is gridded directly if block_gridding is True (see grid_blocks_directly).
+
+    :param vis: Visibility or BlockVisibility to be inverted
     :param im: image template (not changed)
     :param dopsf: Make the psf instead of the dirty image
     :param normalize: Normalize by the sum of weights (True)
+    :param gridding_engine: Engine used for gridding 'auto' | 'loop' | 'numpy' | 'numba' (see gridding_engine)
+    :param nthreads: Number of threads used for gridding (1). The result does not depend on the number of threads.
+        Only faster with the numba engine, which releases the GIL.
+    :param gridding_plan: Precalculated GriddingPlan (optional, see get_gridding_plan)
+    :param precision: Precision of kernels, grid and FFT 'double' | 'single' ('double'). The image has the same
+        precision.
+    :param block_gridding: Grid a BlockVisibility directly, without coalescence (False)
     :return: resulting image
 
     """
-    if not isinstance(vis, Visibility):
-        svis = coalesce_visibility(vis, **kwargs)
+    if grid_blocks_directly(vis, **kwargs):
+        # Grid the cross-correlations of the BlockVisibility directly. As for coalesce_visibility, the imaging
+        # weights are unity.
+        svis = BlockVisibilityRows(vis)
+        if dopsf:
+            visdata = numpy.ones([svis.nvis, svis.npol], dtype='complex')
+        else:
+            visdata = svis.gather(vis.data['vis'])
+        visdata = shift_rows_to_image(svis, visdata, im, inverse=False)
+        visweights = numpy.ones([svis.nvis, svis.npol])
     else:
-        svis = copy_visibility(vis)
-    
-    if dopsf:
-        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
-    
-    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+        if not isinstance(vis, Visibility):
+            svis = coalesce_visibility(vis, **kwargs)
+        else:
+            svis = copy_visibility(vis)
+        
+        if dopsf:
+            svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+        
+        svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+        visdata, visweights = svis.data['vis'], svis.data['imaging_weight']
     
     nchan, npol, ny, nx = im.data.shape
     
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
-    
-    # Optionally pad to control aliasing
-    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype='complex')
-    imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
-                                          vuvwmap, vfrequencymap)
-    
-    # Fourier transform the padded grid to image, multiply by the gridding correction
-    # function, and extract the unpadded inner part.
-    
-    # Normalise weights for consistency with transform
-    sumwt /= float(padding * int(round(padding * nx)) * ny)
+    plan = get_gridding_plan(svis, im, **kwargs)
+    padding = plan.padding
+    gcf = plan.gcf
+    
+    # Optionally pad to control aliasing. The padded grid is borrowed from the workspace pool and transformed
+    # in place.
+    imgridpad = workspace.borrow(plan.shape, complex_type(get_parameter(kwargs, "precision", 'double')), zero=True)
+    try:
+        imgridpad, sumwt = convolutional_grid(plan.kernel_list, imgridpad, visdata, visweights, plan.vuvwmap,
+                                              plan.vfrequencymap,
+                                              engine=get_parameter(kwargs, "gridding_engine", 'auto'),
+                                              nthreads=get_parameter(kwargs, "nthreads", 1),
+                                              grid_coords=plan.grid_coords)
+        
+        # Normalise weights for consistency with transform
+        sumwt /= float(padding * int(round(padding * nx)) * ny)
+        
+        # Fourier transform the padded grid to image, extract the unpadded inner part, and multiply by the
+        # gridding correction function.
+        imaginary = get_parameter(kwargs, "imaginary", False)
+        if imaginary:
+            log.debug("invert_2d: retaining imaginary part of dirty image")
+            result = extract_mid(ifft(imgridpad, out=imgridpad), npixel=nx) * extract_mid(gcf, npixel=nx)
+        else:
+            result = extract_mid(ifft_real(imgridpad, overwrite_a=True), npixel=nx) * extract_mid(gcf, npixel=nx)
+    finally:
+        workspace.release(imgridpad)
     
-    imaginary = get_parameter(kwargs, "imaginary", False)
     if imaginary:
-        log.debug("invert_2d: retaining imaginary part of dirty image")
-        result = extract_mid(ifft(imgridpad) * gcf, npixel=nx)
         resultreal = create_image_from_array(result.real, im.wcs, im.polarisation_frame)
         resultimag = create_image_from_array(result.imag, im.wcs, im.polarisation_frame)
         if normalize:
@@ -201,39 +298,70 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
             resultimag = normalize_sumwt(resultimag, sumwt)
         return resultreal, sumwt, resultimag
     else:
-        result = extract_mid(numpy.real(ifft(imgridpad)) * gcf, npixel=nx)
         resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
         if normalize:
             resultimage = normalize_sumwt(resultimage, sumwt)
         return resultimage, sumwt
 
 
+def skycomponent_directions(vis: Union[Visibility, BlockVisibility], sc: List[Skycomponent]) -> numpy.ndarray:
+    """ Direction vectors of Skycomponents relative to the phasecentre of a visibility, as used by dft_predict
+
+    :param vis: Visibility or BlockVisibility
+    :param sc: list of Skycomponents
+    :return: Array [ncomp, 3]
+    """
+    try:
+        l, m, _ = skycoord_to_lmn(SkyCoord([comp.direction for comp in sc]), vis.phasecentre)
+    except (ValueError, TypeError):
+        # The directions cannot be combined into one SkyCoord e.g. they are in different frames
+        l, m, _ = numpy.array([skycoord_to_lmn(comp.direction, vis.phasecentre) for comp in sc]).T
+    return dft_directions(l, m)
+
+
 def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
-                                    sc: Union[Skycomponent, List[Skycomponent]]) -> Union[Visibility, BlockVisibility]:
+                                    sc: Union[Skycomponent, List[Skycomponent]], **kwargs) \
+        -> Union[Visibility, BlockVisibility]:
     """Predict the visibility from a Skycomponent, add to existing visibility, for Visibility or BlockVisibility
 
+    All components are predicted together by direct Fourier transform (see dft_predict), in chunks of visibilities
+    and components.
+
     :param vis: Visibility or BlockVisibility
     :param sc: Skycomponent or list of SkyComponents
+    :param nthreads: Number of threads (1)
+    :param dft_chunk_bytes: Maximum size of the phasors for a chunk of visibilities and components (16MB)
     :return: Visibility or BlockVisibility
     """
     if not isinstance(sc, collections.Iterable):
         sc = [sc]
+    sc = list(sc)
+    if len(sc) == 0:
+        return vis
+
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    max_chunk_bytes = get_parameter(kwargs, "dft_chunk_bytes", 16 * 1024 ** 2)
 
     if isinstance(vis, Visibility):
     
         _, im_nchan = list(get_frequency_map(vis, None))
-        npol = vis.polarisation_frame.npol
+        im_nchan = numpy.array(im_nchan)
         
         for comp in sc:
             assert isinstance(comp, Skycomponent), comp
-
             assert_same_chan_pol(vis, comp)
-            
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            phasor = simulate_point(vis.uvw, l, m)
-            for ivis in range(vis.nvis):
-                for pol in range(npol):
-                    vis.data['vis'][ivis, pol] += comp.flux[im_nchan[ivis], pol] * phasor[ivis]
+        
+        directions = skycomponent_directions(vis, sc)
+        flux = numpy.array([comp.flux for comp in sc])
+        for chan in numpy.unique(im_nchan):
+            rows = im_nchan == chan
+            if numpy.all(rows):
+                dft_predict(vis.data['vis'], vis.uvw, directions, flux[:, chan, :], nthreads=nthreads,
+                            max_chunk_bytes=max_chunk_bytes)
+            else:
+                vis.data['vis'][rows] = dft_predict(vis.data['vis'][rows], vis.uvw[rows], directions,
+                                                    flux[:, chan, :], nthreads=nthreads,
+                                                    max_chunk_bytes=max_chunk_bytes)
                 
     elif isinstance(vis, BlockVisibility):
         
@@ -241,21 +369,22 @@ def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
     
         k = numpy.array(vis.frequency) / constants.c.to('m s^-1').value
     
+        flux = list()
         for comp in sc:
-#            assert isinstance(comp, Skycomponent), comp
             assert_same_chan_pol(vis, comp)
-    
-            flux = comp.flux
             if comp.polarisation_frame != vis.polarisation_frame:
-                flux = convert_pol_frame(flux, comp.polarisation_frame, vis.polarisation_frame)
+                flux.append(convert_pol_frame(comp.flux, comp.polarisation_frame, vis.polarisation_frame))
+            else:
+                flux.append(comp.flux)
+        flux = numpy.array(flux)
         
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            uvw = vis.uvw[..., numpy.newaxis] * k
-            phasor = numpy.ones([ntimes, nant, nant, nchan, npol], dtype='complex')
-            for chan in range(nchan):
-                phasor[:,:,:,chan,:] = simulate_point(uvw[...,chan], l, m)[...,numpy.newaxis]
-                
-            vis.data['vis'][..., :, :] += flux[:, :] * phasor[..., :]
+        directions = skycomponent_directions(vis, sc)
+        uvw = vis.uvw.reshape([ntimes * nant * nant, 3])
+        for chan in range(nchan):
+            cvis = numpy.zeros([ntimes * nant * nant, npol], dtype='complex')
+            dft_predict(cvis, uvw * k[chan], directions, flux[:, chan, :], nthreads=nthreads,
+                        max_chunk_bytes=max_chunk_bytes)
+            vis.data['vis'][..., chan, :] += cvis.reshape([ntimes, nant, nant, npol])
 
     return vis
 
@@ -274,6 +403,7 @@ def create_image_from_visibility(vis, **kwargs) -> Image:
     :param frame: Coordinate frame for WCS (ICRS)
     :param equinox: Equinox for WCS (2000.0)
     :param nchan: Number of image channels (Default is 1 -> MFS)
+    :param precision: Precision of the image pixels 'double' | 'single' ('double')
     :return: image
     """
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), \
@@ -356,7 +486,8 @@ def create_image_from_visibility(vis, **kwargs) -> Image:
     w.wcs.radesys = get_parameter(kwargs, 'frame', 'ICRS')
     w.wcs.equinox = get_parameter(kwargs, 'equinox', 2000.0)
     
-    return create_image_from_array(numpy.zeros(shape), wcs=w, polarisation_frame=pol_frame)
+    return create_image_from_array(numpy.zeros(shape, dtype=real_type(get_parameter(kwargs, "precision", 'double'))),
+                                   wcs=w, polarisation_frame=pol_frame)
 
 
 def residual_image(vis: Visibility, model: Image, invert_residual=invert_2d, predict_residual=predict_2d,
@@ -0,0 +1,136 @@
+"""
+Imaging using image domain gridding (see libs.fourier_transforms.image_domain_gridding). The w term is applied
+exactly to each visibility in the image domain of small subgrids, so unlike w projection no w kernels are needed,
+and unlike w stacking no w planes. This is most useful for long baselines with large w, where the w projection
+kernels become very large.
+"""
+
+import logging
+
+import numpy
+
+from data_models.memory_data_models import Visibility, Image, BlockVisibility
+from data_models.parameters import get_parameter
+
+from libs.fourier_transforms.fft_support import fft, ifft_real, extract_mid, complex_type
+from libs.fourier_transforms.image_domain_gridding import idg_grid, idg_degrid, idg_correction, idg_subgrid_size
+from libs.image.operations import create_image_from_array
+from libs.imaging.imaging_params import get_frequency_map, get_uvw_map
+from libs.util.workspace import workspace
+
+from ..visibility.base import copy_visibility
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+from .base import shift_vis_to_image, normalize_sumwt
+
+log = logging.getLogger(__name__)
+
+
+def idg_parameters(vis: Visibility, im: Image, **kwargs):
+    """ Grid geometry and visibility information needed by idg_grid and idg_degrid
+
+    :param vis: Visibility
+    :param im: Image
+    :param padding: Padding factor (2)
+    :return: shape of padded grid, padding, vuvwmap, vfrequencymap, baselines, field of view
+    """
+    nchan, npol, ny, nx = im.data.shape
+    padding = get_parameter(kwargs, "padding", 2)
+    _, vfrequencymap = get_frequency_map(vis, im)
+    _, _, padding, vuvwmap = get_uvw_map(vis, im, padding=padding)
+    shape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    nants = max(numpy.max(vis.antenna1), numpy.max(vis.antenna2)) + 1
+    baselines = vis.antenna1 * nants + vis.antenna2
+    field_of_view = shape[3] * numpy.abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    return shape, padding, vuvwmap, vfrequencymap, baselines, field_of_view
+
+
+def invert_idg(vis: Visibility, im: Image, dopsf=False, normalize=True, **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using image domain gridding
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param padding: Padding factor (2)
+    :param subgrid_size: Minimum size of the IDG subgrids (32), increased if needed for the w term
+    :param idg_batch: Number of visibilities processed at once (2048)
+    :param precision: Precision of grid and FFT 'double' | 'single' ('double')
+    :return: resulting image, sum of weights
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    if dopsf:
+        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    nchan, npol, ny, nx = im.data.shape
+    shape, padding, vuvwmap, vfrequencymap, baselines, field_of_view = idg_parameters(svis, im, **kwargs)
+
+    grid = workspace.borrow(shape, complex_type(get_parameter(kwargs, "precision", 'double')), zero=True)
+    try:
+        grid, sumwt, subgrid_size = idg_grid(grid, svis.data['vis'], svis.data['imaging_weight'], vuvwmap,
+                                             vfrequencymap, svis.w, baselines, field_of_view,
+                                             subgrid_size=get_parameter(kwargs, "subgrid_size", 32),
+                                             batch=get_parameter(kwargs, "idg_batch", 2048))
+        correction = extract_mid(idg_correction(shape[2:], subgrid_size), npixel=nx)
+        result = extract_mid(ifft_real(grid, overwrite_a=True), npixel=nx) * correction
+    finally:
+        workspace.release(grid)
+
+    # Normalise weights for consistency with transform
+    sumwt /= float(padding * int(round(padding * nx)) * ny)
+
+    resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
+def predict_idg(vis: Visibility, model: Image, **kwargs) -> Visibility:
+    """ Predict using image domain gridding
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param padding: Padding factor (2)
+    :param subgrid_size: Minimum size of the IDG subgrids (32), increased if needed for the w term
+    :param idg_batch: Number of visibilities processed at once (2048)
+    :param precision: Precision of grid and FFT 'double' | 'single' ('double')
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_idg: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+
+    assert isinstance(avis, Visibility), avis
+
+    _, _, ny, nx = model.data.shape
+    shape, padding, vuvwmap, vfrequencymap, baselines, field_of_view = idg_parameters(avis, model, **kwargs)
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+
+    grid = workspace.borrow(shape, complex_type(get_parameter(kwargs, "precision", 'double')), zero=True)
+    try:
+        # The taper correction depends on the subgrid size, which depends on w
+        subgrid_size, _ = idg_subgrid_size(numpy.max(numpy.abs(avis.w)), field_of_view, subgrid_size)
+        correction = extract_mid(idg_correction(shape[2:], subgrid_size), npixel=nx)
+        extract_mid(grid, npixel=nx)[...] = model.data * correction
+        grid = fft(grid, out=grid)
+        avis.data['vis'], _ = idg_degrid(grid, avis.data['vis'].shape, vuvwmap, vfrequencymap, avis.w, baselines,
+                                         field_of_view, subgrid_size=subgrid_size,
+                                         batch=get_parameter(kwargs, "idg_batch", 2048))
+    finally:
+        workspace.release(grid)
+
+    # Now we can shift the visibility from the image frame to the original visibility frame
+    svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+
+    if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+        log.debug("predict_idg: decoalescing post prediction")
+        return decoalesce_visibility(svis)
+    else:
+        return svis
@@ -14,8 +14,8 @@ from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 
 from libs.fourier_transforms.convolutional_gridding import weight_gridding
-from libs.imaging.imaging_params import get_polarisation_map, get_uvw_map
-from libs.imaging.imaging_params import get_frequency_map
+from libs.imaging.gridding_plan import get_gridding_plan
+from libs.imaging.imaging_params import get_polarisation_map
 
 def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
     """ Reweight the visibility data using a selected algorithm
@@ -32,21 +32,28 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
 
     :param vis:
     :param im:
+    :param weighting: 'natural' | 'uniform' | 'super-uniform' | 'briggs' | 'super-briggs' ('uniform')
+    :param robustness: Briggs robustness, -2 (close to uniform) to 2 (close to natural) (0.0)
+    :param superuniform_box: Full width in cells of the box for super-uniform and super-briggs (3)
+    :param gridding_plan: Precalculated GriddingPlan (optional, see get_gridding_plan)
     :return: visibility with imaging_weights column added and filled
     """
     assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
     
     assert get_parameter(kwargs, "padding", False) is False
-    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    plan = get_gridding_plan(vis, im, **kwargs)
     polarisation_mode, vpolarisationmap = get_polarisation_map(vis, im)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
     
     density = None
     densitygrid = None
     
     weighting = get_parameter(kwargs, "weighting", "uniform")
-    vis.data['imaging_weight'], density, densitygrid = weight_gridding(im.data.shape, vis.data['weight'], vuvwmap,
-                                                                       vfrequencymap, vpolarisationmap, weighting)
+    robustness = get_parameter(kwargs, "robustness", 0.0)
+    superuniform_box = get_parameter(kwargs, "superuniform_box", 3)
+    vis.data['imaging_weight'], density, densitygrid = weight_gridding(im.data.shape, vis.data['weight'],
+                                                                       plan.vuvwmap, plan.vfrequencymap,
+                                                                       vpolarisationmap, weighting,
+                                                                       robustness, superuniform_box)
     
     return vis, density, densitygrid
 
@@ -0,0 +1,205 @@
+"""
+W stacking in a single pass over the visibility data. The visibilities are assigned to w planes as in
+vis_wslice_iter, but instead of imaging each slice separately, all visibilities are gridded in one pass onto a
+stack of grids (one per occupied w plane), the grids are Fourier transformed as a batch, and the w beam for
+each plane is applied in the image plane:
+
+.. math::
+
+    V(u,v,w) =\\sum_i \\int \\frac{ I(l,m) e^{-2 \\pi j (w_i(\\sqrt{1-l^2-m^2}-1))})}{\\sqrt{1-l^2-m^2}} e^{-2 \\pi j (ul+vm)} dl dm
+
+The results agree with the wstack context (to rounding error) without making a Visibility for each slice.
+"""
+
+import logging
+
+import numpy
+
+from data_models.memory_data_models import Visibility, Image, BlockVisibility
+from data_models.parameters import get_parameter
+
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
+from libs.fourier_transforms.fft_support import fft, ifft, extract_mid, complex_type, real_type
+from libs.image.operations import create_image_from_array, create_w_term_like
+from libs.imaging.gridding_plan import get_gridding_plan
+from libs.util.workspace import workspace
+
+from ..visibility.base import copy_visibility
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+from .base import shift_vis_to_image, normalize_sumwt
+
+log = logging.getLogger(__name__)
+
+
+def w_plane_map(vis: Visibility, vis_slices=1):
+    """ Assign each row of a visibility to a w plane, in the same way as vis_wslice_iter
+
+    :param vis: Visibility
+    :param vis_slices: Number of w planes
+    :return: plane index for each row, boolean array of rows in a plane, average w of each plane
+    """
+    assert isinstance(vis, Visibility), vis
+    w = vis.w
+    wmaxabs = numpy.max(numpy.abs(w))
+
+    boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
+    if vis_slices > 1:
+        wstack = boxes[1] - boxes[0]
+    else:
+        wstack = 2 * wmaxabs
+
+    if wstack > 0.0:
+        plane = numpy.clip(numpy.round((w - boxes[0]) / wstack).astype('int'), 0, vis_slices - 1)
+        inplane = numpy.abs(w - boxes[plane]) < 0.5 * wstack
+        # Rounding can put a row at the edge of a box into the neighbouring plane
+        for shift in [-1, 1]:
+            neighbour = numpy.clip(plane + shift, 0, vis_slices - 1)
+            move = numpy.logical_not(inplane) & (numpy.abs(w - boxes[neighbour]) < 0.5 * wstack)
+            plane[move] = neighbour[move]
+            inplane |= move
+    else:
+        plane = numpy.zeros(len(w), dtype='int')
+        inplane = numpy.ones(len(w), dtype='bool')
+
+    count = numpy.bincount(plane[inplane], minlength=vis_slices)
+    wsum = numpy.bincount(plane[inplane], weights=w[inplane], minlength=vis_slices)
+    w_average = numpy.zeros(vis_slices)
+    w_average[count > 0] = wsum[count > 0] / count[count > 0]
+    return plane, inplane, w_average
+
+
+def w_plane_coordinates(plan, plane, occupied, nchan):
+    """ Grid coordinates for a stack of w planes: the channel index selects both the plane and the channel
+
+    :param plan: GriddingPlan for the visibility
+    :param plane: plane index for each row
+    :param occupied: indices of the occupied planes
+    :param nchan: Number of image channels
+    :return: grid coordinates as from grid_coordinates
+    """
+    stack_index = numpy.zeros(numpy.max(occupied) + 1, dtype='int')
+    stack_index[occupied] = numpy.arange(len(occupied))
+    chan = stack_index[plane] * nchan + plan.grid_coords[0]
+    return (chan,) + tuple(plan.grid_coords[1:])
+
+
+def invert_wstack_native(vis: Visibility, im: Image, dopsf=False, normalize=True, vis_slices=1, **kwargs) \
+        -> (Image, numpy.ndarray):
+    """ Invert using w stacking, gridding all w planes in a single pass
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param vis_slices: Number of w planes
+    :param kwargs: Parameters for gridding as for invert_2d e.g. padding, wstep, gridding_engine, nthreads, precision
+    :return: resulting image, sum of weights
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    if dopsf:
+        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+
+    # Remove the average w of each plane, and drop rows outside all planes
+    plane, inplane, w_average = w_plane_map(svis, vis_slices)
+    svis.data['uvw'][..., 2] -= w_average[plane]
+    svis.data['imaging_weight'][numpy.logical_not(inplane)] = 0.0
+    occupied = numpy.unique(plane[inplane])
+    assert len(occupied) > 0, "No valid data found for imaging"
+    log.debug("invert_wstack_native: gridding %d w planes in a single pass" % len(occupied))
+
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    nchan, npol, ny, nx = im.data.shape
+    plan = get_gridding_plan(svis, im, **kwargs)
+    precision = get_parameter(kwargs, "precision", 'double')
+
+    stack_shape = [len(occupied) * nchan] + list(plan.shape[1:])
+    gridstack = workspace.borrow(stack_shape, complex_type(precision), zero=True)
+    try:
+        gridstack, sumwt = convolutional_grid(plan.kernel_list, gridstack, svis.data['vis'],
+                                              svis.data['imaging_weight'], plan.vuvwmap, plan.vfrequencymap,
+                                              engine=get_parameter(kwargs, "gridding_engine", 'auto'),
+                                              nthreads=get_parameter(kwargs, "nthreads", 1),
+                                              grid_coords=w_plane_coordinates(plan, plane, occupied, nchan))
+        sumwt = numpy.sum(sumwt.reshape([len(occupied), nchan, npol]), axis=0)
+        sumwt /= float(plan.padding * int(round(plan.padding * nx)) * ny)
+
+        # Transform all planes at once, then apply the w beam of each plane and sum
+        gridstack = ifft(gridstack, out=gridstack)
+        gcf = extract_mid(plan.gcf, npixel=nx)
+        result = numpy.zeros(im.shape, dtype=real_type(precision))
+        for i, p in enumerate(occupied):
+            image = extract_mid(gridstack[i * nchan:(i + 1) * nchan], npixel=nx) * gcf
+            w_beam = create_w_term_like(im, w_average[p], vis.phasecentre)
+            result += w_beam.data.real * image.real - w_beam.data.imag * image.imag
+    finally:
+        workspace.release(gridstack)
+
+    resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
+def predict_wstack_native(vis: Visibility, model: Image, vis_slices=1, **kwargs) -> Visibility:
+    """ Predict using w stacking, degridding from all w planes in a single pass
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param vis_slices: Number of w planes
+    :param kwargs: Parameters for degridding as for predict_2d e.g. padding, wstep, gridding_engine, nthreads,
+        precision
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_wstack_native: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+
+    assert isinstance(avis, Visibility), avis
+
+    # The gridding is done on a copy with the average w of each plane removed
+    plane, inplane, w_average = w_plane_map(avis, vis_slices)
+    wvis = copy_visibility(avis, zero=True)
+    wvis.data['uvw'][..., 2] -= w_average[plane]
+    occupied = numpy.unique(plane[inplane])
+    assert len(occupied) > 0, "No valid data found for prediction"
+    log.debug("predict_wstack_native: degridding %d w planes in a single pass" % len(occupied))
+
+    nchan, npol, ny, nx = model.data.shape
+    plan = get_gridding_plan(wvis, model, **kwargs)
+    precision = get_parameter(kwargs, "precision", 'double')
+
+    # Apply the conjugate w beam of each plane to the model, pad, and transform all planes at once
+    stack_shape = [len(occupied) * nchan] + list(plan.shape[1:])
+    gridstack = workspace.borrow(stack_shape, complex_type(precision), zero=True)
+    try:
+        gcf = extract_mid(plan.gcf, npixel=nx)
+        for i, p in enumerate(occupied):
+            w_beam = create_w_term_like(model, w_average[p], vis.phasecentre)
+            extract_mid(gridstack[i * nchan:(i + 1) * nchan], npixel=nx)[...] = \
+                numpy.conjugate(w_beam.data) * model.data * gcf
+        gridstack = fft(gridstack, out=gridstack)
+        wvis.data['vis'] = convolutional_degrid(plan.kernel_list, wvis.data['vis'].shape, gridstack, plan.vuvwmap,
+                                                plan.vfrequencymap,
+                                                engine=get_parameter(kwargs, "gridding_engine", 'auto'),
+                                                nthreads=get_parameter(kwargs, "nthreads", 1),
+                                                grid_coords=w_plane_coordinates(plan, plane, occupied, nchan))
+    finally:
+        workspace.release(gridstack)
+    wvis.data['vis'][numpy.logical_not(inplane)] = 0.0
+
+    # Now we can shift the visibility from the image frame to the original visibility frame
+    wvis = shift_vis_to_image(wvis, model, tangent=True, inverse=True)
+    avis.data['vis'] = wvis.data['vis']
+
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_wstack_native: decoalescing post prediction")
+        return decoalesce_visibility(avis)
+    else:
+        return avis
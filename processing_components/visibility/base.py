@@ -37,6 +37,8 @@ def copy_visibility(vis: Union[Visibility, BlockVisibility], zero=False) -> Unio
     if isinstance(vis, Visibility):
         newvis.cindex = vis.cindex
         newvis.blockvis = vis.blockvis
+    else:
+        newvis.coalescence_plans = dict(getattr(vis, 'coalescence_plans', dict()))
     if zero:
         newvis.data['vis'][...] = 0.0
     return newvis
@@ -46,7 +48,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
                       channel_bandwidth, phasecentre: SkyCoord,
                       weight: float, polarisation_frame=PolarisationFrame('stokesI'),
                       integration_time=1.0,
-                      zerow=False) -> Visibility:
+                      zerow=False, precision='double') -> Visibility:
     """ Create a Visibility from Configuration, hour angles, and direction of source
 
     Note that we keep track of the integration time for BDA purposes
@@ -59,6 +61,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
     :param channel_bandwidth: channel bandwidths: (Hz] [nchan]
     :param integration_time: Integration time ('auto' or value in s)
     :param polarisation_frame: PolarisationFrame('stokesI')
+    :param precision: Precision of the vis, weight and imaging_weight columns 'double' | 'single'
     :return: Visibility
     """
     assert phasecentre is not None, "Must specify phase centre"
@@ -115,7 +118,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
                      frequency=rfrequency, vis=rvis,
                      weight=rweight, imaging_weight=rweight,
                      integration_time=rintegration_time, channel_bandwidth=rchannel_bandwidth,
-                     polarisation_frame=polarisation_frame)
+                     polarisation_frame=polarisation_frame, precision=precision)
     vis.phasecentre = phasecentre
     vis.configuration = config
     log.info("create_visibility: %s" % (vis_summary(vis)))
@@ -191,48 +194,69 @@ def create_blockvisibility(config: Configuration,
     return vis
 
 
+def count_rows(rows: numpy.ndarray) -> int:
+    """ Number of rows selected by a boolean array or an array of row indices
+
+    :param rows: Boolean array of row selection, or array of row indices
+    :return: Number of rows
+    """
+    if rows.dtype == bool:
+        return int(numpy.sum(rows))
+    return len(rows)
+
+
+def rows_slice(rows: numpy.ndarray):
+    """ The slice equivalent to a selection of rows, if the rows are a contiguous range
+
+    :param rows: Boolean array of row selection, or array of row indices
+    :return: slice, or None if the rows are not a contiguous range
+    """
+    if rows.dtype == bool:
+        rows = numpy.nonzero(rows)[0]
+    if len(rows) == 0 or rows[0] < 0:
+        return None
+    start, stop = int(rows[0]), int(rows[-1]) + 1
+    if stop - start == len(rows) and numpy.all(numpy.diff(rows) == 1):
+        return slice(start, stop)
+    return None
+
+
 def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility], rows: numpy.ndarray, makecopy=True) \
-        -> None:
+        -> Union[Visibility, BlockVisibility]:
     """ Create a Visibility from selected rows
 
+    Only the selected rows are copied. If makecopy is False and the rows are a contiguous range, no data is copied:
+    the data of the new Visibility is a view on the data of vis, so changes to either are seen in both. Rows that are
+    not a contiguous range are always copied.
+
     :param vis: Visibility
-    :param rows: Boolean array of row selction
-    :param makecopy: Make a deep copy (True)
+    :param rows: Boolean array of row selction, or array of row indices
+    :param makecopy: Make a copy of the rows even if they could be a view (True)
     :return: Visibility
     """
     
-    if rows is None or numpy.sum(rows) == 0:
+    if rows is None or count_rows(rows) == 0:
         return None
     
-    assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
+    if rows.dtype == bool:
+        assert len(rows) == vis.nvis, "Length of rows does not agree with length of visibility"
+    
+    newvis = copy.copy(vis)
+    # Indexing with an array of rows always copies, and indexing with a slice gives a view
+    view = None if makecopy else rows_slice(rows)
+    if view is not None:
+        newvis.data = vis.data[view]
+    else:
+        newvis.data = vis.data[rows]
     
     if isinstance(vis, Visibility):
-        
-        if makecopy:
-            newvis = copy_visibility(vis)
-            if vis.cindex is not None and len(rows) == len(vis.cindex):
-                newvis.cindex = vis.cindex[rows]
-            else:
-                newvis.cindex = None
-            if vis.blockvis is not None:
-                newvis.blockvis = vis.blockvis
-            newvis.data = copy.deepcopy(vis.data[rows])
-            return newvis
+        if vis.cindex is not None and vis.nvis == len(vis.cindex):
+            newvis.cindex = vis.cindex[rows]
         else:
-            vis.data = copy.deepcopy(vis.data[rows])
-            if vis.cindex is not None:
-                vis.cindex = vis.cindex[rows]
-            return vis
+            newvis.cindex = None
     else:
-        
-        if makecopy:
-            newvis = copy_visibility(vis)
-            newvis.data = copy.deepcopy(vis.data[rows])
-            return newvis
-        else:
-            vis.data = copy.deepcopy(vis.data[rows])
-            
-            return vis
+        newvis.coalescence_plans = dict()
+    return newvis
 
 
 def phaserotate_visibility(vis: Visibility, newphasecentre: SkyCoord, tangent=True, inverse=False) -> Visibility:
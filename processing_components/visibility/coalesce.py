@@ -18,11 +18,13 @@ A typical use might be::
 
 """
 
+import hashlib
+
 import numpy
 
 from astropy import constants
 
-from libs.util.array_functions import average_chunks, average_chunks2
+from libs.util.array_functions import average_chunks2_axes
 
 from data_models.memory_data_models import Visibility, BlockVisibility
 from data_models.parameters import get_parameter
@@ -34,6 +36,162 @@ import logging
 log = logging.getLogger(__name__)
 
 
+class CoalescencePlan:
+    """ Precomputed coalescence of a BlockVisibility: everything except the visibility values
+
+    The averaging factors, the map from baselines to coalesced rows, the averaged uvw, time, frequency, weights
+    etc. and the cindex used in decoalescence depend only on the uvw, weights and sampling of the BlockVisibility,
+    which do not change between major cycles. The plan holds all of these, so that coalescing new visibility
+    values requires only the weighted averages of the visibilities.
+    """
+
+    def __init__(self, vis: BlockVisibility, time_coal=0.0, max_time_coal=100, frequency_coal=0.0,
+                 max_frequency_coal=100):
+        """ Create a coalescence plan
+
+        :param vis: BlockVisibility
+        :param time_coal: Coalescence factor in time (0.0 for no coalescence)
+        :param max_time_coal: Maximum number of integrations averaged
+        :param frequency_coal: Coalescence factor in frequency (0.0 for no coalescence)
+        :param max_frequency_coal: Maximum number of channels averaged
+        """
+        assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
+        self.parameters = coalescence_parameters(time_coal=time_coal, max_time_coal=max_time_coal,
+                                                 frequency_coal=frequency_coal,
+                                                 max_frequency_coal=max_frequency_coal)
+        self.key = coalescence_plan_key(vis)
+        wts = vis.data['weight']
+        if self.converts:
+            # Plain conversion: the rows are the baselines with antenna2 > antenna1 for all times and channels
+            self.groups = None
+            self.antenna1, self.antenna2 = numpy.triu_indices(vis.vis.shape[1], 1)
+            _, self.uvw, self.weight, self.time, self.frequency, self.channel_bandwidth, self.ca1, self.ca2, \
+                self.integration_time, self.cindex = convert_blocks(vis.data['vis'], vis.data['uvw'], wts, vis.time,
+                                                                    vis.integration_time, vis.frequency,
+                                                                    vis.channel_bandwidth)
+        else:
+            self.groups, self.ca1, self.ca2, self.cindex = coalescence_groups(vis.data['uvw'], wts,
+                                                                              *self.parameters)
+            self.time, self.frequency, self.channel_bandwidth, self.uvw, self.integration_time = \
+                average_columns_in_groups(self.groups, self.nvis, vis.data['uvw'], wts, vis.time,
+                                          vis.integration_time, vis.frequency, vis.channel_bandwidth)
+            _, self.weight = average_vis_in_groups(self.groups, self.nvis, numpy.zeros(wts.shape, dtype='complex'),
+                                                   wts)
+
+    @property
+    def converts(self):
+        """ True if the plan is for conversion without coalescence
+        """
+        return self.parameters[0] == 0.0 and self.parameters[2] == 0.0
+
+    @property
+    def nvis(self):
+        return len(self.ca1)
+
+    def matches(self, vis: BlockVisibility):
+        """ Check that the plan is for the uvw, weights and sampling of vis
+
+        :param vis: BlockVisibility
+        :return: True if the plan can be used for vis
+        """
+        return self.key == coalescence_plan_key(vis)
+
+    def coalesce(self, vis: BlockVisibility) -> Visibility:
+        """ Coalesce the visibility values of vis using the plan
+
+        :param vis: BlockVisibility with the same uvw, weights and sampling as the plan
+        :return: Coalesced visibility with cindex and blockvis filled in
+        """
+        if self.converts:
+            npol = vis.vis.shape[-1]
+            cvis = vis.data['vis'][:, self.antenna2, self.antenna1, ...].astype('complex').reshape([self.nvis, npol])
+        else:
+            cvis, _ = average_vis_in_groups(self.groups, self.nvis, vis.data['vis'], vis.data['weight'])
+        return Visibility(uvw=self.uvw, time=self.time, frequency=self.frequency,
+                          channel_bandwidth=self.channel_bandwidth, phasecentre=vis.phasecentre,
+                          antenna1=self.ca1, antenna2=self.ca2, vis=cvis, weight=self.weight,
+                          imaging_weight=numpy.ones(cvis.shape), configuration=vis.configuration,
+                          integration_time=self.integration_time, polarisation_frame=vis.polarisation_frame,
+                          cindex=self.cindex, blockvis=vis)
+
+
+def coalescence_parameters(**kwargs):
+    """ Normalised coalescence parameters, as used to look up plans
+
+    Any coalescence factor of zero in both time and frequency is a plain conversion, for which the maxima do not
+    matter.
+
+    :return: (time_coal, max_time_coal, frequency_coal, max_frequency_coal)
+    """
+    time_coal = float(get_parameter(kwargs, 'time_coal', 0.0))
+    max_time_coal = int(get_parameter(kwargs, 'max_time_coal', 100))
+    frequency_coal = float(get_parameter(kwargs, 'frequency_coal', 0.0))
+    max_frequency_coal = int(get_parameter(kwargs, 'max_frequency_coal', 100))
+    if time_coal == 0.0 and frequency_coal == 0.0:
+        return 0.0, 0, 0.0, 0
+    return time_coal, max_time_coal, frequency_coal, max_frequency_coal
+
+
+def coalescence_plan_key(vis: BlockVisibility):
+    """ Fingerprint of everything in a BlockVisibility that a coalescence plan depends on
+
+    :param vis: BlockVisibility
+    :return: tuple
+    """
+    digest = hashlib.sha1()
+    for column in ['uvw', 'weight', 'time', 'integration_time']:
+        digest.update(numpy.ascontiguousarray(vis.data[column]).tobytes())
+    digest.update(numpy.ascontiguousarray(vis.frequency, dtype='float').tobytes())
+    digest.update(numpy.ascontiguousarray(vis.channel_bandwidth, dtype='float').tobytes())
+    return tuple(vis.vis.shape), digest.hexdigest()
+
+
+def create_coalescence_plan(vis: BlockVisibility, **kwargs) -> CoalescencePlan:
+    """ Calculate the coalescence plan for a BlockVisibility
+
+    :param vis: BlockVisibility
+    :param time_coal: Coalescence factor in time (0.0 for no coalescence)
+    :param max_time_coal: Maximum number of integrations averaged (100)
+    :param frequency_coal: Coalescence factor in frequency (0.0 for no coalescence)
+    :param max_frequency_coal: Maximum number of channels averaged (100)
+    :return: CoalescencePlan
+    """
+    time_coal, max_time_coal, frequency_coal, max_frequency_coal = coalescence_parameters(**kwargs)
+    return CoalescencePlan(vis, time_coal, max_time_coal, frequency_coal, max_frequency_coal)
+
+
+def get_coalescence_plan(vis: BlockVisibility, **kwargs) -> CoalescencePlan:
+    """ Get the coalescence plan for a BlockVisibility
+
+    If a plan is given by the keyword coalescence_plan, it is used. Otherwise a plan for the same parameters
+    attached to the BlockVisibility is used if it still matches the uvw, weights and sampling, or a new plan is
+    calculated and attached. Copies of the BlockVisibility made by copy_visibility keep the plans, so e.g. every
+    major cycle finds the plan already calculated.
+
+    :param vis: BlockVisibility
+    :param coalescence_plan: Precalculated plan (optional)
+    :return: CoalescencePlan
+    """
+    plan = get_parameter(kwargs, "coalescence_plan", None)
+    if plan is not None:
+        assert plan.matches(vis), "Coalescence plan does not match the BlockVisibility"
+        return plan
+
+    parameters = coalescence_parameters(**kwargs)
+    plans = getattr(vis, 'coalescence_plans', None)
+    if plans is None:
+        plans = vis.coalescence_plans = dict()
+    plan = plans.get(parameters, None)
+    if plan is not None and plan.matches(vis):
+        return plan
+
+    log.debug('get_coalescence_plan: calculating coalescence plan for (t,f) = (%.3f,%.3f)' %
+              (parameters[0], parameters[2]))
+    plan = create_coalescence_plan(vis, **kwargs)
+    plans[parameters] = plan
+    return plan
+
+
 def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
     """ Coalesce the BlockVisibility data_models. The output format is a Visibility, as needed for imaging
 
@@ -45,32 +203,22 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
 
     If coalescence_factor=0.0 then just a format conversion is done
 
+    The coalescence is done through a CoalescencePlan (see get_coalescence_plan), so only the visibility values are
+    averaged when the BlockVisibility has been coalesced before.
+
     :param vis: BlockVisibility to be coalesced
+    :param coalescence_plan: Precalculated plan (optional)
     :return: Coalesced visibility with  cindex and blockvis filled in
     """
 
     assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
 
-    time_coal = get_parameter(kwargs, 'time_coal', 0.0)
-    max_time_coal = get_parameter(kwargs, 'max_time_coal', 100)
-    frequency_coal = get_parameter(kwargs, 'frequency_coal', 0.0)
-    max_frequency_coal = get_parameter(kwargs, 'max_frequency_coal', 100)
+    plan = get_coalescence_plan(vis, **kwargs)
+    if plan.converts:
+        return convert_blockvisibility_to_visibility(vis, coalescence_plan=plan)
 
-    if time_coal == 0.0 and frequency_coal == 0.0:
-        return convert_blockvisibility_to_visibility((vis))
-
-    cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex \
-        = average_in_blocks(vis.data['vis'], vis.data['uvw'], vis.data['weight'], vis.time, vis.integration_time,
-                            vis.frequency, vis.channel_bandwidth, time_coal, max_time_coal,
-                            frequency_coal, max_frequency_coal)
-    cimwt = numpy.ones(cvis.shape)
-    coalesced_vis = Visibility(uvw=cuvw, time=ctime, frequency=cfrequency,
-                               channel_bandwidth=cchannel_bandwidth,
-                               phasecentre=vis.phasecentre, antenna1=ca1, antenna2=ca2, vis=cvis,
-                               weight=cwts, imaging_weight=cimwt,
-                               configuration=vis.configuration, integration_time=cintegration_time,
-                               polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis)
+    time_coal, max_time_coal, frequency_coal, max_frequency_coal = plan.parameters
+    coalesced_vis = plan.coalesce(vis)
 
     log.debug('coalesce_visibility: Created new Visibility for coalesced data_models, coalescence factors (t,f) = (%.3f,%.3f)'
               % (time_coal, frequency_coal))
@@ -81,26 +229,20 @@ def coalesce_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
     return coalesced_vis
 
 
-def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
+def convert_blockvisibility_to_visibility(vis: BlockVisibility, **kwargs) -> Visibility:
     """ Convert the BlockVisibility data with no coalescence
 
     :param vis: BlockVisibility to be converted
+    :param coalescence_plan: Precalculated plan (optional)
     :return: Visibility with  cindex and blockvis filled in
     """
 
     assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
 
-    cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex \
-        = convert_blocks(vis.data['vis'], vis.data['uvw'], vis.data['weight'], vis.time, vis.integration_time,
-                         vis.frequency, vis.channel_bandwidth)
-    cimwt = numpy.ones(cvis.shape)
-    converted_vis = Visibility(uvw=cuvw, time=ctime, frequency=cfrequency,
-                               channel_bandwidth=cchannel_bandwidth,
-                               phasecentre=vis.phasecentre, antenna1=ca1, antenna2=ca2, vis=cvis,
-                               weight=cwts, imaging_weight=cimwt,
-                               configuration=vis.configuration, integration_time=cintegration_time,
-                               polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis)
+    plan = get_parameter(kwargs, "coalescence_plan", None)
+    if plan is None or not plan.converts:
+        plan = get_coalescence_plan(vis)
+    converted_vis = plan.coalesce(vis)
 
     log.debug('convert_visibility: Original %s, converted %s' % (vis_summary(vis),
                                                                  vis_summary(converted_vis)))
@@ -128,14 +270,7 @@ def decoalesce_visibility(vis: Visibility, overwrite=False, **kwargs) -> BlockVi
         log.debug('decoalesce_visibility: Filled decoalesced data into template')
         decomp_vis = vis.blockvis
 
-    vshape = decomp_vis.data['vis'].shape
-
-    npol = vshape[-1]
-    dvis = numpy.zeros(vshape, dtype='complex')
-    assert numpy.max(vis.cindex) < dvis.size
-    assert numpy.max(vis.cindex) < vis.vis.shape[0], "Incorrect template used in decoalescing"
-    for i in range(dvis.size // npol):
-        decomp_vis.data['vis'].flat[i:i + npol] = vis.data['vis'][vis.cindex[i]]
+    decoalesce_vis(decomp_vis.data['vis'].shape, vis.data['vis'], vis.cindex, dvis=decomp_vis.data['vis'])
 
     log.debug('decoalesce_visibility: Coalesced %s, decoalesced %s' % (vis_summary(vis),
                                                                        vis_summary(
@@ -152,124 +287,136 @@ def average_in_blocks(vis, uvw, wts, times, integration_time, frequency, channel
 
     # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol]. We will map this
     # into rows like vis[npol] and with additional columns antenna1, antenna2, frequency
+    groups, ca1, ca2, cindex = coalescence_groups(uvw, wts, time_coal, max_time_coal, frequency_coal,
+                                                  max_frequency_coal)
+    ctime, cfrequency, cchannel_bandwidth, cuvw, cintegration_time = \
+        average_columns_in_groups(groups, len(ca1), uvw, wts, times, integration_time, frequency, channel_bandwidth)
+    cvis, cwts = average_vis_in_groups(groups, len(ca1), vis, wts)
 
-    ntimes, nant, _, nchan, npol = vis.shape
+    return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
+
+
+def coalescence_groups(uvw, wts, time_coal=1.0, max_time_coal=100, frequency_coal=1.0, max_frequency_coal=100):
+    """ Find the baseline-dependent averaging factors and group the baselines that have the same factors
+
+    Each group is a tuple (factor, a2, a1, rows) where factor is (time_average, frequency_average), a2 and a1 are
+    the antennas of the baselines in the group, and rows [nbaselines, nchunks] are the coalesced rows of the
+    chunks of each baseline (in time then frequency order).
+
+    :param uvw: uvw of the block [ntimes, nant, nant, 3]
+    :param wts: weights of the block [ntimes, nant, nant, nchan, npol]
+    :return: list of groups, antenna1 and antenna2 for each coalesced row, cindex
+    """
+    ntimes, nant, _, nchan, npol = wts.shape
 
     # Pol independent weighting
     allpwtsgrid = numpy.sum(wts, axis=4)
-    # Pol and frequency independent weighting
-    allcpwtsgrid = numpy.sum(allpwtsgrid, axis=3)
-    # Pol and time independent weighting
-    alltpwtsgrid = numpy.sum(allpwtsgrid, axis=0)
 
     # Now calculate on a baseline basis the time and frequency averaging. We do this by looking at
     # the maximum uv distance for all data and for a given baseline. The integration time and
     # channel bandwidth are scale appropriately.
     uvmax = numpy.sqrt(numpy.max(uvw[:, 0] ** 2 + uvw[:, 1] ** 2 + uvw[:, 2] ** 2))
-    time_average = numpy.ones([nant, nant], dtype='int')
-    frequency_average = numpy.ones([nant, nant], dtype='int')
-    ua = numpy.arange(nant)
-    for a2 in ua:
-        for a1 in ua:
-            if allpwtsgrid[:, a2, a1, :].any() > 0.0:
-                uvdist = numpy.max(numpy.sqrt(uvw[:, a2, a1, 0] ** 2 + uvw[:, a2, a1, 1] ** 2), axis=0)
-                if uvdist > 0.0:
-                    time_average[a2, a1] = min(max_time_coal,
-                                               max(1, int(round((time_coal * uvmax / uvdist)))))
-                    frequency_average[a2, a1] = min(max_frequency_coal,
-                                                    max(1, int(round(frequency_coal * uvmax / uvdist))))
-                else:
-                    time_average[a2, a1] = max_time_coal
-                    frequency_average[a2, a1] = max_frequency_coal
-
-    # See how many time chunks and frequency we need for each baseline. To do this we use the same averaging that
-    # we will use later for the actual data_models. This tells us the number of chunks required for each baseline.
-    frequency_grid, time_grid = numpy.meshgrid(frequency, times)
-    channel_bandwidth_grid, integration_time_grid = numpy.meshgrid(channel_bandwidth, integration_time)
-    cnvis = 0
-    time_chunk_len = numpy.ones([nant, nant], dtype='int')
-    frequency_chunk_len = numpy.ones([nant, nant], dtype='int')
-    for a2 in ua:
-        for a1 in ua:
-            if (time_average[a2, a1] > 0) & (frequency_average[a2, a1] > 0 & (allpwtsgrid[:, a2, a1, ...].any() > 0.0)):
-                time_chunks, _ = average_chunks(times, allcpwtsgrid[:, a2, a1], time_average[a2, a1])
-                time_chunk_len[a2, a1] = time_chunks.shape[0]
-                frequency_chunks, _ = average_chunks(frequency, alltpwtsgrid[a2, a1, :], frequency_average[a2, a1])
-                frequency_chunk_len[a2, a1] = frequency_chunks.shape[0]
-                nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-                cnvis += nrows
-
-    # Now we know enough to define the output coalesced arrays. The shape will be
-    # succesive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
-    ctime = numpy.zeros([cnvis])
-    cfrequency = numpy.zeros([cnvis])
-    cchannel_bandwidth = numpy.zeros([cnvis])
-    cvis = numpy.zeros([cnvis, npol], dtype='complex')
-    cwts = numpy.zeros([cnvis, npol])
-    cuvw = numpy.zeros([cnvis, 3])
-    ca1 = numpy.zeros([cnvis], dtype='int')
-    ca2 = numpy.zeros([cnvis], dtype='int')
-    cintegration_time = numpy.zeros([cnvis])
+    uvdist = numpy.max(numpy.sqrt(uvw[..., 0] ** 2 + uvw[..., 1] ** 2), axis=0)
+    weighted = numpy.any(allpwtsgrid != 0.0, axis=(0, 3))
+    time_average, frequency_average = [numpy.ones([nant, nant], dtype='int') for i in range(2)]
+    moving = weighted & (uvdist > 0.0)
+    time_average[moving] = numpy.minimum(max_time_coal, numpy.maximum(
+        1, numpy.round(time_coal * uvmax / uvdist[moving]).astype('int')))
+    frequency_average[moving] = numpy.minimum(max_frequency_coal, numpy.maximum(
+        1, numpy.round(frequency_coal * uvmax / uvdist[moving]).astype('int')))
+    time_average[weighted & (uvdist == 0.0)] = max_time_coal
+    frequency_average[weighted & (uvdist == 0.0)] = max_frequency_coal
+
+    # The number of time and frequency chunks for each baseline follows from the averaging factors. Only
+    # baselines with some weight are kept, in the order a2, a1.
+    a2, a1 = numpy.nonzero(weighted)
+    time_chunk_len = -(-ntimes // time_average[a2, a1])
+    frequency_chunk_len = -(-nchan // frequency_average[a2, a1])
+    nrows = time_chunk_len * frequency_chunk_len
+    visstart = numpy.concatenate([[0], numpy.cumsum(nrows)])
 
     # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-    rowgrid.flat = range(rowgrid.size)
-
+    rowgrid = numpy.arange(ntimes * nant * nant * nchan).reshape([ntimes, nant, nant, nchan])
     cindex = numpy.zeros([rowgrid.size], dtype='int')
 
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
+    # Baselines with the same averaging factors have the same number of chunks, so each such group can be
+    # averaged together with array reductions over the time and channel axes.
     # To aid decoalescence we will need an index of which output elements a given input element
     # contributes to. This is a many to one. The decoalescence will then just consist of using
     # this index to extract the coalesced value that a given input element contributes towards.
+    groups = list()
+    factors = numpy.stack([time_average[a2, a1], frequency_average[a2, a1]], axis=1)
+    for factor in numpy.unique(factors, axis=0):
+        group = numpy.nonzero(numpy.all(factors == factor, axis=1))[0]
+        ngrouprows = nrows[group[0]]
+        rows = visstart[group][:, numpy.newaxis] + numpy.arange(ngrouprows)
+        groups.append((tuple(factor), a2[group], a1[group], rows))
 
-    visstart = 0
-    for a2 in ua:
-        for a1 in ua:
-            if (time_chunk_len[a2, a1] > 0) & (frequency_chunk_len[a2, a1] > 0) & \
-                    (allpwtsgrid[:, a2, a1, :].any() > 0.0):
-
-                nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-                rows = slice(visstart, visstart + nrows)
-
-                cindex.flat[rowgrid[:, a2, a1, :]] = numpy.array(range(visstart, visstart + nrows))
-
-                ca1[rows] = a1
-                ca2[rows] = a2
-
-                # Average over time and frequency for case where polarisation isn't an issue
-                def average_from_grid(arr):
-                    return average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                           (time_average[a2, a1], frequency_average[a2, a1]))[0]
+        # Each element of a baseline is mapped cyclically onto the rows of that baseline
+        elements = rowgrid[:, a2[group], a1[group], :].transpose([1, 0, 2]).reshape([len(group), ntimes * nchan])
+        cindex[elements] = visstart[group][:, numpy.newaxis] + numpy.arange(ntimes * nchan) % ngrouprows
 
-                ctime[rows] = average_from_grid(time_grid).flatten()
-                cfrequency[rows] = average_from_grid(frequency_grid).flatten()
+    return groups, numpy.repeat(a1, nrows), numpy.repeat(a2, nrows), cindex
 
-                for axis in range(3):
-                    uvwgrid = numpy.outer(uvw[:, a2, a1, axis], frequency / constants.c.value)
-                    cuvw[rows, axis] = average_from_grid(uvwgrid).flatten()
 
-                # For some variables, we need the sum not the average
-                def sum_from_grid(arr):
-                    result = average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                             (time_average[a2, a1], frequency_average[a2, a1]))
-                    return result[0] * result[0].size
+def average_columns_in_groups(groups, cnvis, uvw, wts, times, integration_time, frequency, channel_bandwidth):
+    """ Average the time, frequency, uvw, integration time and channel bandwidth for each group of baselines
 
-                cintegration_time[rows] = sum_from_grid(integration_time_grid).flatten()
-                cchannel_bandwidth[rows] = sum_from_grid(channel_bandwidth_grid).flatten()
-
-                # For the polarisations we have to perform the time-frequency average separately for each polarisation
-                for pol in range(npol):
-                    result = average_chunks2(vis[:, a2, a1, :, pol], wts[:, a2, a1, :, pol],
-                                             (time_average[a2, a1], frequency_average[a2, a1]))
-                    cvis[rows, pol], cwts[rows, pol] = result[0].flatten(), result[1].flatten()
-
-                visstart += nrows
-
-    assert cnvis == visstart, "Mismatch between number of rows in coalesced visibility and index"
+    :param groups: Groups from coalescence_groups
+    :param cnvis: Number of coalesced rows
+    :return: ctime, cfrequency, cchannel_bandwidth, cuvw, cintegration_time
+    """
+    ntimes, nant, _, nchan, npol = wts.shape
+    ctime = numpy.zeros([cnvis])
+    cfrequency = numpy.zeros([cnvis])
+    cchannel_bandwidth = numpy.zeros([cnvis])
+    cuvw = numpy.zeros([cnvis, 3])
+    cintegration_time = numpy.zeros([cnvis])
 
-    return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
+    # Everything is converted into arrays with axes [..., baseline, time, channel] and then it is averaged
+    # over time and frequency chunks for the baselines in the group.
+    frequency_grid, time_grid = numpy.meshgrid(frequency, times)
+    channel_bandwidth_grid, integration_time_grid = numpy.meshgrid(channel_bandwidth, integration_time)
+    for factor, a2, a1, rows in groups:
+        nbaselines, ngrouprows = rows.shape
+
+        # Average over time and frequency for case where polarisation isn't an issue
+        weight = numpy.sum(wts[:, a2, a1, ...], axis=3).transpose([1, 0, 2])
+        grids = numpy.zeros([7, nbaselines, ntimes, nchan])
+        grids[0], grids[1] = time_grid, frequency_grid
+        for axis in range(3):
+            grids[2 + axis] = uvw[:, a2, a1, axis].T[..., numpy.newaxis] * (frequency / constants.c.value)
+        grids[5], grids[6] = integration_time_grid, channel_bandwidth_grid
+        averages = average_chunks2_axes(grids, weight, factor)[0].reshape([7, nbaselines * ngrouprows])
+        ctime[rows.flat] = averages[0]
+        cfrequency[rows.flat] = averages[1]
+        cuvw[rows.flat, :] = averages[2:5].T
+        # For some variables, we need the sum not the average
+        cintegration_time[rows.flat] = averages[5] * ngrouprows
+        cchannel_bandwidth[rows.flat] = averages[6] * ngrouprows
+
+    return ctime, cfrequency, cchannel_bandwidth, cuvw, cintegration_time
+
+
+def average_vis_in_groups(groups, cnvis, vis, wts):
+    """ Average the visibilities and weights for each group of baselines
+
+    :param groups: Groups from coalescence_groups
+    :param cnvis: Number of coalesced rows
+    :param vis: Visibility of the block [ntimes, nant, nant, nchan, npol]
+    :param wts: Weights of the block [ntimes, nant, nant, nchan, npol]
+    :return: cvis, cwts
+    """
+    npol = vis.shape[-1]
+    cvis = numpy.zeros([cnvis, npol], dtype='complex')
+    cwts = numpy.zeros([cnvis, npol])
+    for factor, a2, a1, rows in groups:
+        # For the polarisations we have to perform the time-frequency average separately for each polarisation
+        result = average_chunks2_axes(vis[:, a2, a1, :, :].transpose([3, 1, 0, 2]),
+                                      wts[:, a2, a1, :, :].transpose([3, 1, 0, 2]), factor)
+        cvis[rows.flat, :] = result[0].reshape([npol, rows.size]).T
+        cwts[rows.flat, :] = result[1].reshape([npol, rows.size]).T
+    return cvis, cwts
 
 
 def convert_blocks(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth):
@@ -279,56 +426,33 @@ def convert_blocks(vis, uvw, wts, times, integration_time, frequency, channel_ba
     ntimes, nant, _, nchan, npol = vis.shape
     assert nchan == len(frequency)
 
-    cnvis = ntimes * nant * (nant - 1) * nchan // 2
-
-    # Now we know enough to define the output coalesced arrays. The shape will be
-    # succesive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
-    ctime = numpy.zeros([cnvis])
-    cfrequency = numpy.zeros([cnvis])
-    cchannel_bandwidth = numpy.zeros([cnvis])
-    cvis = numpy.zeros([cnvis, npol], dtype='complex')
-    cwts = numpy.zeros([cnvis, npol])
-    cuvw = numpy.zeros([cnvis, 3])
-    ca1 = numpy.zeros([cnvis], dtype='int')
-    ca2 = numpy.zeros([cnvis], dtype='int')
-    cintegration_time = numpy.zeros([cnvis])
-
-    # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-    rowgrid.flat = range(rowgrid.size)
-
+    # The rows are ordered by time, then baseline (a1 < a2 with a1 varying slowest), then channel. All the
+    # columns are filled by indexing the upper triangle of baselines and broadcasting over time and channel.
+    a1, a2 = numpy.triu_indices(nant, 1)
+    nbaselines = len(a1)
+    cnvis = ntimes * nbaselines * nchan
+
+    ca1 = numpy.tile(numpy.repeat(a1, nchan), ntimes)
+    ca2 = numpy.tile(numpy.repeat(a2, nchan), ntimes)
+    ctime = numpy.repeat(numpy.asarray(times, dtype='float'), nbaselines * nchan)
+    cintegration_time = numpy.repeat(numpy.asarray(integration_time, dtype='float'), nbaselines * nchan)
+    cfrequency = numpy.tile(numpy.asarray(frequency, dtype='float'), ntimes * nbaselines)
+    cchannel_bandwidth = numpy.tile(numpy.asarray(channel_bandwidth, dtype='float'), ntimes * nbaselines)
+
+    cuvw = (uvw[:, a2, a1, numpy.newaxis, :] * frequency[:, numpy.newaxis] / constants.c.value).reshape([cnvis, 3])
+    cvis = vis[:, a2, a1, ...].astype('complex').reshape([cnvis, npol])
+    cwts = wts[:, a2, a1, ...].astype('float').reshape([cnvis, npol])
+
+    # For decoalescence we keep an index to map back to the original BlockVisibility. Elements of the block
+    # that are not converted (autocorrelations and a1 > a2) map to row 0.
+    rowgrid = numpy.arange(ntimes * nant * nant * nchan).reshape([ntimes, nant, nant, nchan])
     cindex = numpy.zeros([rowgrid.size], dtype='int')
-
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
-    # To aid decoalescence we will need an index of which output elements a given input element
-    # contributes to. This is a many to one. The decoalescence will then just consist of using
-    # this index to extract the coalesced value that a given input element contributes towards.
-
-    row = 0
-    for itime in range(ntimes):
-        for a1 in range(nant):
-            for a2 in range(a1 + 1, nant):
-                for chan in range(nchan):
-                    ca1[row] = a1
-                    ca2[row] = a2
-                    cfrequency[row] = frequency[chan]
-                    ctime[row] = times[itime]
-
-                    cuvw[row, :] = uvw[itime, a2, a1, :] * frequency[chan] / constants.c.value
-
-                    cindex.flat[rowgrid[itime, a2, a1, chan]] = row
-                    cintegration_time[row] = integration_time[itime]
-                    cchannel_bandwidth[row] = channel_bandwidth[chan]
-                    cvis[row, :] = vis[itime, a2, a1, chan, :]
-                    cwts[row, :] = wts[itime, a2, a1, chan, :]
-                    row += 1
+    cindex[rowgrid[:, a2, a1, :].flatten()] = numpy.arange(cnvis)
 
     return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
 
 
-def decoalesce_vis(vshape, cvis, cindex):
+def decoalesce_vis(vshape, cvis, cindex, dvis=None):
     """Decoalesce data using Time-Baseline
 
     We use the index into the coalesced data_models. For every output row, this gives the
@@ -337,14 +461,18 @@ def decoalesce_vis(vshape, cvis, cindex):
     :param vshape: Shape of template visibility data_models
     :param cvis: Coalesced visibility values
     :param cindex: Index array from coalescence
+    :param dvis: Array of shape vshape to be filled (optional, otherwise a new array is made)
     :return: uncoalesced vis
     """
     npol = vshape[-1]
-    dvis = numpy.zeros(vshape, dtype='complex')
-    assert numpy.max(cindex) < dvis.size
-    for i in range(dvis.size // npol):
-        dvis.flat[i:i + npol] = cvis[cindex[i]]
-
+    assert len(cindex) * npol == numpy.prod(vshape), "Index does not match the shape of the template"
+    assert numpy.max(cindex) < cvis.shape[0], "Incorrect template used in decoalescing"
+    if dvis is None:
+        dvis = numpy.empty(vshape, dtype='complex')
+    assert tuple(dvis.shape) == tuple(vshape), "Array to be filled does not have shape %s" % str(vshape)
+    
+    # Gather the rows for all elements of the block in one operation
+    dvis[...] = cvis[cindex].reshape(vshape)
     return dvis
 
 
@@ -18,8 +18,8 @@ import numpy
 from data_models.memory_data_models import Visibility, BlockVisibility
 
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
-from ..visibility.iterators import vis_timeslice_iter, vis_wslice_iter
-from ..visibility.base import create_visibility_from_rows
+from ..visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_index_iter
+from ..visibility.base import create_visibility_from_rows, count_rows
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +30,9 @@ def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibili
     If vis_iter is over time then the type of the outvisibilities will be the same as inout
     If vis_iter is over w then the type of the output visibilities will always be Visibility
 
+    The rows of all slices are found in one pass by the equivalent iterator yielding row indices, if there is one
+    (see vis_index_iter). The rows are copied once, and the subvisibilities are views on this copy.
+
     :param vis: Visibility
     :param vis_iter: visibility iterator
     :param vis_slices: Number of slices to be made
@@ -46,10 +49,19 @@ def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibili
     else:
         avis = vis
         
+    index_list = list()
+    for rows in vis_index_iter(vis_iter)(avis, vis_slices=vis_slices):
+        index_list.append(numpy.nonzero(rows)[0] if rows.dtype == bool else rows)
+
+    # Copy the rows of all slices once, ordered by slice. Each subvisibility is then a view on a contiguous range of
+    # these rows.
+    sorted_vis = create_visibility_from_rows(avis, numpy.concatenate(index_list))
     visibility_list = list()
-    for i, rows in enumerate(vis_iter(avis, vis_slices=vis_slices)):
-        subvis = create_visibility_from_rows(avis, rows)
+    start = 0
+    for rows in index_list:
+        subvis = create_visibility_from_rows(sorted_vis, numpy.arange(start, start + len(rows)), makecopy=False)
         visibility_list.append(subvis)
+        start += len(rows)
         
     return visibility_list
 
@@ -78,13 +90,14 @@ def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_it
         cvis = vis
 
     rowses = []
-    for i, rows in enumerate(vis_iter(cvis, vis_slices=vis_slices)):
+    for i, rows in enumerate(vis_index_iter(vis_iter)(cvis, vis_slices=vis_slices)):
         rowses.append(rows)
 
     for i, rows in enumerate(rowses):
         assert i < len(visibility_list), "Gather not consistent with scatter for slice %d" % i
-        if visibility_list[i] is not None and numpy.sum(rows):
-            assert numpy.sum(rows) == visibility_list[i].nvis, "Mismatch in number of rows in gather for slice %d" % i
+        if visibility_list[i] is not None and count_rows(rows):
+            assert count_rows(rows) == visibility_list[i].nvis, \
+                "Mismatch in number of rows in gather for slice %d" % i
             cvis.data[rows] = visibility_list[i].data[...]
     
     if vis_iter == vis_wslice_iter and isinstance(vis, BlockVisibility):
@@ -7,6 +7,10 @@ A typical use would be to make a sequence of snapshot images::
         dirtySnapshot = create_image_from_visibility(visslice, npixel=512, cellsize=0.001, npol=1)
         dirtySnapshot, sumwt = invert_2d(visslice, dirtySnapshot)
 
+The iterators vis_timeslice_iter and vis_wslice_iter yield a boolean array for each slice, so each slice costs
+time proportional to the number of rows. vis_timeslice_index_iter and vis_wslice_index_iter select the same rows
+but assign all rows to slices in one pass, and yield arrays of row indices. These are much faster for many slices.
+
 """
 
 import logging
@@ -53,8 +57,11 @@ def vis_timeslice_iter(vis: Visibility, vis_slices=None) -> numpy.ndarray:
     else:
         timeslice = timemax - timemin
     
+    # The rows of each slice are found by binary search in the time index
+    index = vis.time_index
     for box in boxes:
-        rows = numpy.abs(vis.time - box) <= 0.5 * timeslice
+        rows = numpy.zeros(vis.nvis, dtype='bool')
+        rows[index.rows_near(box, 0.5 * timeslice, inclusive=True)] = True
         yield rows
 
 
@@ -88,6 +95,7 @@ def vis_wslices(vis: Visibility, wslice=10.0) -> int:
     
     return 1 + 2 * numpy.round(wmaxabs / wslice).astype('int')
 
+
 def vis_wslice_iter(vis: Visibility, vis_slices=1) -> numpy.ndarray:
     """ W slice iterator
 
@@ -106,4 +114,106 @@ def vis_wslice_iter(vis: Visibility, vis_slices=1) -> numpy.ndarray:
     
     for box in boxes:
         rows = numpy.abs(vis.w - box) < 0.5 * wstack
-        yield rows
\ No newline at end of file
+        yield rows
+
+
+def bucket_rows(values, boxes, halfwidth, inclusive=True) -> list:
+    """ Assign rows to equally spaced boxes in a single pass
+
+    A row is in a box if its value is within halfwidth of the box, exactly as for the boolean arrays of
+    vis_timeslice_iter (inclusive) and vis_wslice_iter (not inclusive). Each row is compared only with the nearest
+    box and its neighbours, and the rows are then sorted by box.
+
+    :param values: Value for each row e.g. time or w
+    :param boxes: Equally spaced centres of the boxes
+    :param halfwidth: Half width of the boxes
+    :param inclusive: Include rows at exactly halfwidth from a box
+    :return: list of arrays of row indices, one per box
+    """
+    within = numpy.less_equal if inclusive else numpy.less
+    nboxes = len(boxes)
+    nrows = len(values)
+    if nboxes > 1 and boxes[1] > boxes[0]:
+        nearest = numpy.clip(numpy.round((values - boxes[0]) / (boxes[1] - boxes[0])).astype('int'), 0, nboxes - 1)
+        candidates = [numpy.clip(nearest + shift, 0, nboxes - 1) for shift in [0, -1, 1]]
+    else:
+        candidates = [numpy.full(nrows, box, dtype='int') for box in range(nboxes)]
+
+    # Rows at the edge of a box may be in the neighbouring box as well or instead
+    allrows = numpy.arange(nrows)
+    box_list, row_list = list(), list()
+    for i, box in enumerate(candidates):
+        member = within(numpy.abs(values - boxes[box]), halfwidth)
+        if i > 0:
+            member &= box != candidates[0]
+        box_list.append(box[member])
+        row_list.append(allrows[member])
+    rowbox = numpy.concatenate(box_list)
+    rows = numpy.concatenate(row_list)
+
+    # Sort by box then row, and split into boxes. If each row is in one box, a stable sort by box keeps the rows in
+    # order, and for small integers this is a linear time radix sort.
+    if len(rows) > len(box_list[0]):
+        rows = rows[numpy.argsort(rowbox * nrows + rows)]
+    else:
+        rows = rows[numpy.argsort(rowbox.astype(numpy.min_scalar_type(nboxes)), kind='stable')]
+    return numpy.split(rows, numpy.cumsum(numpy.bincount(rowbox, minlength=nboxes))[:-1])
+
+
+def vis_timeslice_index_iter(vis: Union[Visibility, BlockVisibility], vis_slices=None) -> numpy.ndarray:
+    """ Time slice iterator yielding row indices
+
+    The rows are the same as for vis_timeslice_iter but are found for all slices in one pass.
+
+    :param vis:
+    :param vis_slices: Number of time slices
+    :return: Array of the indices of the selected rows
+    """
+    assert vis is not None
+    assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
+    timemin = numpy.min(vis.time)
+    timemax = numpy.max(vis.time)
+
+    if vis_slices is None:
+        vis_slices = vis_timeslices(vis, 'auto')
+
+    boxes = numpy.linspace(timemin, timemax, vis_slices)
+    if vis_slices > 1:
+        timeslice = boxes[1] - boxes[0]
+    else:
+        timeslice = timemax - timemin
+
+    for rows in bucket_rows(vis.time, boxes, 0.5 * timeslice, inclusive=True):
+        yield rows
+
+
+def vis_wslice_index_iter(vis: Visibility, vis_slices=1) -> numpy.ndarray:
+    """ W slice iterator yielding row indices
+
+    The rows are the same as for vis_wslice_iter but are found for all slices in one pass.
+
+    :param vis:
+    :param vis_slices: Number of slices
+    :return: Array of the indices of the selected rows
+    """
+    assert isinstance(vis, Visibility), vis
+    wmaxabs = numpy.max(numpy.abs(vis.w))
+
+    boxes = numpy.linspace(- wmaxabs, +wmaxabs, vis_slices)
+    if vis_slices > 1:
+        wstack = boxes[1] - boxes[0]
+    else:
+        wstack = 2 * wmaxabs
+
+    for rows in bucket_rows(vis.w, boxes, 0.5 * wstack, inclusive=False):
+        yield rows
+
+
+def vis_index_iter(vis_iter):
+    """ The iterator yielding row indices that is equivalent to a given iterator
+
+    :param vis_iter: Visibility iterator e.g. vis_timeslice_iter
+    :return: Equivalent iterator yielding row indices, or vis_iter if there is none
+    """
+    return {vis_timeslice_iter: vis_timeslice_index_iter, vis_wslice_iter: vis_wslice_index_iter}.get(vis_iter,
+                                                                                                       vis_iter)
@@ -194,17 +194,20 @@ def remove_continuum_blockvisibility(vis: BlockVisibility, degree=1, mask=None)
     return vis
 
 
-def divide_visibility(vis: BlockVisibility, modelvis: BlockVisibility):
+def divide_visibility(vis: BlockVisibility, modelvis: BlockVisibility, rcond=1e-12):
     """ Divide visibility by model forming visibility for equivalent point source
 
     This is a useful intermediate product for calibration. Variation of the visibility in time and
     frequency due to the model structure is removed and the data can be averaged to a limit determined
     by the instrumental stability. The weight is adjusted to compensate for the division.
     
-    Zero divisions are avoided and the corresponding weight set to zero.
+    Zero divisions are avoided and the corresponding weight set to zero. For polarised data the 2x2 model
+    coherency matrices are inverted for all baselines at once, and those that are singular or ill-conditioned
+    are skipped, with weight zero.
 
     :param vis:
     :param modelvis:
+    :param rcond: Minimum reciprocal condition number of the 2x2 model coherency matrices (1e-12)
     :return:
     """
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
@@ -225,15 +228,32 @@ def divide_visibility(vis: BlockVisibility, modelvis: BlockVisibility):
         xshape = (nrows, nants, nants, nchan, nrec, nrec)
         x = numpy.zeros(xshape, dtype='complex')
         xwt = numpy.zeros(xshape)
-        for row in range(nrows):
-            for ant1 in range(nants):
-                for ant2 in range(ant1 + 1, nants):
-                    for chan in range(nchan):
-                        ovis = numpy.matrix(vis.vis[row, ant2, ant1, chan].reshape([2, 2]))
-                        mvis = numpy.matrix(modelvis.vis[row, ant2, ant1, chan].reshape([2, 2]))
-                        wt = numpy.matrix(vis.weight[row, ant2, ant1, chan].reshape([2, 2]))
-                        x[row, ant2, ant1, chan] = numpy.matmul(numpy.linalg.inv(mvis), ovis)
-                        xwt[row, ant2, ant1, chan] = numpy.dot(mvis, numpy.multiply(wt, mvis.H)).real
+        
+        # All baselines ant1 < ant2, for all rows and channels at once
+        ant1, ant2 = numpy.triu_indices(nants, 1)
+        blshape = (nrows, len(ant1), nchan, nrec, nrec)
+        ovis = vis.vis[:, ant2, ant1].reshape(blshape)
+        mvis = modelvis.vis[:, ant2, ant1].reshape(blshape)
+        wt = vis.weight[:, ant2, ant1].reshape(blshape)
+        
+        # The reciprocal of the condition number in the Frobenius norm of a 2x2 matrix is |det| / |M|^2
+        det = mvis[..., 0, 0] * mvis[..., 1, 1] - mvis[..., 0, 1] * mvis[..., 1, 0]
+        norm2 = numpy.sum(numpy.abs(mvis) ** 2, axis=(-2, -1))
+        good = numpy.abs(det) > rcond * norm2
+        if not numpy.all(good):
+            log.debug('divide_visibility: %d ill-conditioned model visibilities given zero weight' %
+                      numpy.sum(~good))
+        
+        mvis = mvis[good]
+        xgood = numpy.matmul(numpy.linalg.inv(mvis), ovis[good])
+        xwtgood = numpy.matmul(mvis, wt[good] * numpy.conjugate(numpy.swapaxes(mvis, -2, -1))).real
+        
+        xbl = numpy.zeros(blshape, dtype='complex')
+        xwtbl = numpy.zeros(blshape)
+        xbl[good] = xgood
+        xwtbl[good] = xwtgood
+        x[:, ant2, ant1] = xbl
+        xwt[:, ant2, ant1] = xwtbl
         x = x.reshape((nrows, nants, nants, nchan, nrec * nrec))
         xwt = xwt.reshape((nrows, nants, nants, nchan, nrec * nrec))
     
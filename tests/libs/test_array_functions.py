@@ -7,7 +7,7 @@ import numpy
 import logging
 
 from libs.util.array_functions import average_chunks_jit as average_chunks
-from libs.util.array_functions import average_chunks2, average_chunks_jit
+from libs.util.array_functions import average_chunks2, average_chunks_jit, average_chunks2_axes
 
 log = logging.getLogger(__name__)
 
@@ -81,6 +81,18 @@ class TestArray_functions(unittest.TestCase):
         numpy.testing.assert_array_equal(carr[:, 5], answerarr)
         numpy.testing.assert_array_equal(cwts[:, 5], answerwts)
 
+    def test_average_chunks2_axes(self):
+        arr = numpy.random.randn(3, 4, 23, 11) + 1j * numpy.random.randn(3, 4, 23, 11)
+        wts = numpy.random.rand(4, 23, 11)
+        wts[1, 3:6, :] = 0.0
+        for chunksize in [(5, 2), (1, 3), (4, 1), (1, 1), (30, 12)]:
+            carr, cwts = average_chunks2_axes(arr, wts, chunksize)
+            for i in range(arr.shape[0]):
+                for j in range(arr.shape[1]):
+                    answerarr, answerwts = average_chunks2(arr[i, j], wts[j], chunksize)
+                    numpy.testing.assert_array_equal(carr[i, j], answerarr)
+                    numpy.testing.assert_array_equal(cwts[i, j], answerwts)
+
     def test_average_chunks_jit(self):
         arr = numpy.linspace(0.0, 100.0, 11)
         wts = numpy.ones_like(arr)
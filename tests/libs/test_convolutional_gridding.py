@@ -10,7 +10,8 @@ from numpy.testing import assert_allclose
 
 from libs.fourier_transforms.convolutional_gridding import w_beam, coordinates, \
     coordinates2, coordinateBounds, anti_aliasing_calculate, \
-    convolutional_degrid, convolutional_grid
+    convolutional_degrid, convolutional_grid, weight_gridding, frac_coord
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
 
 
 class TestConvolutionalGridding(unittest.TestCase):
@@ -73,6 +74,32 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert uvgrid.shape[2] == npixel
         assert uvgrid.shape[3] == npixel
 
+    def test_convolutional_grid_engines(self):
+        npixel = 128
+        nvis = 1000
+        nchan = 2
+        npol = 4
+        numpy.random.seed(180555)
+        _, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        vis = numpy.random.randn(nvis, npol) + 1j * numpy.random.randn(nvis, npol)
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        frequencymap = numpy.random.randint(0, nchan, nvis)
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.random.randint(0, 3, nvis), [kernel, 1j * kernel, (1.0 + 1j) * kernel])]:
+            uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                               vis, visweights, uvcoords, frequencymap, engine='loop')
+            for engine in ['numpy', 'auto']:
+                egrid, esumwt = convolutional_grid(kernels,
+                                                   numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                   vis, visweights, uvcoords, frequencymap, engine=engine)
+                assert numpy.array_equal(uvgrid, egrid), engine
+                assert numpy.array_equal(sumwt, esumwt), engine
+            egrid, esumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                               vis, visweights, uvcoords, frequencymap, engine='numba')
+            assert_allclose(uvgrid, egrid, rtol=1e-12, atol=1e-12)
+            assert_allclose(sumwt, esumwt, rtol=1e-12, atol=1e-12)
+
     def test_convolutional_degrid(self):
         npixel = 256
         nvis = 100000
@@ -92,6 +119,142 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert vis.shape[0] == nvis
         assert vis.shape[1] == npol
 
+    def test_convolutional_degrid_engines(self):
+        npixel = 128
+        nvis = 1000
+        nchan = 2
+        npol = 4
+        numpy.random.seed(180555)
+        _, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        uvgrid = numpy.random.randn(nchan, npol, npixel, npixel) + 1j * numpy.random.randn(nchan, npol, npixel,
+                                                                                            npixel)
+        frequencymap = numpy.random.randint(0, nchan, nvis)
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.random.randint(0, 3, nvis), [kernel, 1j * kernel, (1.0 + 1j) * kernel])]:
+            vis = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap, engine='loop')
+            for engine in ['numpy', 'auto']:
+                assert numpy.array_equal(vis, convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords,
+                                                                   frequencymap, engine=engine)), engine
+            assert_allclose(vis, convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap,
+                                                      engine='numba'), rtol=1e-12, atol=1e-12)
+
+    def test_convolutional_grid_threads(self):
+        npixel = 128
+        nvis = 1000
+        nchan = 2
+        npol = 4
+        numpy.random.seed(180555)
+        _, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        vis = numpy.random.randn(nvis, npol) + 1j * numpy.random.randn(nvis, npol)
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        frequencymap = numpy.random.randint(0, nchan, nvis)
+        initial = numpy.random.randn(nchan, npol, npixel, npixel) + 0j
+        kernels = (numpy.random.randint(0, 2, nvis), [kernel, 1j * kernel])
+        uvgrid, sumwt = convolutional_grid(kernels, initial.copy(), vis, visweights, uvcoords, frequencymap,
+                                           engine='loop')
+        vis_predicted = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap, engine='numpy')
+        for engine in ['loop', 'numpy', 'numba']:
+            egrid, esumwt = convolutional_grid(kernels, initial.copy(), vis, visweights, uvcoords, frequencymap,
+                                               engine=engine)
+            assert_allclose(uvgrid, egrid, rtol=1e-12, atol=1e-12)
+            for nthreads in [2, 3, 8]:
+                tgrid, tsumwt = convolutional_grid(kernels, initial.copy(), vis, visweights, uvcoords, frequencymap,
+                                                   engine=engine, nthreads=nthreads)
+                assert numpy.array_equal(egrid, tgrid), (engine, nthreads)
+                assert numpy.array_equal(esumwt, tsumwt), (engine, nthreads)
+                tvis = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap, engine=engine,
+                                            nthreads=nthreads)
+                assert_allclose(vis_predicted, tvis, rtol=1e-12, atol=1e-12)
+
+    def test_weight_gridding(self):
+        npixel = 64
+        nvis = 1000
+        nchan = 2
+        npol = 2
+        numpy.random.seed(180555)
+        shape = [nchan, npol, npixel, npixel]
+        uvcoords = numpy.random.uniform(-0.2, 0.2, [nvis, 2])
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        frequencymap = numpy.random.randint(0, nchan, nvis)
+        
+        # Reference uniform weighting, one sample at a time
+        densitygrid = numpy.zeros(shape)
+        for flip in [-1.0, 1.0]:
+            y, _ = frac_coord(npixel, 1.0, flip * uvcoords[:, 1])
+            x, _ = frac_coord(npixel, 1.0, flip * uvcoords[:, 0])
+            for pol in range(npol):
+                for ivis in range(nvis):
+                    densitygrid[frequencymap[ivis], pol, y[ivis], x[ivis]] += visweights[ivis, pol]
+        density = numpy.array([[densitygrid[frequencymap[ivis], pol, y[ivis], x[ivis]] for pol in range(npol)]
+                               for ivis in range(nvis)])
+        
+        newweights, newdensity, newdensitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap,
+                                                                 weighting='uniform')
+        assert numpy.array_equal(densitygrid, newdensitygrid)
+        assert numpy.array_equal(density, newdensity)
+        assert numpy.array_equal(visweights / density, newweights)
+        
+        naturalweights, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap,
+                                                               weighting='natural')
+        assert naturalweights is visweights
+        assert density is None and densitygrid is None
+        
+        # Briggs weighting tends to uniform and natural weighting at the extremes of robustness
+        uniformweights = newweights
+        for weighting, box in [('briggs', 1), ('super-briggs', 3)]:
+            briggsweights, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting=weighting,
+                                                  robustness=-10.0, superuniform_box=box)
+            if box == 1:
+                # Proportional to the uniform weights within each channel and polarisation
+                ratio = briggsweights / uniformweights
+                for chan in range(nchan):
+                    assert_allclose(ratio[frequencymap == chan] / ratio[frequencymap == chan][0], 1.0, rtol=1e-6)
+            briggsweights, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting=weighting,
+                                                  robustness=10.0, superuniform_box=box)
+            assert_allclose(briggsweights, visweights, rtol=1e-6)
+        
+        superweights, _, superdensitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap,
+                                                            weighting='super-uniform', superuniform_box=3)
+        assert numpy.all(superweights <= uniformweights)
+        assert_allclose(numpy.sum(superdensitygrid), 9.0 * numpy.sum(newdensitygrid))
+
+    def test_single_precision(self):
+        # Accuracy of single precision imaging relative to double precision, for an image of 128 x 128 pixels
+        # padded by a factor 2 (as in invert_2d and predict_2d). For 10000 visibilities, the dirty image
+        # agrees to about 2e-7 of its peak, and the visibilities predicted from a random image agree to about
+        # 1.5e-7 of the peak visibility.
+        npixel = 256
+        nvis = 10000
+        npol = 1
+        numpy.random.seed(180555)
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        vis = numpy.random.randn(nvis, npol) + 1j * numpy.random.randn(nvis, npol)
+        visweights = numpy.ones([nvis, npol])
+        frequencymap = numpy.zeros([nvis], dtype='int')
+        model = numpy.random.randn(1, npol, npixel // 2, npixel // 2)
+        
+        dirty = dict()
+        predicted = dict()
+        for dtype in ['complex128', 'complex64']:
+            kernels = (numpy.zeros([nvis], dtype='int'), [kernel.astype(dtype)])
+            uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([1, npol, npixel, npixel], dtype=dtype),
+                                               vis.astype(dtype), visweights, uvcoords, frequencymap)
+            image = numpy.real(ifft(uvgrid)) * gcf.astype(uvgrid.real.dtype)
+            assert image.dtype == uvgrid.real.dtype
+            dirty[dtype] = extract_mid(image, npixel // 2)
+            uvgrid = fft((pad_mid(model, npixel) * gcf).astype(dtype))
+            assert uvgrid.dtype == dtype
+            predicted[dtype] = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+            assert predicted[dtype].dtype == dtype
+        
+        dirty_error = numpy.max(numpy.abs(dirty['complex64'] - dirty['complex128']))
+        assert dirty_error < 1e-6 * numpy.max(numpy.abs(dirty['complex128'])), dirty_error
+        predict_error = numpy.max(numpy.abs(predicted['complex64'] - predicted['complex128']))
+        assert predict_error < 1e-6 * numpy.max(numpy.abs(predicted['complex128'])), predict_error
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,48 @@
+""" Unit tests for the direct Fourier transform
+
+
+"""
+import logging
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.direct_fourier_transform import dft_predict, dft_directions
+from libs.util.coordinate_support import simulate_point
+
+log = logging.getLogger(__name__)
+
+
+class TestDirectFourierTransform(unittest.TestCase):
+    def setUp(self):
+        rs = numpy.random.RandomState(1)
+        self.uvw = rs.normal(0.0, 1000.0, [2000, 3])
+        self.l = rs.uniform(-0.05, 0.05, 200)
+        self.m = rs.uniform(-0.05, 0.05, 200)
+        self.flux = rs.uniform(0.0, 1.0, [200, 4])
+
+    def test_dft_predict(self):
+        expected = numpy.zeros([2000, 4], dtype='complex')
+        for l, m, flux in zip(self.l, self.m, self.flux):
+            expected += simulate_point(self.uvw, l, m)[:, numpy.newaxis] * flux
+        vis = dft_predict(numpy.zeros([2000, 4], dtype='complex'), self.uvw, dft_directions(self.l, self.m),
+                          self.flux)
+        numpy.testing.assert_allclose(vis, expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+
+    def test_dft_predict_chunks_threads(self):
+        # The result must not depend on the size of the chunks or the number of threads
+        directions = dft_directions(self.l, self.m)
+        vis = dft_predict(numpy.ones([2000, 4], dtype='complex'), self.uvw, directions, self.flux)
+        for nthreads, max_chunk_bytes in [(1, 1000), (3, 24 * 200 * 7), (4, 16 * 1024 ** 2)]:
+            result = dft_predict(numpy.ones([2000, 4], dtype='complex'), self.uvw, directions, self.flux,
+                                 nthreads=nthreads, max_chunk_bytes=max_chunk_bytes)
+            numpy.testing.assert_allclose(result, vis, atol=1e-12 * numpy.max(numpy.abs(vis)))
+
+    def test_dft_predict_empty(self):
+        vis = numpy.ones([2000, 4], dtype='complex')
+        assert dft_predict(vis, self.uvw, numpy.zeros([0, 3]), numpy.zeros([0, 4])) is vis
+        assert numpy.all(vis == 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,8 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, fft, ifft, ifft_real, \
+    fft2, ifft2, set_fft_backend, get_fft_backend
 from libs.fourier_transforms.convolutional_gridding import coordinates2
 
 
@@ -38,6 +39,29 @@ class TestFFTSupport(unittest.TestCase):
             a = 1 + self._pattern(npixel * kernel_oversampling)
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
+    
+    def test_fft_backends(self):
+        numpy.random.seed(180555)
+        try:
+            for shape in [(2, 1, 64, 64), (1, 1, 63, 65), (64, 48)]:
+                a = numpy.random.randn(*shape) + 1j * numpy.random.randn(*shape)
+                original = a.copy()
+                set_fft_backend('numpy')
+                expected_fft = fft(a)
+                expected_ifft = ifft(a)
+                assert numpy.array_equal(ifft_real(a), numpy.real(expected_ifft))
+                for backend in ['scipy', 'pyfftw']:
+                    set_fft_backend(backend, workers=2)
+                    assert get_fft_backend()[1] == 2
+                    assert_allclose(fft(a), expected_fft, atol=1e-12)
+                    assert_allclose(ifft(a), expected_ifft, atol=1e-15)
+                    assert_allclose(ifft_real(a), numpy.real(expected_ifft), atol=1e-15)
+                    assert_allclose(ifft2(fft2(a)), a, atol=1e-13)
+                    # The input must not be changed by the in place transforms
+                    assert numpy.array_equal(a, original)
+                    assert ifft_real(a.astype('complex64')).dtype == numpy.float32
+        finally:
+            set_fft_backend('numpy')
 
 
 if __name__ == '__main__':
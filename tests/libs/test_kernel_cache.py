@@ -0,0 +1,87 @@
+""" Unit tests for kernel caches
+
+
+"""
+import logging
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from libs.imaging.kernel_cache import KernelCache, cached_anti_aliasing_calculate
+
+log = logging.getLogger(__name__)
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.ncalculated = 0
+
+    def calculate(self, value, size=100):
+        def calculate_arrays():
+            self.ncalculated += 1
+            return [value * numpy.ones([size]), numpy.arange(size)]
+
+        return calculate_arrays
+
+    def test_hits_and_misses(self):
+        cache = KernelCache('test')
+        arrays = cache.get(('a', 1.0), self.calculate(1.0))
+        assert len(arrays) == 2
+        numpy.testing.assert_array_equal(arrays[0], numpy.ones([100]))
+        again = cache.get(('a', 1.0), self.calculate(1.0))
+        assert again[0] is arrays[0]
+        cache.get(('a', 2.0), self.calculate(2.0))
+        assert self.ncalculated == 2
+        stats = cache.statistics()
+        assert stats['hits'] == 1, stats
+        assert stats['misses'] == 2, stats
+        assert stats['entries'] == 2, stats
+        with self.assertRaises(ValueError):
+            arrays[0][0] = 0.0
+        cache.clear()
+        assert cache.statistics()['entries'] == 0
+
+    def test_eviction(self):
+        # Each entry uses 1600 bytes so only two fit
+        cache = KernelCache('test', max_bytes=3500)
+        for value in [1.0, 2.0, 3.0]:
+            cache.get(('a', value), self.calculate(value))
+        assert cache.statistics()['evictions'] == 1
+        assert cache.statistics()['nbytes'] <= 3500
+        # The least recently used entry should have gone
+        cache.get(('a', 3.0), self.calculate(3.0))
+        assert self.ncalculated == 3
+        cache.get(('a', 1.0), self.calculate(1.0))
+        assert self.ncalculated == 4
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = KernelCache('test', directory=directory)
+            arrays = cache.get(('a', 1.0), self.calculate(1.0))
+            newcache = KernelCache('test', directory=directory)
+            newarrays = newcache.get(('a', 1.0), self.calculate(1.0))
+            assert self.ncalculated == 1
+            assert newcache.statistics()['disk_hits'] == 1
+            for a, newa in zip(arrays, newarrays):
+                numpy.testing.assert_array_equal(a, newa)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cached_anti_aliasing_calculate(self):
+        gcf, kernel = cached_anti_aliasing_calculate((64, 64), 8)
+        expected_gcf, expected_kernel = anti_aliasing_calculate((64, 64), 8)
+        assert numpy.array_equal(gcf, expected_gcf)
+        assert numpy.array_equal(kernel, expected_kernel)
+        assert not kernel.flags.writeable
+        newgcf, newkernel = cached_anti_aliasing_calculate([64, 64], 8)
+        assert newgcf is gcf
+        assert newkernel is kernel
+        assert cached_anti_aliasing_calculate((64, 64), 4)[1].shape == (4, 4, 8, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
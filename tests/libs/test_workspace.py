@@ -0,0 +1,99 @@
+""" Unit tests for the workspace pool
+
+
+"""
+import logging
+import tracemalloc
+import unittest
+
+import numpy
+
+from libs.fourier_transforms.fft_support import ifft, set_fft_backend
+from libs.util.workspace import BufferPool, workspace
+
+log = logging.getLogger(__name__)
+
+
+class TestWorkspace(unittest.TestCase):
+    def test_borrow_release(self):
+        pool = BufferPool('test')
+        a = pool.borrow([4, 8], 'complex', zero=True)
+        assert a.shape == (4, 8) and a.dtype == numpy.complex128
+        assert numpy.max(numpy.abs(a)) == 0.0
+        a[...] = 1.0
+        b = pool.borrow([4, 8], 'complex')
+        assert b is not a
+        pool.release(a)
+        c = pool.borrow((4, 8), numpy.complex128, zero=True)
+        assert c is a
+        assert numpy.max(numpy.abs(c)) == 0.0
+        assert pool.borrow([4, 8], 'float') is not a
+        stats = pool.statistics()
+        assert stats['allocations'] == 3, stats
+        assert stats['reuses'] == 1, stats
+        pool.release(b)
+        pool.release(c)
+        assert pool.statistics()['free'] == 2
+        with self.assertRaises(AssertionError):
+            pool.release(c[1:, :])
+        pool.clear()
+        assert pool.statistics()['nbytes'] == 0
+
+    def test_max_bytes(self):
+        pool = BufferPool('test', max_bytes=1000)
+        a = pool.borrow([100], 'float')
+        b = pool.borrow([100], 'float')
+        pool.release(a)
+        pool.release(b)
+        stats = pool.statistics()
+        assert stats['free'] == 1, stats
+        assert stats['nbytes'] == 800, stats
+        pool.configure(max_bytes=500)
+        stats = pool.statistics()
+        assert stats['free'] == 0, stats
+        assert stats['nbytes'] == 0, stats
+        pool.release(pool.borrow([50], 'float'))
+        assert pool.statistics()['free'] == 1
+        assert BufferPool('test').max_bytes == 256 * 1024 ** 2
+
+    @staticmethod
+    def peak_memory(function):
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_ifft_peak_memory(self):
+        # Compare the peak memory allocated by the shifted inverse FFT of a 16MB grid as done previously, and done
+        # in place with the workspace pool, for each backend including the default numpy backend.
+        grid = numpy.random.randn(1, 1, 1024, 1024) + 0j
+        nbytes = grid.nbytes
+
+        def ifft_copy():
+            return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(grid, axes=[2, 3])), axes=[2, 3])
+
+        def ifft_in_place():
+            return ifft(grid, out=grid)
+
+        try:
+            for backend in ['numpy', 'scipy']:
+                set_fft_backend(backend)
+                ifft_in_place()
+                copy_peak = self.peak_memory(ifft_copy)
+                in_place_peak = self.peak_memory(ifft_in_place)
+                log.info("test_ifft_peak_memory: %s backend, peak allocated %.1f MB with copies, %.1f MB in place" %
+                         (backend, copy_peak / 1024 ** 2, in_place_peak / 1024 ** 2))
+                assert copy_peak >= 3 * nbytes
+                assert in_place_peak <= copy_peak - 2 * nbytes
+                if backend != 'numpy':
+                    # The numpy backend transforms in blocks of a few MB
+                    assert in_place_peak < 0.1 * nbytes
+        finally:
+            set_fft_backend('numpy')
+            workspace.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,10 +3,13 @@
 
 """
 
-import numpy
+import copy
 import logging
 import unittest
 
+import numpy
+from numpy.testing import assert_allclose
+
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
@@ -22,6 +25,34 @@ from processing_components.imaging.base import predict_skycomponent_visibility
 log = logging.getLogger(__name__)
 
 
+def apply_gains_loop(vis, gain, inverse=False):
+    """ Reference application of the gains for one time, one baseline and channel at a time
+
+    :param vis: Visibility array [nants, nants, nchan, npol]
+    :param gain: Gain array [nants, nchan, nrec, nrec]
+    """
+    nant, nchan, nrec, _ = gain.shape
+    applied = copy.deepcopy(vis)
+    for a1 in range(nant - 1):
+        for a2 in range(a1 + 1, nant):
+            for chan in range(nchan):
+                if nrec == 1:
+                    smueller = gain[a1, chan, 0, 0] * numpy.conjugate(gain[a2, chan, 0, 0])
+                    if not inverse:
+                        applied[a2, a1, chan, 0] = vis[a2, a1, chan, 0] * smueller
+                    elif numpy.all(gain[a1, :, 0, 0] * numpy.conjugate(gain[a2, :, 0, 0]) != 0.0):
+                        applied[a2, a1, chan, 0] = vis[a2, a1, chan, 0] / smueller
+                else:
+                    mueller = numpy.kron(gain[a1, chan], numpy.conjugate(gain[a2, chan]))
+                    if inverse:
+                        try:
+                            mueller = numpy.linalg.inv(mueller)
+                        except numpy.linalg.LinAlgError:
+                            continue
+                    applied[a2, a1, chan, :] = numpy.matmul(mueller, vis[a2, a1, chan, :])
+    return applied
+
+
 class TestCalibrationOperations(unittest.TestCase):
     
     def setUp(self):
@@ -123,6 +154,22 @@ class TestCalibrationOperations(unittest.TestCase):
             error = numpy.max(numpy.abs(vis.vis - original.vis))
             assert error < 1e-12, "Error = %s" % (error)
 
+    def test_apply_gaintable_exact(self):
+        # The gains applied to all baselines at once must agree with one baseline at a time to rounding error,
+        # including the baselines with singular gains
+        for spf, dpf, gains in [('stokesI', 'stokesI', 'scalar'), ('stokesIQUV', 'linear', 'vector'),
+                                ('stokesIQUV', 'linear', 'matrix')]:
+            self.actualSetup(spf, dpf)
+            gt = create_gaintable_from_blockvisibility(self.vis, timeslice='auto')
+            gt = simulate_gaintable(gt, phase_error=1.0, amplitude_error=0.1, leakage=0.1 if gains == 'matrix' else 0.0)
+            gt.data['gain'][0, 2, 1, ...] = 0.0
+            for inverse in [False, True]:
+                expected = numpy.array([apply_gains_loop(self.vis.vis[itime], gt.gain[itime], inverse)
+                                        for itime in range(len(self.times))])
+                vis = apply_gaintable(copy_visibility(self.vis), gt, inverse=inverse)
+                assert_allclose(vis.vis, expected, rtol=1e-12, atol=1e-12 * numpy.max(numpy.abs(expected)),
+                                err_msg="%s gains differ, inverse %s" % (gains, inverse))
+
     def test_apply_gaintable_null(self):
         for spf, dpf in[('stokesI', 'stokesI'), ('stokesIQUV', 'linear'), ('stokesIQUV', 'circular')]:
             self.actualSetup(spf, dpf)
@@ -4,6 +4,7 @@
 """
 import numpy
 
+import time
 import unittest
 
 from astropy.coordinates import SkyCoord
@@ -15,6 +16,7 @@ from data_models.polarisation import PolarisationFrame
 from processing_components.calibration.operations import apply_gaintable, create_gaintable_from_blockvisibility, gaintable_summary, \
     qa_gaintable
 from processing_components.calibration.calibration import solve_gaintable
+from libs.calibration.solvers import solve_from_X
 from processing_components.simulation.testing_support import create_named_configuration, simulate_gaintable
 from processing_components.visibility.operations import divide_visibility
 from processing_components.visibility.base import copy_visibility, create_blockvisibility
@@ -104,8 +106,27 @@ class TestCalibrationSolvers(unittest.TestCase):
         assert residual < 3e-8, "Max residual = %s" % (residual)
         assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
 
+    def test_solve_gaintable_scalar_batch(self):
+        # Solving all intervals at once must agree with solving each interval separately
+        self.actualSetup('stokesI', 'stokesI', f=[100.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.1)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        gtsol = solve_gaintable(self.vis, original, phase_only=False, niter=200, normalise_gains=False)
+        point_vis = divide_visibility(self.vis, original)
+        gtrow = create_gaintable_from_blockvisibility(self.vis)
+        for row in range(gtrow.ntimes):
+            x = numpy.sum(point_vis.vis[row:row + 1] * point_vis.weight[row:row + 1], axis=0)
+            xwt = numpy.sum(point_vis.weight[row:row + 1], axis=0)
+            x[xwt > 0.0] /= xwt[xwt > 0.0]
+            gtrow = solve_from_X(gtrow, x, xwt, row, crosspol=False, niter=200, phase_only=False, tol=1e-8, npol=1)
+        numpy.testing.assert_allclose(gtsol.gain, gtrow.gain, atol=1e-12)
+        numpy.testing.assert_allclose(gtsol.residual, gtrow.residual, atol=1e-12)
+
     def core_solve(self, spf, dpf, phase_error=0.1, amplitude_error=0.0, leakage=0.0,
-                   phase_only=True, niter=200, crosspol=False, residual_tol=1e-6, f=None, vnchan=3):
+                   phase_only=True, niter=200, crosspol=False, residual_tol=1e-6, f=None, vnchan=3, solver='itsubs',
+                   tol=1e-6):
         if f is None:
             f = [100.0, 50.0, -10.0, 40.0]
         self.actualSetup(spf, dpf, f=f, vnchan=vnchan)
@@ -114,13 +135,59 @@ class TestCalibrationSolvers(unittest.TestCase):
         gt = simulate_gaintable(gt, phase_error=phase_error, amplitude_error=amplitude_error, leakage=leakage)
         original = copy_visibility(self.vis)
         vis = apply_gaintable(self.vis, gt)
-        gtsol = solve_gaintable(self.vis, original, phase_only=phase_only, niter=niter, crosspol=crosspol, tol=1e-6)
+        gtsol = solve_gaintable(self.vis, original, phase_only=phase_only, niter=niter, crosspol=crosspol, tol=tol,
+                                solver=solver)
         vis = apply_gaintable(vis, gtsol, inverse=True)
         residual = numpy.max(gtsol.residual)
         assert residual < residual_tol, "%s %s Max residual = %s" % (spf, dpf, residual)
         log.debug(qa_gaintable(gt))
         assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
 
+    def test_solve_gaintable_stefcal_scalar(self):
+        self.actualSetup('stokesI', 'stokesI', f=[100.0])
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=10.0, amplitude_error=0.1)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        gtsol = solve_gaintable(self.vis, original, phase_only=False, niter=200, solver='stefcal')
+        residual = numpy.max(gtsol.residual)
+        assert residual < 3e-8, "Max residual = %s" % (residual)
+        assert numpy.max(numpy.abs(gtsol.gain - 1.0)) > 0.1
+
+    # StefCal stops on the relative change of the gains, so the residual for a 100 Jy source is larger than tol.
+    # A tighter tol than for iterative substitution keeps it well below residual_tol.
+    def test_solve_gaintable_stefcal_vector_phase_only_linear(self):
+        self.core_solve('stokesIQUV', 'linear', phase_error=0.1, phase_only=True,
+                        f=[100.0, 50.0, 0.0, 0.0], solver='stefcal', tol=1e-8)
+
+    def test_solve_gaintable_stefcal_vector_both_circular(self):
+        self.core_solve('stokesIQUV', 'circular', phase_error=0.1, amplitude_error=0.01,
+                        phase_only=False, f=[100.0, 0.0, 0.0, 50.0], solver='stefcal', tol=1e-8)
+
+    def test_solve_gaintable_stefcal_crosspol(self):
+        self.actualSetup('stokesIQUV', 'linear')
+        with self.assertRaises(ValueError):
+            solve_gaintable(self.vis, copy_visibility(self.vis), crosspol=True, solver='stefcal')
+
+    def test_solve_gaintable_stefcal_compare(self):
+        # Compare StefCal with iterative substitution for the same corrupted visibilities. The times are logged but
+        # not compared.
+        self.actualSetup('stokesI', 'stokesI', f=[100.0], vnchan=32)
+        gt = create_gaintable_from_blockvisibility(self.vis)
+        gt = simulate_gaintable(gt, phase_error=1.0, amplitude_error=0.1)
+        original = copy_visibility(self.vis)
+        self.vis = apply_gaintable(self.vis, gt)
+        gtsols = dict()
+        for solver in ['itsubs', 'stefcal']:
+            start = time.time()
+            gtsols[solver] = solve_gaintable(self.vis, original, phase_only=False, niter=200, tol=1e-12,
+                                             solver=solver)
+            residual = numpy.max(gtsols[solver].residual)
+            log.info("test_solve_gaintable_stefcal_compare: %s took %.3f s, max residual %.3g" %
+                     (solver, time.time() - start, residual))
+            assert residual < 3e-8, "%s max residual = %s" % (solver, residual)
+        numpy.testing.assert_allclose(gtsols['stefcal'].gain, gtsols['itsubs'].gain, atol=1e-6)
+
     def test_solve_gaintable_vector_phase_only_linear(self):
         self.core_solve('stokesIQUV', 'linear', phase_error=0.1, phase_only=True,
                         f=[100.0, 50.0, 0.0, 0.0])
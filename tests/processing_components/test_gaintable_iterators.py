@@ -8,8 +8,11 @@ import unittest
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
+from data_models.memory_data_models import TimeIndex
+
 from processing_components.simulation.testing_support import create_named_configuration
-from processing_components.calibration.iterators import gaintable_timeslice_iter, gaintable_null_iter
+from processing_components.calibration.iterators import gaintable_timeslice_iter, gaintable_null_iter, \
+    gaintable_timeslice_index_iter
 from processing_components.calibration.operations import create_gaintable_from_blockvisibility
 from processing_components.visibility.base import create_blockvisibility
 
@@ -55,5 +58,40 @@ class TestGainTableIterators(unittest.TestCase):
         assert total_rows == self.gaintable.gain.shape[0], \
             "Total rows iterated %d, Original rows %d" % (total_rows, self.gaintable.gain.shape[0])
 
+    def test_gt_timeslice_index_iterator(self):
+        self.actualSetUp()
+        for timeslice in ['auto', None, 100.0]:
+            for rows, index_rows in zip(gaintable_timeslice_iter(self.gaintable, timeslice=timeslice),
+                                        gaintable_timeslice_index_iter(self.gaintable, timeslice=timeslice)):
+                numpy.testing.assert_array_equal(numpy.nonzero(rows)[0], index_rows)
+
+    def test_gt_time_index(self):
+        # Lookups must give exactly the rows found by testing all rows, including rows at the edges
+        rs = numpy.random.RandomState(1)
+        time = rs.choice(numpy.linspace(0.0, 100.0, 51), 200)
+        interval = rs.choice([1.0, 2.0, 4.0, 7.5], 200)
+        index = TimeIndex(time, interval)
+        for t in numpy.linspace(-10.0, 110.0, 241):
+            numpy.testing.assert_array_equal(index.rows_containing(t),
+                                             numpy.where(numpy.abs(time - t) < interval / 2.0)[0])
+            numpy.testing.assert_array_equal(index.rows_near(t, 2.0), numpy.where(numpy.abs(time - t) < 2.0)[0])
+            numpy.testing.assert_array_equal(index.rows_near(t, 2.0, inclusive=True),
+                                             numpy.where(numpy.abs(time - t) <= 2.0)[0])
+
+    def test_gt_time_index_cached(self):
+        self.actualSetUp()
+        index = self.gaintable.time_index
+        assert self.gaintable.time_index is index
+        self.gaintable.time = self.gaintable.time + 1.0
+        assert self.gaintable.time_index is not index
+        numpy.testing.assert_array_equal(self.gaintable.time_index.time, self.gaintable.time)
+        # Replacing the data, even by data of the same length, drops the index
+        for data in [self.gaintable.data[::2].copy(), self.gaintable.data[::-1].copy()]:
+            index = self.gaintable.time_index
+            self.gaintable.data = data
+            assert self.gaintable.time_index is not index
+            numpy.testing.assert_array_equal(self.gaintable.time_index.time, self.gaintable.time)
+            numpy.testing.assert_array_equal(self.gaintable.time_index.interval, self.gaintable.interval)
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,14 +7,21 @@ import sys
 import unittest
 
 import numpy
+from astropy import constants
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from processing_components.imaging.base import create_image_from_visibility
+from data_models.memory_data_models import Skycomponent, Visibility
+from data_models.polarisation import convert_pol_frame
+
+from libs.util.coordinate_support import simulate_point, skycoord_to_lmn
+
+from processing_components.imaging.base import create_image_from_visibility, predict_skycomponent_visibility
 from processing_components.imaging.weighting import weight_visibility
 from processing_components.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, create_unittest_model
+from processing_components.visibility.base import copy_visibility
 
 log = logging.getLogger(__name__)
 
@@ -83,6 +90,42 @@ class TestImagingFunctions(unittest.TestCase):
                                           nchan=1)
         assert im.data.shape == (1, 1, 128, 128)
 
+    def predict_skycomponent_loop(self, vis, sc):
+        """ Reference prediction, one component at a time with simulate_point
+        """
+        for comp in sc:
+            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
+            if isinstance(vis, Visibility):
+                for chan in range(len(self.frequency)):
+                    rows = vis.frequency == self.frequency[chan]
+                    vis.data['vis'][rows] += simulate_point(vis.uvw[rows], l, m)[:, numpy.newaxis] * comp.flux[chan]
+            else:
+                flux = convert_pol_frame(comp.flux, comp.polarisation_frame, vis.polarisation_frame)
+                for chan in range(len(self.frequency)):
+                    uvw = vis.uvw * vis.frequency[chan] / constants.c.value
+                    vis.data['vis'][..., chan, :] += simulate_point(uvw, l, m)[..., numpy.newaxis] * flux[chan]
+        return vis
+
+    def test_predict_skycomponent_visibility(self):
+        # All components are predicted together in chunks; the result must agree with predicting each component
+        # with simulate_point
+        for block, dopol in [(False, False), (True, True)]:
+            self.actualSetUp(freqwin=3, block=block, dopol=dopol)
+            rs = numpy.random.RandomState(1)
+            sc = [Skycomponent(direction=SkyCoord(ra=self.phasecentre.ra + rs.uniform(-1.0, 1.0) * u.deg,
+                                                  dec=self.phasecentre.dec + rs.uniform(-1.0, 1.0) * u.deg,
+                                                  frame='icrs', equinox='J2000'),
+                               frequency=self.frequency, flux=rs.uniform(0.0, 1.0, [3, self.image_pol.npol]),
+                               polarisation_frame=self.image_pol if block else self.vis_pol)
+                  for i in range(100)]
+            expected = self.predict_skycomponent_loop(copy_visibility(self.vis, zero=True), sc)
+            vis = predict_skycomponent_visibility(copy_visibility(self.vis, zero=True), sc)
+            error = numpy.max(numpy.abs(vis.vis - expected.vis)) / numpy.max(numpy.abs(expected.vis))
+            assert error < 1e-12, error
+            chunked = predict_skycomponent_visibility(copy_visibility(self.vis, zero=True), sc, nthreads=4,
+                                                      dft_chunk_bytes=100000)
+            assert numpy.max(numpy.abs(chunked.vis - vis.vis)) < 1e-12 * numpy.max(numpy.abs(vis.vis))
+
 
 if __name__ == '__main__':
     unittest.main()
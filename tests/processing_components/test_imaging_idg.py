@@ -0,0 +1,101 @@
+""" Unit tests for image domain gridding, compared with a direct Fourier transform, w projection and w stacking
+
+
+"""
+import logging
+import time
+import unittest
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord, EarthLocation
+
+from data_models.memory_data_models import Configuration
+from data_models.polarisation import PolarisationFrame
+
+from libs.image.operations import copy_image
+from libs.util.coordinate_support import xyz_at_latitude
+
+from processing_components.imaging.base import predict_skycomponent_visibility, invert_2d
+from processing_components.imaging.idg import invert_idg, predict_idg
+from processing_components.imaging.wstack_native import invert_wstack_native
+from processing_components.skycomponent.operations import insert_skycomponent
+from processing_components.simulation.testing_support import ingest_unittest_visibility, create_unittest_model, \
+    create_unittest_components
+from processing_components.visibility.base import copy_visibility
+
+log = logging.getLogger(__name__)
+
+
+class TestImagingIDG(unittest.TestCase):
+    def setUp(self, nants=20, rmax=2000.0, npixel=128):
+        # A random array with long baselines, so that the w term matters. This avoids needing the configuration files.
+        rs = numpy.random.RandomState(1)
+        r = rmax * numpy.sqrt(rs.uniform(0.0, 1.0, nants))
+        theta = rs.uniform(0.0, 2.0 * numpy.pi, nants)
+        xyz = numpy.array([r * numpy.cos(theta), r * numpy.sin(theta), rs.uniform(-5.0, 5.0, nants)]).T
+        location = EarthLocation(lon="116.4999", lat="-26.7000", height=300.0)
+        xyz = xyz_at_latitude(xyz, location.geodetic[1].to(u.rad).value)
+        config = Configuration(location=location, names='S_%d', mount='xy', xyz=xyz, frame='local',
+                               diameter=35.0, name='IDGTEST')
+
+        times = numpy.linspace(-3.0, +3.0, 5) * numpy.pi / 12.0
+        phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
+        self.vis = ingest_unittest_visibility(config, numpy.array([1e8]), numpy.array([1e6]), times,
+                                              PolarisationFrame('stokesI'), phasecentre, block=False)
+        self.model = create_unittest_model(self.vis, PolarisationFrame('stokesI'), npixel=npixel)
+        self.components = create_unittest_components(self.model, numpy.array([[100.0]]))
+        self.vis = predict_skycomponent_visibility(self.vis, self.components)
+
+    def dft_image(self):
+        """ Dirty image by direct Fourier transform, including the w term
+        """
+        npixel = self.model.shape[3]
+        cdelt = self.model.wcs.wcs.cdelt * numpy.pi / 180.0
+        l = cdelt[0] * (numpy.arange(npixel) - npixel // 2)
+        m = cdelt[1] * (numpy.arange(npixel) - npixel // 2)
+        l, m = numpy.meshgrid(l, m)
+        n = numpy.sqrt(1.0 - l ** 2 - m ** 2) - 1.0
+        uvw = self.vis.uvw
+        wt = self.vis.imaging_weight[:, 0]
+        phasor = numpy.exp(2j * numpy.pi * (uvw[:, 0, None, None] * l + uvw[:, 1, None, None] * m +
+                                            uvw[:, 2, None, None] * n))
+        return numpy.real(numpy.einsum('k,kyx->yx', wt * self.vis.vis[:, 0], phasor)) / numpy.sum(wt)
+
+    def test_invert_idg(self):
+        dirty, sumwt = invert_idg(self.vis, self.model)
+        expected = self.dft_image()
+        error = numpy.max(numpy.abs(dirty.data[0, 0] - expected)) / numpy.max(expected)
+        assert error < 1e-3, "Relative error %g of IDG invert is too large" % error
+
+    def test_psf_idg(self):
+        psf, sumwt = invert_idg(self.vis, self.model, dopsf=True)
+        assert numpy.abs(numpy.max(psf.data) - 1.0) < 1e-3, numpy.max(psf.data)
+
+    def test_predict_idg(self):
+        model = insert_skycomponent(copy_image(self.model), self.components)
+        vis = predict_idg(copy_visibility(self.vis, zero=True), model)
+        error = numpy.max(numpy.abs(vis.vis - self.vis.vis)) / numpy.max(numpy.abs(self.vis.vis))
+        assert error < 1e-3, "Relative error %g of IDG predict is too large" % error
+
+    def test_invert_idg_compare(self):
+        # Compare accuracy with w projection and w stacking for the same long baseline data. The times are logged
+        # but not compared (see examples/benchmarks/benchmark_idg.py).
+        expected = self.dft_image()
+        contexts = [('idg', invert_idg, {}),
+                    ('wprojection', invert_2d, {'wstep': 10.0, 'oversampling': 4}),
+                    ('wstack_native', invert_wstack_native, {'vis_slices': 11})]
+        errors = dict()
+        for name, invert, kwargs in contexts:
+            start = time.time()
+            dirty, sumwt = invert(self.vis, self.model, **kwargs)
+            elapsed = time.time() - start
+            errors[name] = numpy.max(numpy.abs(dirty.data[0, 0] - expected)) / numpy.max(expected)
+            log.info("test_invert_idg_compare: %s took %.3f s, relative error %.3g" % (name, elapsed, errors[name]))
+
+        assert errors['idg'] < errors['wprojection']
+        assert errors['idg'] < errors['wstack_native']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,11 +11,14 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
+from libs.imaging.gridding_plan import create_gridding_plan, get_gridding_plan, clear_gridding_plan_cache, \
+    BlockVisibilityRows
 from libs.imaging.imaging_params import get_frequency_map, w_kernel_list
 
 from processing_components.simulation.testing_support import create_named_configuration, create_low_test_image_from_gleam
-from processing_components.visibility.base import create_visibility
-from processing_components.imaging.base import create_image_from_visibility
+from processing_components.visibility.base import create_visibility, create_blockvisibility, copy_visibility
+from processing_components.visibility.coalesce import convert_blockvisibility_to_visibility
+from processing_components.imaging.base import create_image_from_visibility, invert_2d, predict_2d
 from processing_components.image.operations import export_image_to_fits, create_image_from_array
 
 log = logging.getLogger(__name__)
@@ -93,6 +96,94 @@ class TestImagingParams(unittest.TestCase):
                                                     wstep=50, oversampling=3,
                                                     maxsupport=128)
 
+    def test_gridding_plan(self):
+        clear_gridding_plan_cache()
+        plan = get_gridding_plan(self.vis, self.model, oversampling=4)
+        assert plan.nvis == self.vis.nvis
+        assert plan.shape == [self.vnchan, 1, 256, 256]
+        assert plan.kernel_name == '2d'
+        assert get_gridding_plan(self.vis, self.model, oversampling=4) is plan
+        assert get_gridding_plan(self.vis, self.model, oversampling=8) is not plan
+        with self.assertRaises(ValueError):
+            plan.grid_coords[2][0] = 0
+        
+        # A plan larger than the cache is not cached, and does not displace the plans already cached
+        from libs.imaging import gridding_plan
+        max_bytes = gridding_plan.gridding_plan_cache_max_bytes
+        try:
+            gridding_plan.gridding_plan_cache_max_bytes = plan.nbytes + 1
+            large_vis = create_visibility(self.lowcore, times=numpy.linspace(-1.0, 1.0, 14), frequency=self.frequency,
+                                          phasecentre=self.phasecentre, weight=1.0,
+                                          polarisation_frame=PolarisationFrame('stokesI'),
+                                          channel_bandwidth=self.channel_bandwidth)
+            large_plan = get_gridding_plan(large_vis, self.model, oversampling=4)
+            assert large_plan.nbytes > gridding_plan.gridding_plan_cache_max_bytes
+            assert get_gridding_plan(large_vis, self.model, oversampling=4) is not large_plan
+            assert get_gridding_plan(self.vis, self.model, oversampling=4) is plan
+        finally:
+            gridding_plan.gridding_plan_cache_max_bytes = max_bytes
+        
+        # Results with and without a (cached or explicit) plan must be identical
+        dirty, sumwt = invert_2d(self.vis, self.model, oversampling=4, gridding_plan_cache=False)
+        for kwargs in [{}, {'gridding_plan': create_gridding_plan(self.vis, self.model, oversampling=4)}]:
+            pdirty, psumwt = invert_2d(self.vis, self.model, oversampling=4, **kwargs)
+            assert numpy.array_equal(dirty.data, pdirty.data)
+            assert numpy.array_equal(sumwt, psumwt)
+        
+        self.model.data[...] = dirty.data
+        vis = predict_2d(self.vis, self.model, oversampling=4, gridding_plan_cache=False).vis.copy()
+        pvis = predict_2d(self.vis, self.model, oversampling=4, gridding_plan=plan).vis
+        assert numpy.array_equal(vis, pvis)
+
+    def test_block_visibility_rows(self):
+        bvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                      polarisation_frame=PolarisationFrame('stokesI'),
+                                      channel_bandwidth=self.channel_bandwidth)
+        bvis.data['vis'] = numpy.random.randn(*bvis.vis.shape) + 1j * numpy.random.randn(*bvis.vis.shape)
+        rows = BlockVisibilityRows(bvis)
+        vis = convert_blockvisibility_to_visibility(bvis)
+        assert rows.nvis == vis.nvis
+        assert numpy.array_equal(rows.uvw, vis.uvw)
+        assert numpy.array_equal(rows.frequency, vis.frequency)
+        assert numpy.array_equal(rows.gather(bvis.vis), vis.vis)
+        
+        # Only the cross-correlations are written back
+        rows.scatter(vis.vis, bvis.data['vis'])
+        assert numpy.array_equal(rows.gather(bvis.vis), vis.vis)
+        assert numpy.max(numpy.abs(bvis.vis[:, 0, 0, ...])) == 0.0
+        assert numpy.array_equal(bvis.vis[:, 0, 1, ...], numpy.conjugate(bvis.vis[:, 1, 0, ...]))
+
+    def test_invert_predict_block_directly(self):
+        # Gridding a BlockVisibility directly must give the same results as converting to a Visibility first
+        bvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                      polarisation_frame=PolarisationFrame('stokesI'),
+                                      channel_bandwidth=self.channel_bandwidth)
+        bvis.data['vis'] = numpy.random.randn(*bvis.vis.shape) + 1j * numpy.random.randn(*bvis.vis.shape)
+        vis = convert_blockvisibility_to_visibility(bvis)
+        for dopsf in [False, True]:
+            dirty, sumwt = invert_2d(vis, self.model, dopsf=dopsf)
+            bdirty, bsumwt = invert_2d(bvis, self.model, dopsf=dopsf, block_gridding=True)
+            assert numpy.array_equal(dirty.data, bdirty.data)
+            assert numpy.array_equal(sumwt, bsumwt)
+        
+        # The image phase centre is offset from the visibility phase centre so that both the dirty image and
+        # the PSF are shifted
+        offset_phasecentre = SkyCoord(ra=+181.0 * u.deg, dec=-59.5 * u.deg, frame='icrs', equinox='J2000')
+        offset_model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.001, nchan=self.vnchan,
+                                                    frequency=self.startfrequency, phasecentre=offset_phasecentre,
+                                                    imagecentre=offset_phasecentre)
+        for dopsf in [False, True]:
+            dirty, sumwt = invert_2d(vis, offset_model, dopsf=dopsf)
+            bdirty, bsumwt = invert_2d(bvis, offset_model, dopsf=dopsf, block_gridding=True)
+            assert numpy.array_equal(dirty.data, bdirty.data)
+            assert numpy.array_equal(sumwt, bsumwt)
+        
+        dirty, sumwt = invert_2d(vis, self.model)
+        self.model.data[...] = dirty.data
+        vis = predict_2d(vis, self.model)
+        bvis = predict_2d(copy_visibility(bvis, zero=True), self.model, block_gridding=True)
+        assert numpy.array_equal(BlockVisibilityRows(bvis).gather(bvis.vis), vis.vis)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,19 +2,25 @@
 
 
 """
+import time
 import unittest
 
 import numpy
 
+from astropy import constants
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
 from data_models.polarisation import PolarisationFrame
 
+from libs.util.array_functions import average_chunks2
+
 from processing_components.simulation.testing_support import create_named_configuration
 from processing_components.visibility.coalesce import coalesce_visibility, decoalesce_visibility, \
-    convert_blockvisibility_to_visibility
-from processing_components.visibility.base import create_blockvisibility, create_visibility_from_rows
+    convert_blockvisibility_to_visibility, convert_blocks, average_in_blocks, decoalesce_vis, get_coalescence_plan, \
+    create_coalescence_plan
+from processing_components.visibility.base import create_blockvisibility, create_visibility_from_rows, \
+    copy_visibility
 from processing_components.visibility.iterators import vis_timeslice_iter
 
 import logging
@@ -22,6 +28,39 @@ import logging
 log = logging.getLogger(__name__)
 
 
+def convert_blocks_loop(vis, uvw, wts, times, integration_time, frequency, channel_bandwidth):
+    """ Reference conversion of blocks to rows, one element at a time
+    """
+    ntimes, nant, _, nchan, npol = vis.shape
+    cnvis = ntimes * nant * (nant - 1) * nchan // 2
+    ctime, cfrequency, cchannel_bandwidth, cintegration_time = [numpy.zeros([cnvis]) for i in range(4)]
+    cvis = numpy.zeros([cnvis, npol], dtype='complex')
+    cwts = numpy.zeros([cnvis, npol])
+    cuvw = numpy.zeros([cnvis, 3])
+    ca1 = numpy.zeros([cnvis], dtype='int')
+    ca2 = numpy.zeros([cnvis], dtype='int')
+    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
+    rowgrid.flat = range(rowgrid.size)
+    cindex = numpy.zeros([rowgrid.size], dtype='int')
+    row = 0
+    for itime in range(ntimes):
+        for a1 in range(nant):
+            for a2 in range(a1 + 1, nant):
+                for chan in range(nchan):
+                    ca1[row] = a1
+                    ca2[row] = a2
+                    cfrequency[row] = frequency[chan]
+                    ctime[row] = times[itime]
+                    cuvw[row, :] = uvw[itime, a2, a1, :] * frequency[chan] / constants.c.value
+                    cindex.flat[rowgrid[itime, a2, a1, chan]] = row
+                    cintegration_time[row] = integration_time[itime]
+                    cchannel_bandwidth[row] = channel_bandwidth[chan]
+                    cvis[row, :] = vis[itime, a2, a1, chan, :]
+                    cwts[row, :] = wts[itime, a2, a1, chan, :]
+                    row += 1
+    return cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
+
+
 class TestCoalesce(unittest.TestCase):
     def setUp(self):
 
@@ -53,6 +92,123 @@ class TestCoalesce(unittest.TestCase):
         dvis = decoalesce_visibility(cvis, overwrite=True)
         assert dvis.nvis == self.blockvis.nvis
 
+    def test_convert_blocks(self):
+        # The vectorised conversion must give exactly the same rows and index as the element by element loop. The
+        # times are logged but not compared.
+        self.blockvis.data['vis'] = numpy.random.randn(*self.blockvis.vis.shape) + \
+                                    1j * numpy.random.randn(*self.blockvis.vis.shape)
+        self.blockvis.data['weight'] = numpy.random.rand(*self.blockvis.vis.shape)
+        args = (self.blockvis.data['vis'], self.blockvis.data['uvw'], self.blockvis.data['weight'], self.blockvis.time,
+                self.blockvis.integration_time, self.blockvis.frequency, self.blockvis.channel_bandwidth)
+        start = time.time()
+        expected = convert_blocks_loop(*args)
+        loop_time = time.time() - start
+        start = time.time()
+        result = convert_blocks(*args)
+        vectorised_time = time.time() - start
+        log.info("test_convert_blocks: loop %.3f s, vectorised %.3f s" % (loop_time, vectorised_time))
+        for e, r in zip(expected, result):
+            assert e.dtype == r.dtype
+            assert numpy.array_equal(e, r)
+
+    def test_average_in_blocks(self):
+        # Each baseline must be averaged as by average_chunks2, with the baselines in the order a2, a1
+        vis = numpy.random.randn(*self.blockvis.vis.shape) + 1j * numpy.random.randn(*self.blockvis.vis.shape)
+        wts = numpy.random.rand(*self.blockvis.vis.shape)
+        uvw = self.blockvis.uvw
+        ntimes, nant, _, nchan, npol = vis.shape
+        cvis, cuvw, cwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex = \
+            average_in_blocks(vis, uvw, wts, self.blockvis.time, self.blockvis.integration_time, self.frequency,
+                              self.channel_bandwidth, time_coal=1.0, max_time_coal=10, frequency_coal=1.0,
+                              max_frequency_coal=2)
+        uvmax = numpy.sqrt(numpy.max(uvw[:, 0] ** 2 + uvw[:, 1] ** 2 + uvw[:, 2] ** 2))
+        rowgrid = numpy.arange(cindex.size).reshape([ntimes, nant, nant, nchan])
+        start = 0
+        for a2 in range(nant):
+            for a1 in range(nant):
+                uvdist = numpy.max(numpy.sqrt(uvw[:, a2, a1, 0] ** 2 + uvw[:, a2, a1, 1] ** 2))
+                if uvdist > 0.0:
+                    factor = max(1, int(round(uvmax / uvdist)))
+                    chunksize = (min(10, factor), min(2, factor))
+                else:
+                    chunksize = (10, 2)
+                for pol in range(npol):
+                    answervis, answerwts = average_chunks2(vis[:, a2, a1, :, pol], wts[:, a2, a1, :, pol], chunksize)
+                    rows = slice(start, start + answervis.size)
+                    numpy.testing.assert_array_equal(cvis[rows, pol], answervis.flatten())
+                    numpy.testing.assert_array_equal(cwts[rows, pol], answerwts.flatten())
+                assert numpy.all(ca1[rows] == a1) and numpy.all(ca2[rows] == a2)
+                numpy.testing.assert_array_equal(cindex[rowgrid[:, a2, a1, :].flatten()],
+                                                 start + numpy.arange(ntimes * nchan) % answervis.size)
+                start += answervis.size
+        assert start == cvis.shape[0]
+
+    def test_decoalesce_exact(self):
+        # The gather must reproduce the row by row copy exactly
+        cvis = coalesce_visibility(self.blockvis, time_coal=1.0, frequency_coal=1.0)
+        cvis.data['vis'] = numpy.random.randn(*cvis.vis.shape) + 1j * numpy.random.randn(*cvis.vis.shape)
+        vshape = self.blockvis.vis.shape
+        npol = vshape[-1]
+        expected = numpy.zeros(vshape, dtype='complex')
+        for i in range(expected.size // npol):
+            expected.flat[i:i + npol] = cvis.vis[cvis.cindex[i]]
+        dvis = decoalesce_visibility(cvis, overwrite=True)
+        assert numpy.array_equal(dvis.vis, expected)
+        assert numpy.array_equal(decoalesce_vis(vshape, cvis.vis, cvis.cindex), expected)
+        
+        # Reuse a preallocated array
+        target = numpy.zeros(vshape, dtype='complex')
+        assert decoalesce_vis(vshape, cvis.vis, cvis.cindex, dvis=target) is target
+        assert numpy.array_equal(target, expected)
+
+    def test_decoalesce_polarisation(self):
+        self.blockvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                               weight=1.0, polarisation_frame=PolarisationFrame('linear'),
+                                               channel_bandwidth=self.channel_bandwidth)
+        self.blockvis.data['vis'] = numpy.random.randn(*self.blockvis.vis.shape)
+        cvis = convert_blockvisibility_to_visibility(self.blockvis)
+        dvis = decoalesce_visibility(cvis, overwrite=True)
+        a1, a2 = numpy.triu_indices(self.blockvis.nants, 1)
+        assert numpy.array_equal(dvis.vis[:, a2, a1, ...], self.blockvis.vis[:, a2, a1, ...])
+
+    def test_coalescence_plan(self):
+        # The plan is calculated once and attached to the BlockVisibility; later coalescence of new visibility
+        # values must give exactly the same result as coalescing from scratch
+        self.blockvis.data['weight'] = numpy.random.rand(*self.blockvis.vis.shape)
+        for kwargs in [dict(time_coal=1.0, frequency_coal=1.0), dict(time_coal=0.0, frequency_coal=0.0)]:
+            cvis = coalesce_visibility(self.blockvis, **kwargs)
+            plan = get_coalescence_plan(self.blockvis, **kwargs)
+            assert cvis.cindex is plan.cindex
+            self.blockvis.data['vis'] = numpy.random.randn(*self.blockvis.vis.shape) + 0j
+            cvis = coalesce_visibility(self.blockvis, **kwargs)
+            assert get_coalescence_plan(self.blockvis, **kwargs) is plan
+            assert cvis.cindex is plan.cindex
+            if kwargs['time_coal'] > 0.0:
+                expected = average_in_blocks(self.blockvis.data['vis'], self.blockvis.data['uvw'],
+                                             self.blockvis.data['weight'], self.blockvis.time,
+                                             self.blockvis.integration_time, self.frequency, self.channel_bandwidth,
+                                             time_coal=1.0, max_time_coal=100, frequency_coal=1.0,
+                                             max_frequency_coal=100)
+            else:
+                expected = convert_blocks(self.blockvis.data['vis'], self.blockvis.data['uvw'],
+                                          self.blockvis.data['weight'], self.blockvis.time,
+                                          self.blockvis.integration_time, self.frequency, self.channel_bandwidth)
+            for column, e in zip(['vis', 'uvw', 'weight', 'time', 'frequency', 'channel_bandwidth', 'antenna1',
+                                  'antenna2', 'integration_time'], expected):
+                assert numpy.array_equal(cvis.data[column], e), column
+            assert numpy.array_equal(cvis.cindex, expected[-1])
+
+            # Copies keep the plan, explicit plans are used, and changed weights need a new plan
+            assert get_coalescence_plan(copy_visibility(self.blockvis), **kwargs) is plan
+            assert get_coalescence_plan(self.blockvis, coalescence_plan=plan) is plan
+            newvis = copy_visibility(self.blockvis)
+            newvis.data['weight'][0, ...] = 0.0
+            assert not plan.matches(newvis)
+            assert get_coalescence_plan(newvis, **kwargs) is not plan
+            assert get_coalescence_plan(self.blockvis, **kwargs) is plan
+            with self.assertRaises(AssertionError):
+                coalesce_visibility(newvis, coalescence_plan=create_coalescence_plan(self.blockvis, **kwargs))
+
     def test_coalesce_decoalesce(self):
         cvis = coalesce_visibility(self.blockvis, time_coal=1.0, frequency_coal=1.0)
         assert numpy.min(cvis.frequency) == numpy.min(self.frequency)
@@ -3,6 +3,7 @@
 
 """
 
+import tracemalloc
 import unittest
 
 import numpy
@@ -13,8 +14,9 @@ from processing_components.simulation.testing_support import create_named_config
 from processing_components.visibility.gather_scatter import visibility_gather_time, visibility_gather_w, \
     visibility_scatter_time, visibility_scatter_w, visibility_scatter_channel, \
     visibility_gather_channel
-from processing_components.visibility.iterators import vis_wslices, vis_timeslices
-from processing_components.visibility.base import create_visibility, create_blockvisibility
+from processing_components.visibility.iterators import vis_wslices, vis_timeslices, vis_wslice_iter
+from processing_components.visibility.base import create_visibility, create_blockvisibility, copy_visibility, \
+    create_visibility_from_rows
 
 import logging
 
@@ -66,6 +68,41 @@ class TestVisibilityGatherScatter(unittest.TestCase):
         assert self.vis.nvis == newvis.nvis
         assert numpy.max(numpy.abs(newvis.vis)) > 0.0
 
+    def test_vis_scatter_gather_views(self):
+        # The subvisibilities are views on one copy of the rows, and the gather restores every row
+        self.actualSetUp()
+        self.vis.data['vis'][:, 0] = numpy.arange(self.vis.nvis)
+        vis_slices = vis_wslices(self.vis, 10.0)
+        tracemalloc.start()
+        try:
+            vis_list = visibility_scatter_w(self.vis, vis_slices)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        log.info("test_vis_scatter_gather_views: %d slices, peak allocated %.2f of visibility size" %
+                 (vis_slices, peak / self.vis.data.nbytes))
+        assert peak < 1.5 * self.vis.data.nbytes
+        bases = set(id(subvis.data.base) for subvis in vis_list if subvis is not None)
+        assert len(bases) == 1
+        for i, rows in enumerate(vis_wslice_iter(self.vis, vis_slices)):
+            if numpy.sum(rows):
+                assert numpy.array_equal(vis_list[i].data, self.vis.data[rows])
+        newvis = visibility_gather_w(vis_list, copy_visibility(self.vis, zero=True), vis_slices)
+        assert numpy.array_equal(newvis.data, self.vis.data)
+
+    def test_create_visibility_from_rows_view(self):
+        self.actualSetUp()
+        rows = self.vis.time == numpy.unique(self.vis.time)[3]
+        selected = create_visibility_from_rows(self.vis, rows, makecopy=False)
+        assert numpy.shares_memory(selected.data, self.vis.data)
+        selected.data['vis'][...] = -1.0
+        assert numpy.all(self.vis.vis[rows] == -1.0)
+        selected = create_visibility_from_rows(self.vis, rows)
+        assert not numpy.shares_memory(selected.data, self.vis.data)
+        # Rows that are not contiguous are always copied
+        selected = create_visibility_from_rows(self.vis, numpy.arange(0, self.vis.nvis, 2), makecopy=False)
+        assert not numpy.shares_memory(selected.data, self.vis.data)
+
     def test_vis_scatter_gather_channel(self):
         self.actualSetUp()
         nchan = len(self.blockvis.frequency)
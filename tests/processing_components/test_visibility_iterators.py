@@ -2,13 +2,15 @@
 
 
 """
-import numpy
 import unittest
 
+import numpy
+
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 from processing_components.simulation.testing_support import create_named_configuration
-from processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices
+from processing_components.visibility.iterators import vis_timeslice_iter, vis_wslice_iter, vis_null_iter, vis_timeslices, vis_wslices, \
+    vis_timeslice_index_iter, vis_wslice_index_iter
 from processing_components.visibility.base import create_visibility, create_visibility_from_rows
 
 import logging
@@ -76,5 +78,32 @@ class TestVisibilityIterators(unittest.TestCase):
             assert numpy.sum(visslice.nvis) < self.vis.nvis
         assert total_rows == self.vis.nvis, "Total rows iterated %d, Original rows %d" % (total_rows, self.vis.nvis)
 
+    def test_vis_index_iterators(self):
+        # The index iterators must select exactly the same rows as the boolean iterators, including rows on the
+        # boundary of two slices
+        self.actualSetUp()
+        for mask_iter, index_iter, slices in [(vis_timeslice_iter, vis_timeslice_index_iter, [None, 1, 2, 4, 9]),
+                                              (vis_wslice_iter, vis_wslice_index_iter, [1, 2, 11, 101])]:
+            for vis_slices in slices:
+                masks = list(mask_iter(self.vis, vis_slices=vis_slices))
+                indices = list(index_iter(self.vis, vis_slices=vis_slices))
+                assert len(masks) == len(indices)
+                for rows, index in zip(masks, indices):
+                    assert numpy.array_equal(numpy.nonzero(rows)[0], index)
+                    visslice = create_visibility_from_rows(self.vis, index)
+                    if len(index):
+                        assert numpy.array_equal(visslice.vis, create_visibility_from_rows(self.vis, rows).vis)
+                    else:
+                        assert visslice is None
+
+    def test_vis_index_iterators_many_slices(self):
+        self.actualSetUp(times=numpy.linspace(-300.0, 300.0, 100) * numpy.pi / 43200.0)
+        for mask_iter, index_iter in [(vis_timeslice_iter, vis_timeslice_index_iter),
+                                      (vis_wslice_iter, vis_wslice_index_iter)]:
+            nmask = sum(numpy.sum(rows) for rows in mask_iter(self.vis, vis_slices=500))
+            nindex = sum(len(rows) for rows in index_iter(self.vis, vis_slices=500))
+            assert nmask == nindex
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,7 +19,7 @@ from processing_components.simulation.testing_support import create_named_config
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.visibility.coalesce import convert_blockvisibility_to_visibility
 from processing_components.visibility.operations import append_visibility, qa_visibility, \
-    sum_visibility, subtract_visibility
+    sum_visibility, subtract_visibility, divide_visibility
 from processing_components.visibility.base import copy_visibility, create_visibility, create_blockvisibility, create_visibility_from_rows,\
     phaserotate_visibility
 
@@ -200,6 +200,39 @@ class TestVisibilityOperations(unittest.TestCase):
         self.assertAlmostEqual(qa.data['maxabs'], 0.0, 7)
 
 
+    def test_divide_visibility_polarised(self):
+        vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                     channel_bandwidth=self.channel_bandwidth,
+                                     phasecentre=self.phasecentre, weight=1.0,
+                                     polarisation_frame=PolarisationFrame("linear"))
+        rs = numpy.random.RandomState(1)
+        shape = vis.vis.shape
+        vis.data['vis'] = rs.normal(size=shape) + 1j * rs.normal(size=shape)
+        vis.data['weight'] = rs.uniform(0.5, 2.0, shape)
+        modelvis = copy_visibility(vis)
+        modelvis.data['vis'] = rs.normal(size=shape) + 1j * rs.normal(size=shape)
+        pointvis = divide_visibility(vis, modelvis)
+        
+        # Compare with the division one baseline at a time. The weights are identical, but the batched inverse and
+        # product may round differently so the point source visibilities agree only to rounding error
+        for row, ant2, ant1, chan in [(0, 1, 0, 0), (3, 7, 2, 1), (shape[0] - 1, shape[1] - 1, 0, 2)]:
+            ovis = numpy.matrix(vis.vis[row, ant2, ant1, chan].reshape([2, 2]))
+            mvis = numpy.matrix(modelvis.vis[row, ant2, ant1, chan].reshape([2, 2]))
+            wt = numpy.matrix(vis.weight[row, ant2, ant1, chan].reshape([2, 2]))
+            x = numpy.matmul(numpy.linalg.inv(mvis), ovis)
+            xwt = numpy.dot(mvis, numpy.multiply(wt, mvis.H)).real
+            assert_allclose(pointvis.vis[row, ant2, ant1, chan], numpy.asarray(x).reshape([4]), rtol=1e-12)
+            assert numpy.array_equal(pointvis.weight[row, ant2, ant1, chan], numpy.asarray(xwt).reshape([4]))
+        
+        # Singular model visibilities are given zero weight
+        modelvis.data['vis'][0, 1, 0, 0] = 0.0
+        modelvis.data['vis'][3, 7, 2, 1] = [1.0, 2.0, 2.0, 4.0]
+        pointvis = divide_visibility(vis, modelvis)
+        assert numpy.all(pointvis.weight[0, 1, 0, 0] == 0.0)
+        assert numpy.all(pointvis.weight[3, 7, 2, 1] == 0.0)
+        assert numpy.all(numpy.isfinite(pointvis.vis))
+        assert numpy.all(pointvis.weight[0, 2, 0, 0] != 0.0)
+
     def test_qa(self):
         self.vis = create_visibility(self.lowcore, self.times, self.frequency,
                                      channel_bandwidth=self.channel_bandwidth,
@@ -187,6 +187,15 @@ class TestImaging(unittest.TestCase):
         self._predict_base(context='wstack', extra='_wprojection', fluxthreshold=3.0, wstep=2.5, vis_slices=11,
                            oversampling=2)
     
+    def test_predict_wstack_native(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_native', fluxthreshold=2.0, vis_slices=41)
+    
+    def test_predict_wstack_native_wprojection(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_native', extra='_wprojection', fluxthreshold=3.0, wstep=2.5,
+                           vis_slices=11, oversampling=2)
+    
     def test_predict_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._predict_base(context='wstack', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
@@ -243,6 +252,18 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=41)
     
+    def test_invert_wstack_native(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_native', positionthreshold=1.0, vis_slices=41)
+    
+    def test_invert_wstack_native_agrees(self):
+        self.actualSetUp()
+        dirty = invert_serial(self.vis, self.model, context='wstack', vis_slices=41)
+        dirty_native = invert_serial(self.vis, self.model, context='wstack_native', vis_slices=41)
+        numpy.testing.assert_allclose(dirty_native[0].data, dirty[0].data,
+                                      atol=1e-12 * numpy.max(numpy.abs(dirty[0].data)))
+        numpy.testing.assert_allclose(dirty_native[1], dirty[1])
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -7,6 +7,11 @@ to denote a null node.
 The actual imaging code executed eventually is specified by the context variable (see libs.imaging.imaging)context.
 These are the same as executed in the imaging framework.
 
+The gridding plans (grid coordinates, channel maps and kernels) used by invert, predict and weighting are kept in a
+cache in each worker process (see libs.imaging.gridding_plan). They are not passed between tasks, so a plan is reused
+in later major cycles only when the task for the same visibility runs in the same worker process again. If the
+scheduler moves the task to another worker, the plan is calculated again there.
+
 """
 
 import collections
@@ -22,7 +27,7 @@ from processing_components.image.deconvolution import deconvolve_cube, restore_c
 from processing_components.image.gather_scatter import image_scatter_facets, image_gather_facets, \
     image_scatter_channels,    image_gather_channels
 from processing_components.imaging.base import normalize_sumwt
-from workflows.shared.imaging.imaging_shared import imaging_context
+from workflows.shared.imaging.imaging_shared import imaging_context, imaging_context_slices
 from processing_components.imaging.weighting import weight_visibility
 from processing_components.visibility.base import copy_visibility
 from processing_components.visibility.gather_scatter import visibility_scatter, visibility_gather
@@ -70,7 +75,8 @@ def predict_arlexecute(vis_list, model_imagelist, vis_slices=1, facets=1, contex
         facet_lists = arlexecute.execute(image_scatter_facets, nout=actual_number_facets ** 2)(model_imagelist[freqwin],
                                                                                                facets=facets)
         # Create the graph to divide the visibility into slices. This is by copy.
-        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=vis_slices)(vis_list, vis_iter, vis_slices)
+        nslices = imaging_context_slices(context, vis_slices)
+        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=nslices)(vis_list, vis_iter, nslices)
         
         facet_vis_lists = list()
         # Loop over sub visibility
@@ -146,8 +152,8 @@ def invert_arlexecute(vis_list, template_model_imagelist, dopsf=False, normalize
                                                                                                    freqwin],
                                                                                                facets=facets)
         # Create the graph to divide the visibility into slices. This is by copy.
-        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=vis_slices)(vis_list, vis_iter,
-                                                                                vis_slices=vis_slices)
+        nslices = imaging_context_slices(context, vis_slices)
+        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=nslices)(vis_list, vis_iter, vis_slices=nslices)
         
         # Iterate within each vis_list
         vis_results = list()
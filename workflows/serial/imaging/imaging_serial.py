@@ -28,6 +28,8 @@ def invert_serial(vis, im: Image, dopsf=False, normalize=True, context='2d', vis
 
      * 2d: Two-dimensional transform
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_native: wstacking with vis_slices w planes, gridded in a single pass
+     * idg: image domain gridding, with the w term applied exactly in the image domain of small subgrids
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
@@ -86,6 +88,8 @@ def predict_serial(vis, model: Image, context='2d', vis_slices=1, facets=1, over
     
      * 2d: Two-dimensional transform
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_native: wstacking with vis_slices w planes, gridded in a single pass
+     * idg: image domain gridding, with the w term applied exactly in the image domain of small subgrids
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
@@ -120,7 +124,7 @@ def predict_serial(vis, model: Image, context='2d', vis_slices=1, facets=1, over
             visslice.data['vis'][...] = 0.0
             for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
                 result.data['vis'][...] = 0.0
-                result = predict(visslice, dpatch, **kwargs)
+                result = predict(visslice, dpatch, facets=facets, vis_slices=vis_slices, **kwargs)
                 svis.data['vis'][rows] += result.data['vis']
 
     if not isinstance(vis, Visibility):
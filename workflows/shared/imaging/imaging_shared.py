@@ -6,6 +6,8 @@ from processing_components.imaging.base import predict_2d, invert_2d
 from processing_components.visibility.iterators import vis_null_iter, vis_timeslice_iter, vis_wslice_iter
 from processing_components.imaging.timeslice_single import predict_timeslice_single, invert_timeslice_single
 from processing_components.imaging.wstack_single import predict_wstack_single, invert_wstack_single
+from processing_components.imaging.wstack_native import predict_wstack_native, invert_wstack_native
+from processing_components.imaging.idg import predict_idg, invert_idg
 
 
 def imaging_contexts():
@@ -32,12 +34,18 @@ def imaging_contexts():
                 'facets_wstack': {'predict': predict_wstack_single,
                                   'invert': invert_wstack_single,
                                   'vis_iterator': vis_wslice_iter},
+                'idg': {'predict': predict_idg,
+                        'invert': invert_idg,
+                        'vis_iterator': vis_null_iter},
                 'timeslice': {'predict': predict_timeslice_single,
                               'invert': invert_timeslice_single,
                               'vis_iterator': vis_timeslice_iter},
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
-                           'vis_iterator': vis_wslice_iter}}
+                           'vis_iterator': vis_wslice_iter},
+                'wstack_native': {'predict': predict_wstack_native,
+                                  'invert': invert_wstack_native,
+                                  'vis_iterator': vis_null_iter}}
     
     return contexts
 
@@ -45,4 +53,18 @@ def imaging_contexts():
 def imaging_context(context='2d'):
     contexts = imaging_contexts()
     assert context in contexts.keys(), context
-    return contexts[context]
\ No newline at end of file
+    return contexts[context]
+
+
+def imaging_context_slices(context='2d', vis_slices=1):
+    """Number of sub-visibilities made by the visibility iterator of a context
+    
+    Contexts such as wstack_native use vis_slices themselves and do not scatter the visibility.
+    
+    :param context: Imaging context e.g. '2d', 'wstack'
+    :param vis_slices: Number of vis slices requested
+    :return: Number of sub-visibilities
+    """
+    if imaging_context(context)['vis_iterator'] == vis_null_iter:
+        return 1
+    return vis_slices